@@ -21,7 +21,7 @@ from .models import (
 )
 from django.db.models import Sum
 from decimal import Decimal
-from .models import Empleado, Asistencia, AdelantoSueldo
+from .models import Empleado, Asistencia, AdelantoSueldo, CalendarioLaboral, SecuenciaFactura
 
 # --- NUEVO: Panel interactivo para Facturas CORREGIDO ---
 @admin.register(Factura)
@@ -38,6 +38,11 @@ class FacturaAdmin(admin.ModelAdmin):
         return obj.orden.cliente.nombre
     obtener_cliente.short_description = 'Cliente'
 
+    # Si se pone un número a mano, el contador de la serie lo salta a partir de ahora
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        SecuenciaFactura.avanzar_hasta(obj.numero_factura)
+
 
 # Personalización para OrdenDeReparacion
 class OrdenDeReparacionAdmin(admin.ModelAdmin):
@@ -52,8 +57,8 @@ class CompraConsumibleAdmin(admin.ModelAdmin):
 
 # Personalización para TipoConsumible
 class TipoConsumibleAdmin(admin.ModelAdmin):
-    list_display = ('nombre', 'unidad_medida', 'nivel_minimo_stock')
-    fields = ('nombre', 'unidad_medida', 'nivel_minimo_stock')
+    list_display = ('nombre', 'unidad_medida', 'nivel_minimo_stock', 'metodo_coste')
+    fields = ('nombre', 'unidad_medida', 'nivel_minimo_stock', 'metodo_coste')
 
 # --- NUEVA CLASE ADMIN PARA AJUSTES ---
 @admin.register(AjusteStockConsumible)
@@ -70,6 +75,9 @@ class TipoConsumibleStockAdmin(admin.ModelAdmin):
     list_filter = ('unidad_medida',)
     search_fields = ('nombre',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_stock()
+
     def has_add_permission(self, request):
         return False
     def has_delete_permission(self, request, obj=None):
@@ -91,8 +99,17 @@ class AsistenciaAdmin(admin.ModelAdmin):
 
 @admin.register(AdelantoSueldo)
 class AdelantoSueldoAdmin(admin.ModelAdmin):
-    list_display = ('empleado', 'fecha', 'importe', 'motivo', 'liquidado')
+    list_display = ('empleado', 'fecha', 'importe', 'motivo', 'orden', 'liquidado')
     list_filter = ('liquidado', 'empleado', 'fecha')
+    raw_id_fields = ('orden', 'linea_factura')
+    list_select_related = ('empleado', 'orden__vehiculo')
+
+# 🟢 NUEVO: Festivos y cierres del taller (cuentan para el sueldo diario de los fijos)
+@admin.register(CalendarioLaboral)
+class CalendarioLaboralAdmin(admin.ModelAdmin):
+    list_display = ('fecha', 'descripcion', 'ambito')
+    list_filter = ('ambito',)
+    date_hierarchy = 'fecha'
 
 # Registramos todos los modelos restantes
 admin.site.register(Cliente)
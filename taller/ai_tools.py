@@ -2,14 +2,13 @@
 from django.urls import reverse
 from django.core.signing import Signer
 from django.utils import timezone
-from django.db.models import Sum
+from django.db.models import Sum, Count
 from urllib.parse import quote
 from decimal import Decimal
 from collections import Counter
 from .models import (
     Vehiculo, OrdenDeReparacion, Factura, Presupuesto, LineaPresupuesto,
-    TipoConsumible, Ingreso, Gasto, CompraConsumible, 
-    UsoConsumible, AjusteStockConsumible, NotaTablon, Cliente
+    TipoConsumible, Ingreso, Gasto, NotaTablon, Cliente
 )
 
 def obtener_factura_por_matricula(matricula, enviar_whatsapp=False):
@@ -126,14 +125,10 @@ def consultar_estado_vehiculo(matricula):
 
 def consultar_stock(articulo):
     articulo_limpio = articulo.strip().lower()
-    consumible = TipoConsumible.objects.filter(nombre__icontains=articulo_limpio).first()
+    consumible = TipoConsumible.objects.with_stock().filter(nombre__icontains=articulo_limpio).first()
     
     if consumible:
-        total_comprado = CompraConsumible.objects.filter(tipo=consumible).aggregate(total=Sum('cantidad'))['total'] or Decimal('0.00')
-        total_usado = UsoConsumible.objects.filter(tipo=consumible).aggregate(total=Sum('cantidad_usada'))['total'] or Decimal('0.00')
-        total_ajustado = AjusteStockConsumible.objects.filter(tipo=consumible).aggregate(total=Sum('cantidad_ajustada'))['total'] or Decimal('0.00')
-        
-        stock_real = total_comprado - total_usado + total_ajustado
+        stock_real = consumible.stock_actual
         minimo = consumible.nivel_minimo_stock or Decimal('0.00')
 
         if stock_real <= minimo:
@@ -160,16 +155,9 @@ def resumen_caja_hoy():
     return {"status": "success", "mensaje": mensaje}
 
 def clientes_deudores():
-    facturas = Factura.objects.select_related('orden__cliente', 'orden__vehiculo').prefetch_related('orden__ingreso_set')
-    total_deuda = Decimal('0.00')
-    facturas_pendientes = 0
-    
-    for f in facturas:
-        abonos = sum(ing.importe for ing in f.orden.ingreso_set.all()) if f.orden.ingreso_set.exists() else Decimal('0.00')
-        pendiente = f.total_final - abonos
-        if pendiente > Decimal('0.01'):
-            total_deuda += pendiente
-            facturas_pendientes += 1
+    resumen = Factura.objects.pendientes_de_cobro().aggregate(total=Sum('pendiente'), numero=Count('id'))
+    total_deuda = Decimal(resumen['total'] or 0).quantize(Decimal('0.01'))
+    facturas_pendientes = resumen['numero']
             
     if facturas_pendientes == 0:
         return {"status": "success", "mensaje": "¡Excelentes noticias! Ningún cliente nos debe dinero ahora mismo. Todas las cuentas están al día."}
@@ -300,57 +288,40 @@ def desglose_fases_vehiculo(id_orden):
         return {"status": "error", "mensaje": f"No encuentro la orden #{id_orden}."}
         
     vehiculo = orden.vehiculo
-    historial = orden.historial_estados.all().order_by('id')
+    # Las pausas de jornada (taller cerrado) no son una fase: solo enseñamos el tiempo de trabajo
+    historial = list(orden.historial_estados.filter(es_pausa_jornada=False).order_by('fecha_inicio', 'id'))
     
-    if not historial.exists():
+    if not historial:
         return {"status": "success", "mensaje": f"Lo siento, la Orden #{orden.id} no tiene un registro guardado paso a paso de sus fases."}
         
-    lineas = []
-    fechas = list(historial)
-    
-    def obtener_fecha(objeto):
-        for campo in objeto._meta.get_fields():
-            if campo.get_internal_type() in ['DateTimeField', 'DateField']:
-                return getattr(objeto, campo.name)
-        return None
+    def formatear_tiempo(segundos):
+        dias = int(segundos // 86400)
+        horas = int(segundos // 3600)
+        minutos = int((segundos % 3600) // 60)
+        if dias > 0:
+            return f"{dias} días"
+        elif horas > 0:
+            return f"{horas} horas"
+        return f"{minutos} minutos"
 
-    for i in range(len(fechas)):
-        estado_fase = fechas[i].estado
-        fecha_inicio = obtener_fecha(fechas[i])
-        
-        if not fecha_inicio:
-            lineas.append(f"- {estado_fase}: (El sistema no guardó la hora en este paso)")
-            continue
-            
-        if i < len(fechas) - 1:
-            fecha_fin = obtener_fecha(fechas[i+1])
-            if fecha_fin:
-                diferencia = fecha_fin - fecha_inicio
-                dias = diferencia.days
-                segundos = diferencia.seconds
-                horas = segundos // 3600
-                minutos = (segundos % 3600) // 60
-                
-                if dias > 0:
-                    tiempo_str = f"{dias} días"
-                elif horas > 0:
-                    tiempo_str = f"{horas} horas"
-                else:
-                    tiempo_str = f"{minutos} minutos"
-                    
-                lineas.append(f"- {estado_fase}: Estuvo aquí {tiempo_str}")
+    lineas = []
+    for tramo in historial:
+        if tramo.fecha_fin:
+            lineas.append(f"- {tramo.estado}: Estuvo aquí {formatear_tiempo(tramo.duracion_segundos)}")
+        elif orden.estado != 'Entregado':
+            dias = (timezone.now() - tramo.fecha_inicio).days
+            if dias > 0:
+                lineas.append(f"- {tramo.estado} (Actual): Lleva {dias} días")
             else:
-                lineas.append(f"- {estado_fase}: (Error al leer fin)")
+                lineas.append(f"- {tramo.estado} (Actual): Entró hoy mismo")
         else:
-            if orden.estado != 'Entregado':
-                diferencia = timezone.now() - fecha_inicio
-                dias = diferencia.days
-                if dias > 0:
-                    lineas.append(f"- {estado_fase} (Actual): Lleva {dias} días")
-                else:
-                    lineas.append(f"- {estado_fase} (Actual): Entró hoy mismo")
-            else:
-                lineas.append(f"- {estado_fase}: Fase finalizada con éxito.")
+            lineas.append(f"- {tramo.estado}: Fase finalizada con éxito.")
+
+    # Totales ya calculados al cerrar cada tramo (una fase partida por las noches suma todos sus trozos)
+    totales = orden.duraciones_fase.values('estado').annotate(total=Sum('segundos')).order_by('-total')
+    if totales:
+        lineas.append("\n⏱️ Tiempo total de trabajo por fase:")
+        lineas.extend(f"- {fila['estado']}: {formatear_tiempo(fila['total'])}" for fila in totales)
                 
     texto = "\n".join(lineas)
     return {"status": "success", "mensaje": f"Aquí tienes el informe de tiempos paso a paso de la Orden #{orden.id} ({vehiculo.marca}):\n\n{texto}"}
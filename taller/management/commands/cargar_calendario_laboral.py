@@ -0,0 +1,15 @@
+# taller/management/commands/cargar_calendario_laboral.py
+from django.core.management.base import BaseCommand
+
+from taller.models import CalendarioLaboral
+
+
+class Command(BaseCommand):
+    help = "Carga o actualiza los festivos del calendario laboral desde un JSON local (por defecto taller/data/festivos.json)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fichero', help="Ruta a otro JSON con la lista de festivos [{fecha, ambito, descripcion}].")
+
+    def handle(self, *args, **options):
+        creados, actualizados = CalendarioLaboral.cargar_fichero(options['fichero'])
+        self.stdout.write(self.style.SUCCESS(f"Calendario cargado: {creados} festivo(s) nuevo(s), {actualizados} actualizado(s)."))
@@ -0,0 +1,21 @@
+# taller/management/commands/congelar_sueldos.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from taller.models import recalcular_sueldos, sueldos_sin_congelar
+
+
+class Command(BaseCommand):
+    help = "Congela el sueldo de los fichajes cerrados que siguen a 0 (pensado para lanzarlo por cron; el panel de nóminas ya no escribe nada)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--empleado', type=int, help="ID del empleado a congelar (por defecto, todos).")
+
+    def handle(self, *args, **options):
+        asistencias = sueldos_sin_congelar()
+        if options['empleado']: asistencias = asistencias.filter(empleado_id=options['empleado'])
+
+        with transaction.atomic():
+            cambiadas = recalcular_sueldos(asistencias.select_for_update())
+
+        self.stdout.write(self.style.SUCCESS(f"Sueldos congelados: {cambiadas} fichajes."))
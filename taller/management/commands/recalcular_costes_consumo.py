@@ -0,0 +1,38 @@
+# taller/management/commands/recalcular_costes_consumo.py
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from taller.models import TipoConsumible, CompraConsumible, UsoConsumible, AjusteStockConsumible, reconstruir_costes_consumo
+
+
+class Command(BaseCommand):
+    help = "Vuelve a valorar los usos de consumibles repasando su historial (tras cambiar el método de coste o corregir compras antiguas)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tipo', type=int, help="ID del consumible a recalcular (por defecto, todos).")
+
+    def handle(self, *args, **options):
+        tipos = TipoConsumible.objects.all()
+        if options['tipo']: tipos = tipos.filter(id=options['tipo'])
+
+        with transaction.atomic():
+            for tipo in tipos:
+                usos = list(UsoConsumible.objects.filter(tipo=tipo))
+                if not usos: continue
+                costes = reconstruir_costes_consumo(
+                    tipo.metodo_coste,
+                    CompraConsumible.objects.filter(tipo=tipo).values_list('fecha_compra', 'id', 'cantidad', 'coste_total'),
+                    [(u.fecha_uso, u.id, u.cantidad_usada) for u in usos],
+                    AjusteStockConsumible.objects.filter(tipo=tipo).values_list('fecha_ajuste', 'id', 'cantidad_ajustada'),
+                )
+                total_antes = sum((u.coste_total or Decimal('0.00')) for u in usos)
+                for uso in usos:
+                    uso.coste_unitario = costes[uso.id]
+                    uso.coste_total = (uso.coste_unitario * uso.cantidad_usada).quantize(Decimal('0.0001'))
+                UsoConsumible.objects.bulk_update(usos, ['coste_unitario', 'coste_total'])
+                total_despues = sum(u.coste_total for u in usos)
+                self.stdout.write(f"{tipo.nombre} ({tipo.get_metodo_coste_display()}): {len(usos)} usos · {total_antes:.2f}€ -> {total_despues:.2f}€")
+
+        self.stdout.write(self.style.SUCCESS("Costes de consumo recalculados."))
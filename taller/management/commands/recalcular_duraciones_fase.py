@@ -0,0 +1,30 @@
+# taller/management/commands/recalcular_duraciones_fase.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from taller.models import DuracionFaseOrden, HistorialEstadoOrden, sumar_tramos_fase
+
+
+class Command(BaseCommand):
+    help = "Rehace la tabla de tiempos por fase a partir del historial de estados (tras corregir fechas a mano en el admin)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orden', type=int, help="ID de la orden a recalcular (por defecto, todas).")
+
+    def handle(self, *args, **options):
+        historial = HistorialEstadoOrden.objects.filter(fecha_fin__isnull=False)
+        duraciones = DuracionFaseOrden.objects.all()
+        if options['orden']:
+            historial = historial.filter(orden_id=options['orden'])
+            duraciones = duraciones.filter(orden_id=options['orden'])
+
+        with transaction.atomic():
+            duraciones.delete()
+            # La tabla queda vacía: un INSERT por lotes en vez de un get_or_create por fila
+            totales = sumar_tramos_fase(historial.values_list('orden_id', 'estado', 'fecha_inicio', 'fecha_fin', 'es_pausa_jornada').iterator())
+            DuracionFaseOrden.objects.bulk_create([
+                DuracionFaseOrden(orden_id=orden_id, estado=estado, mes=mes, segundos=segundos, tramos=tramos)
+                for (orden_id, estado, mes), (segundos, tramos) in totales.items()
+            ], batch_size=500)
+
+        self.stdout.write(self.style.SUCCESS(f"Tiempos por fase recalculados: {duraciones.count()} filas."))
@@ -0,0 +1,50 @@
+# taller/management/commands/recalcular_saldos.py
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from taller.models import SaldoCuenta
+
+
+class Command(BaseCommand):
+    help = "Reconstruye la tabla de saldos por cuenta (SaldoCuenta) desde Gasto/Ingreso e informa de los descuadres."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--solo-comprobar', action='store_true', help="Solo informa de los descuadres, no corrige nada.")
+
+    def handle(self, *args, **options):
+        solo_comprobar = options['solo_comprobar']
+        descuadres = 0
+
+        with transaction.atomic():
+            reales = SaldoCuenta.calcular_desde_movimientos()
+            guardados = {s.cuenta: s for s in SaldoCuenta.objects.select_for_update()}
+
+            for cuenta, (total_ingresos, total_gastos) in reales.items():
+                fila = guardados.get(cuenta)
+                ing_guardado = fila.total_ingresos if fila else Decimal('0.00')
+                gas_guardado = fila.total_gastos if fila else Decimal('0.00')
+
+                if ing_guardado != total_ingresos or gas_guardado != total_gastos:
+                    descuadres += 1
+                    self.stdout.write(self.style.WARNING(
+                        f"❌ {cuenta}: guardado {ing_guardado - gas_guardado}€ "
+                        f"(ing {ing_guardado} / gas {gas_guardado}) -> real {total_ingresos - total_gastos}€ "
+                        f"(ing {total_ingresos} / gas {total_gastos})"
+                    ))
+                else:
+                    self.stdout.write(f"✅ {cuenta}: {total_ingresos - total_gastos}€")
+
+                if not solo_comprobar:
+                    SaldoCuenta.objects.update_or_create(
+                        cuenta=cuenta,
+                        defaults={'total_ingresos': total_ingresos, 'total_gastos': total_gastos}
+                    )
+
+        if not descuadres:
+            self.stdout.write(self.style.SUCCESS("Saldos cuadrados. Sin descuadres."))
+        elif solo_comprobar:
+            self.stdout.write(self.style.ERROR(f"{descuadres} cuenta(s) descuadrada(s). Ejecuta sin --solo-comprobar para corregir."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{descuadres} cuenta(s) corregida(s)."))
@@ -0,0 +1,52 @@
+# taller/management/commands/verificar_iva.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from taller.models import Factura, FacturaProveedor, IvaTrimestral, calcular_iva_trimestre, sincronizar_deuda_hacienda, trimestre_de
+
+
+class Command(BaseCommand):
+    help = "Compara el acumulado de IVA por trimestre (IvaTrimestral) con el cálculo completo sobre Factura/FacturaProveedor."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corregir', action='store_true', help="Reescribe los trimestres descuadrados y su deuda con Hacienda.")
+
+    def handle(self, *args, **options):
+        corregir = options['corregir']
+
+        trimestres = set(IvaTrimestral.objects.values_list('ano', 'trimestre'))
+        trimestres |= {trimestre_de(f) for f in Factura.objects.filter(es_factura=True).dates('fecha_emision', 'month')}
+        trimestres |= {trimestre_de(f) for f in FacturaProveedor.objects.dates('fecha_factura', 'month')}
+
+        acumulados = {(a.ano, a.trimestre): a for a in IvaTrimestral.objects.all()}
+        descuadres = 0
+
+        for ano, trimestre in sorted(trimestres):
+            iva_clientes, iva_proveedores = calcular_iva_trimestre(ano, trimestre)
+            acumulado = acumulados.get((ano, trimestre))
+            acu_clientes = acumulado.iva_clientes if acumulado else None
+            acu_proveedores = acumulado.iva_proveedores if acumulado else None
+
+            if acu_clientes == iva_clientes and acu_proveedores == iva_proveedores:
+                self.stdout.write(f"✅ T{trimestre} {ano}: neto {iva_clientes - iva_proveedores}€")
+                continue
+
+            descuadres += 1
+            self.stdout.write(self.style.WARNING(
+                f"❌ T{trimestre} {ano}: acumulado clientes {acu_clientes} / proveedores {acu_proveedores} "
+                f"-> real clientes {iva_clientes} / proveedores {iva_proveedores}"
+            ))
+            if corregir:
+                with transaction.atomic():
+                    IvaTrimestral.objects.update_or_create(
+                        ano=ano, trimestre=trimestre,
+                        defaults={'iva_clientes': iva_clientes, 'iva_proveedores': iva_proveedores}
+                    )
+                    sincronizar_deuda_hacienda(ano, trimestre)
+
+        if not descuadres:
+            self.stdout.write(self.style.SUCCESS("IVA cuadrado. Sin descuadres."))
+        elif corregir:
+            self.stdout.write(self.style.SUCCESS(f"{descuadres} trimestre(s) corregido(s)."))
+        else:
+            self.stdout.write(self.style.ERROR(f"{descuadres} trimestre(s) descuadrado(s). Ejecuta con --corregir para arreglarlo."))
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:02
+
+import datetime
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def cargar_saldos_iniciales(apps, schema_editor):
+    SaldoCuenta = apps.get_model('taller', 'SaldoCuenta')
+    Gasto = apps.get_model('taller', 'Gasto')
+    Ingreso = apps.get_model('taller', 'Ingreso')
+    for cuenta in ['EFECTIVO', 'CUENTA_TALLER', 'TARJETA_1', 'TARJETA_2']:
+        SaldoCuenta.objects.create(
+            cuenta=cuenta,
+            total_ingresos=Ingreso.objects.filter(metodo_pago=cuenta).aggregate(total=Sum('importe'))['total'] or Decimal('0.00'),
+            total_gastos=Gasto.objects.filter(metodo_pago=cuenta).aggregate(total=Sum('importe'))['total'] or Decimal('0.00'),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0071_asistencia_sueldo_ganado_historialsueldo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SaldoCuenta',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cuenta', models.CharField(choices=[('EFECTIVO', 'Efectivo (Caja)'), ('CUENTA_TALLER', 'Cuenta Taller (Banco)'), ('TARJETA_1', 'Tarjeta 1 (Visa 2000€)'), ('TARJETA_2', 'Tarjeta 2 (Visa 1000€)')], max_length=20, unique=True)),
+                ('total_ingresos', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('total_gastos', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('fecha_actualizacion', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Saldo de Cuenta',
+                'verbose_name_plural': 'Saldos de Cuentas',
+                'ordering': ['cuenta'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='factura',
+            name='fecha_emision',
+            field=models.DateField(default=datetime.date.today),
+        ),
+        migrations.AlterField(
+            model_name='factura',
+            name='numero_factura',
+            field=models.IntegerField(blank=True, null=True, unique=True),
+        ),
+        migrations.RunPython(cargar_saldos_iniciales, migrations.RunPython.noop),
+    ]
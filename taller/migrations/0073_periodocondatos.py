@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:05
+
+from django.db import migrations, models
+
+
+def cargar_periodos(apps, schema_editor):
+    PeriodoConDatos = apps.get_model('taller', 'PeriodoConDatos')
+    origenes = [
+        ('GASTO', apps.get_model('taller', 'Gasto').objects.dates('fecha', 'month')),
+        ('INGRESO', apps.get_model('taller', 'Ingreso').objects.dates('fecha', 'month')),
+        ('FACTURA', apps.get_model('taller', 'Factura').objects.dates('fecha_emision', 'month')),
+        ('PRESUPUESTO', apps.get_model('taller', 'Presupuesto').objects.datetimes('fecha_creacion', 'month')),
+    ]
+    PeriodoConDatos.objects.bulk_create([
+        PeriodoConDatos(ano=fecha.year, mes=fecha.month, origen=origen)
+        for origen, fechas in origenes for fecha in fechas
+    ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0072_saldocuenta_alter_factura_fecha_emision_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeriodoConDatos',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ano', models.PositiveSmallIntegerField()),
+                ('mes', models.PositiveSmallIntegerField()),
+                ('origen', models.CharField(choices=[('GASTO', 'Gasto'), ('INGRESO', 'Ingreso'), ('FACTURA', 'Factura'), ('PRESUPUESTO', 'Presupuesto')], max_length=20)),
+            ],
+            options={
+                'verbose_name': 'Periodo con Datos',
+                'verbose_name_plural': 'Periodos con Datos',
+                'ordering': ['-ano', 'mes'],
+                'unique_together': {('ano', 'mes', 'origen')},
+            },
+        ),
+        migrations.RunPython(cargar_periodos, migrations.RunPython.noop),
+    ]
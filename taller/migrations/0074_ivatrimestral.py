@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:07
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def cargar_iva_trimestral(apps, schema_editor):
+    IvaTrimestral = apps.get_model('taller', 'IvaTrimestral')
+    Factura = apps.get_model('taller', 'Factura')
+    FacturaProveedor = apps.get_model('taller', 'FacturaProveedor')
+
+    acumulado = {}
+    for fecha, iva in Factura.objects.filter(es_factura=True).values_list('fecha_emision', 'iva'):
+        clave = (fecha.year, (fecha.month - 1) // 3 + 1)
+        acumulado.setdefault(clave, [Decimal('0.00'), Decimal('0.00')])[0] += iva or Decimal('0.00')
+    for fecha, iva in FacturaProveedor.objects.values_list('fecha_factura', 'iva'):
+        clave = (fecha.year, (fecha.month - 1) // 3 + 1)
+        acumulado.setdefault(clave, [Decimal('0.00'), Decimal('0.00')])[1] += iva or Decimal('0.00')
+
+    IvaTrimestral.objects.bulk_create([
+        IvaTrimestral(ano=ano, trimestre=trimestre, iva_clientes=clientes, iva_proveedores=proveedores)
+        for (ano, trimestre), (clientes, proveedores) in acumulado.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0073_periodocondatos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IvaTrimestral',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ano', models.PositiveSmallIntegerField()),
+                ('trimestre', models.PositiveSmallIntegerField()),
+                ('iva_clientes', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('iva_proveedores', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+            ],
+            options={
+                'verbose_name': 'IVA Trimestral',
+                'verbose_name_plural': 'IVA Trimestral',
+                'ordering': ['-ano', '-trimestre'],
+                'unique_together': {('ano', 'trimestre')},
+            },
+        ),
+        migrations.RunPython(cargar_iva_trimestral, migrations.RunPython.noop),
+    ]
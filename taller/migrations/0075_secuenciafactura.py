@@ -0,0 +1,35 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:09
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def cargar_secuencia(apps, schema_editor):
+    # La numeración continua actual sigue desde el último número emitido
+    SecuenciaFactura = apps.get_model('taller', 'SecuenciaFactura')
+    Factura = apps.get_model('taller', 'Factura')
+    ultimo = Factura.objects.aggregate(ultimo=Max('numero_factura'))['ultimo'] or 0
+    SecuenciaFactura.objects.create(serie='FACTURA', ultimo_numero=ultimo)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0074_ivatrimestral'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SecuenciaFactura',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serie', models.CharField(default='FACTURA', max_length=20, unique=True)),
+                ('ultimo_numero', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Secuencia de Facturas',
+                'verbose_name_plural': 'Secuencias de Facturas',
+            },
+        ),
+        migrations.RunPython(cargar_secuencia, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:12
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def enlazar_comisiones(apps, schema_editor):
+    # Las comisiones antiguas solo llevaban la orden en el texto: "🟢 COMISIÓN 60% (Orden #12): DESCRIPCIÓN[:20] (-X€ de Material)"
+    AdelantoSueldo = apps.get_model('taller', 'AdelantoSueldo')
+    OrdenDeReparacion = apps.get_model('taller', 'OrdenDeReparacion')
+    LineaFactura = apps.get_model('taller', 'LineaFactura')
+
+    patron = re.compile(r'\(Orden #(\d+)\)(?::\s*(.*?))?(?:\s\(-[\d.,]+€ de Material\))?$', re.IGNORECASE)
+    ordenes_existentes = set(OrdenDeReparacion.objects.values_list('id', flat=True))
+    lineas_usadas = set()
+
+    for adelanto in AdelantoSueldo.objects.filter(motivo__icontains='(Orden #').order_by('id'):
+        match = patron.search(adelanto.motivo)
+        if not match or int(match.group(1)) not in ordenes_existentes: continue
+        adelanto.orden_id = int(match.group(1))
+
+        descripcion = (match.group(2) or '').strip().upper()
+        if descripcion:
+            for linea in LineaFactura.objects.filter(factura__orden_id=adelanto.orden_id, tipo='Mano de Obra').order_by('id'):
+                if linea.id not in lineas_usadas and linea.descripcion.upper().startswith(descripcion):
+                    adelanto.linea_factura_id = linea.id
+                    lineas_usadas.add(linea.id)
+                    break
+        adelanto.save(update_fields=['orden', 'linea_factura'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0075_secuenciafactura'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adelantosueldo',
+            name='linea_factura',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='comisiones', to='taller.lineafactura'),
+        ),
+        migrations.AddField(
+            model_name='adelantosueldo',
+            name='orden',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='comisiones', to='taller.ordendereparacion'),
+        ),
+        migrations.RunPython(enlazar_comisiones, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def enlazar_origen_lineas(apps, schema_editor):
+    # Mismo emparejamiento que se hacía por texto: repuesto/externo -> primer Gasto libre de la orden con
+    # esa descripción; consumible -> TipoConsumible con ese nombre
+    LineaFactura = apps.get_model('taller', 'LineaFactura')
+    Gasto = apps.get_model('taller', 'Gasto')
+    TipoConsumible = apps.get_model('taller', 'TipoConsumible')
+
+    tipos_por_nombre = {}
+    for tipo in TipoConsumible.objects.order_by('id'):
+        tipos_por_nombre[tipo.nombre.upper()] = tipo.id
+
+    gastos_por_orden = {}
+    for gasto in Gasto.objects.filter(orden__isnull=False, categoria__in=['Repuestos', 'Otros']).order_by('id'):
+        gastos_por_orden.setdefault(gasto.orden_id, []).append(gasto)
+    gastos_usados = set()
+
+    lineas = LineaFactura.objects.filter(tipo__in=['Repuesto', 'Externo', 'Consumible']).select_related('factura').order_by('factura_id', 'id')
+    for linea in lineas:
+        descripcion = linea.descripcion.strip().upper()
+        if linea.tipo == 'Consumible':
+            linea.tipo_consumible_id = tipos_por_nombre.get(descripcion)
+            if linea.tipo_consumible_id:
+                linea.save(update_fields=['tipo_consumible'])
+            continue
+
+        categoria = 'Repuestos' if linea.tipo == 'Repuesto' else 'Otros'
+        for gasto in gastos_por_orden.get(linea.factura.orden_id, []):
+            if gasto.id not in gastos_usados and gasto.categoria == categoria and (gasto.descripcion or '').strip().upper() == descripcion:
+                linea.gasto_origen_id = gasto.id
+                gastos_usados.add(gasto.id)
+                linea.save(update_fields=['gasto_origen'])
+                break
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0076_adelantosueldo_linea_factura_adelantosueldo_orden'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lineafactura',
+            name='gasto_origen',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='lineas_factura', to='taller.gasto'),
+        ),
+        migrations.AddField(
+            model_name='lineafactura',
+            name='tipo_consumible',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='lineas_factura', to='taller.tipoconsumible'),
+        ),
+        migrations.RunPython(enlazar_origen_lineas, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,97 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:17
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+# Copia congelada de taller.models (_coste_fifo / reconstruir_costes_consumo) tal y como estaban al crear
+# esta migración: si el modelo cambia más adelante, la migración debe seguir valorando igual
+def _coste_fifo(compras, consumido_previo, cantidad):
+    # compras: lista de (cantidad, coste_por_unidad) en orden de entrada. Se saltan las unidades ya consumidas
+    # y se valora 'cantidad' con las capas que quedan. Si no llega el stock, lo que falta va al último precio.
+    saltar, pendiente, coste, ultimo_precio = max(consumido_previo, Decimal('0.00')), cantidad, Decimal('0.00'), Decimal('0.0000')
+    for cantidad_capa, coste_capa in compras:
+        ultimo_precio = coste_capa
+        disponible = cantidad_capa
+        if saltar > 0:
+            salto = min(disponible, saltar); disponible -= salto; saltar -= salto
+        if disponible <= 0 or pendiente <= 0: continue
+        tomado = min(disponible, pendiente)
+        coste += tomado * coste_capa; pendiente -= tomado
+    coste += pendiente * ultimo_precio
+    return (coste / cantidad).quantize(Decimal('0.0001')) if cantidad > 0 else ultimo_precio
+
+
+def reconstruir_costes_consumo(metodo, compras, usos, ajustes):
+    """
+    Recorre el historial de un consumible en orden cronológico y devuelve {uso_id: coste_unitario}.
+    compras: (fecha, id, cantidad, coste_total) · usos: (fecha, id, cantidad) · ajustes: (fecha, id, cantidad)
+    """
+    # A igualdad de fecha: primero entra el material, luego los ajustes y por último los usos
+    eventos = [(f, 0, i, ('C', c, t)) for f, i, c, t in compras] + [(f, 1, i, ('A', c, None)) for f, i, c in ajustes] + [(f, 2, i, ('U', c, None)) for f, i, c in usos]
+    eventos.sort(key=lambda e: e[:3])
+
+    costes, capas, consumido, stock, precio_medio = {}, [], Decimal('0.00'), Decimal('0.00'), Decimal('0.0000')
+    for _, _, id_evento, (clase, cantidad, coste_total) in eventos:
+        cantidad = cantidad or Decimal('0.00')
+        if clase == 'C':
+            coste_unidad = (coste_total / cantidad) if cantidad > 0 and coste_total is not None else Decimal('0.0000')
+            capas.append((cantidad, coste_unidad))
+            # Misma fórmula que CompraConsumible.save
+            precio_medio = coste_unidad if stock <= 0 else (stock * precio_medio + (coste_total or 0)) / (stock + cantidad)
+            stock += cantidad
+        elif clase == 'A':
+            consumido -= cantidad; stock += cantidad
+        else:
+            costes[id_evento] = _coste_fifo(capas, consumido, cantidad) if metodo == 'FIFO' else Decimal(precio_medio).quantize(Decimal('0.0001'))
+            consumido += cantidad; stock -= cantidad
+    return costes
+
+
+def congelar_costes_usos(apps, schema_editor):
+    # Los usos antiguos se valoran repasando el historial de cada consumible con precio medio ponderado
+    TipoConsumible = apps.get_model('taller', 'TipoConsumible')
+    CompraConsumible = apps.get_model('taller', 'CompraConsumible')
+    UsoConsumible = apps.get_model('taller', 'UsoConsumible')
+    AjusteStockConsumible = apps.get_model('taller', 'AjusteStockConsumible')
+
+    for tipo in TipoConsumible.objects.all():
+        usos = list(UsoConsumible.objects.filter(tipo=tipo))
+        if not usos: continue
+        costes = reconstruir_costes_consumo(
+            tipo.metodo_coste,
+            CompraConsumible.objects.filter(tipo=tipo).values_list('fecha_compra', 'id', 'cantidad', 'coste_total'),
+            [(u.fecha_uso, u.id, u.cantidad_usada) for u in usos],
+            AjusteStockConsumible.objects.filter(tipo=tipo).values_list('fecha_ajuste', 'id', 'cantidad_ajustada'),
+        )
+        for uso in usos:
+            uso.coste_unitario = costes[uso.id]
+            uso.coste_total = (uso.coste_unitario * uso.cantidad_usada).quantize(Decimal('0.0001'))
+        UsoConsumible.objects.bulk_update(usos, ['coste_unitario', 'coste_total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0077_lineafactura_gasto_origen_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tipoconsumible',
+            name='metodo_coste',
+            field=models.CharField(choices=[('MEDIO', 'Precio medio ponderado'), ('FIFO', 'FIFO (primero en entrar, primero en salir)')], default='MEDIO', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='usoconsumible',
+            name='coste_total',
+            field=models.DecimalField(blank=True, decimal_places=4, editable=False, max_digits=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='usoconsumible',
+            name='coste_unitario',
+            field=models.DecimalField(blank=True, decimal_places=4, editable=False, max_digits=10, null=True),
+        ),
+        migrations.RunPython(congelar_costes_usos, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:19
+
+import django.db.models.deletion
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def cargar_movimientos(apps, schema_editor):
+    # Misma regla que MovimientoStock.apuntar: dentro de un día manda el orden de llegada (el id del apunte).
+    # Los originales no guardan la hora: el histórico se inserta por fecha (y tabla e id para desempatar) y el
+    # saldo se acumula en ese mismo orden de inserción, así que (fecha, id) vuelve a ser el orden del libro.
+    TipoConsumible = apps.get_model('taller', 'TipoConsumible')
+    CompraConsumible = apps.get_model('taller', 'CompraConsumible')
+    UsoConsumible = apps.get_model('taller', 'UsoConsumible')
+    AjusteStockConsumible = apps.get_model('taller', 'AjusteStockConsumible')
+    MovimientoStock = apps.get_model('taller', 'MovimientoStock')
+
+    for tipo in TipoConsumible.objects.all():
+        eventos = [(c.fecha_compra, 0, c.id, 'COMPRA', c.cantidad, {'compra': c}) for c in CompraConsumible.objects.filter(tipo=tipo)]
+        eventos += [(a.fecha_ajuste, 1, a.id, 'AJUSTE', a.cantidad_ajustada, {'ajuste': a}) for a in AjusteStockConsumible.objects.filter(tipo=tipo)]
+        eventos += [(u.fecha_uso, 2, u.id, 'USO', -u.cantidad_usada, {'uso': u}) for u in UsoConsumible.objects.filter(tipo=tipo)]
+        eventos.sort(key=lambda e: e[:3])
+
+        saldo, movimientos = Decimal('0.00'), []
+        for fecha, _, _, tipo_movimiento, cantidad, origen in eventos:
+            saldo += cantidad or Decimal('0.00')
+            movimientos.append(MovimientoStock(tipo=tipo, fecha=fecha, tipo_movimiento=tipo_movimiento, cantidad=cantidad or Decimal('0.00'), saldo=saldo, **origen))
+        MovimientoStock.objects.bulk_create(movimientos)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0078_tipoconsumible_metodo_coste_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MovimientoStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fecha', models.DateField()),
+                ('tipo_movimiento', models.CharField(choices=[('COMPRA', 'Compra'), ('USO', 'Uso en taller'), ('AJUSTE', 'Ajuste manual')], max_length=10)),
+                ('cantidad', models.DecimalField(decimal_places=2, help_text='Con signo: positivo entra, negativo sale', max_digits=10)),
+                ('saldo', models.DecimalField(decimal_places=2, help_text='Stock después de este movimiento', max_digits=12)),
+                ('ajuste', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='movimiento', to='taller.ajustestockconsumible')),
+                ('compra', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='movimiento', to='taller.compraconsumible')),
+                ('tipo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movimientos', to='taller.tipoconsumible')),
+                ('uso', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='movimiento', to='taller.usoconsumible')),
+            ],
+            options={
+                'ordering': ['fecha', 'id'],
+                'indexes': [models.Index(fields=['tipo', 'fecha'], name='movstock_tipo_fecha_idx')],
+            },
+        ),
+        migrations.RunPython(cargar_movimientos, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:22
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def marcar_agotados(apps, schema_editor):
+    StockMaterialChapa = apps.get_model('taller', 'StockMaterialChapa')
+    agotados = [
+        lote.id for lote in StockMaterialChapa.objects.annotate(usado=Sum('usos__importe_usado'))
+        if lote.importe_total - (lote.usado or Decimal('0.00')) <= 0
+    ]
+    StockMaterialChapa.objects.filter(id__in=agotados).update(agotado=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0079_movimientostock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stockmaterialchapa',
+            name='agotado',
+            field=models.BooleanField(db_index=True, default=False, editable=False),
+        ),
+        migrations.RunPython(marcar_agotados, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:26
+
+import datetime
+import json
+import os
+
+from django.db import migrations, models
+
+
+def cargar_festivos(apps, schema_editor):
+    CalendarioLaboral = apps.get_model('taller', 'CalendarioLaboral')
+    ruta = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'festivos.json')
+    with open(ruta, encoding='utf-8') as fichero:
+        festivos = json.load(fichero)
+    CalendarioLaboral.objects.bulk_create([
+        CalendarioLaboral(fecha=datetime.date.fromisoformat(f['fecha']), ambito=f.get('ambito', 'NACIONAL'), descripcion=f['descripcion'])
+        for f in festivos
+    ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0080_stockmaterialchapa_agotado'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarioLaboral',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fecha', models.DateField(unique=True)),
+                ('ambito', models.CharField(choices=[('NACIONAL', 'Festivo nacional'), ('CATALUNA', 'Festivo de Cataluña'), ('LOCAL', 'Festivo local'), ('CIERRE', 'Cierre del taller')], default='NACIONAL', max_length=10)),
+                ('descripcion', models.CharField(max_length=100)),
+            ],
+            options={
+                'verbose_name': 'Día No Laborable',
+                'verbose_name_plural': 'Calendario Laboral',
+                'ordering': ['fecha'],
+            },
+        ),
+        migrations.RunPython(cargar_festivos, migrations.RunPython.noop),
+    ]
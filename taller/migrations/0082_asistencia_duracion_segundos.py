@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:30
+
+import datetime
+
+from django.db import migrations, models
+
+
+# Copia congelada de taller.models.duracion_turno al crear esta migración (no debe cambiar con el modelo)
+def duracion_turno(fecha, hora_entrada, hora_salida):
+    """Segundos trabajados en un fichaje (entrada y salida del mismo día, o turno de noche que acaba al día siguiente)."""
+    t1 = datetime.datetime.combine(fecha, hora_entrada)
+    t2 = datetime.datetime.combine(fecha, hora_salida)
+    # ESCUDO ANTIBALAS: Control de clics rápidos vs turnos de noche
+    if t2 < t1:
+        if (t1 - t2).total_seconds() < 300: # Menos de 5 min de diferencia (clic de prueba)
+            t2 = t1
+        else:
+            t2 += datetime.timedelta(days=1) # Turno de noche real (salió al día siguiente)
+    return int((t2 - t1).total_seconds())
+
+
+def calcular_duraciones(apps, schema_editor):
+    Asistencia = apps.get_model('taller', 'Asistencia')
+    asistencias = list(Asistencia.objects.filter(hora_salida__isnull=False))
+    for asistencia in asistencias:
+        asistencia.duracion_segundos = duracion_turno(asistencia.fecha, asistencia.hora_entrada, asistencia.hora_salida)
+    Asistencia.objects.bulk_update(asistencias, ['duracion_segundos'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0081_calendariolaboral'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asistencia',
+            name='duracion_segundos',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(calcular_duraciones, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0082_asistencia_duracion_segundos'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='historialestadoorden',
+            index=models.Index(fields=['orden', 'fecha_fin'], name='historial_orden_fin_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+# Copia congelada de taller.models.sumar_tramos_fase al crear esta migración (no debe cambiar con el modelo)
+def sumar_tramos_fase(tramos):
+    """
+    Agrupa tramos cerrados del historial (orden_id, estado, fecha_inicio, fecha_fin, es_pausa_jornada) por
+    orden, estado y mes de cierre: {(orden_id, estado, mes): [segundos, tramos]}. Las pausas de jornada
+    (taller cerrado por la noche) NO cuentan: solo se mide el tiempo de trabajo.
+    """
+    totales = {}
+    for orden_id, estado, fecha_inicio, fecha_fin, es_pausa in tramos:
+        if es_pausa or not fecha_inicio or not fecha_fin: continue
+        mes = timezone.localtime(fecha_fin).date().replace(day=1)
+        total = totales.setdefault((orden_id, estado, mes), [0, 0])
+        total[0] += max(0, int((fecha_fin - fecha_inicio).total_seconds()))
+        total[1] += 1
+    return totales
+
+
+def acumular_historial(apps, schema_editor):
+    HistorialEstadoOrden = apps.get_model('taller', 'HistorialEstadoOrden')
+    DuracionFaseOrden = apps.get_model('taller', 'DuracionFaseOrden')
+    totales = sumar_tramos_fase(
+        HistorialEstadoOrden.objects.filter(fecha_fin__isnull=False)
+        .values_list('orden_id', 'estado', 'fecha_inicio', 'fecha_fin', 'es_pausa_jornada').iterator()
+    )
+    DuracionFaseOrden.objects.bulk_create([
+        DuracionFaseOrden(orden_id=orden_id, estado=estado, mes=mes, segundos=segundos, tramos=tramos)
+        for (orden_id, estado, mes), (segundos, tramos) in totales.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0083_historial_orden_fin_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuracionFaseOrden',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('estado', models.CharField(max_length=50)),
+                ('mes', models.DateField(help_text='Mes (día 1) en el que se cerraron los tramos')),
+                ('segundos', models.PositiveBigIntegerField(default=0)),
+                ('tramos', models.PositiveIntegerField(default=0)),
+                ('orden', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='duraciones_fase', to='taller.ordendereparacion')),
+            ],
+            options={
+                'ordering': ['orden', 'mes', 'estado'],
+                'indexes': [models.Index(fields=['mes', 'estado'], name='duracion_fase_mes_idx')],
+                'constraints': [models.UniqueConstraint(fields=('orden', 'estado', 'mes'), name='duracion_fase_unica')],
+            },
+        ),
+        migrations.RunPython(acumular_historial, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-17 22:37
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def fechar_ultima_actividad(apps, schema_editor):
+    # Sin historial de guardados, usamos el último cambio de estado (o la entrada) como última actualización
+    OrdenDeReparacion = apps.get_model('taller', 'OrdenDeReparacion')
+    ordenes = list(OrdenDeReparacion.objects.annotate(ultimo_estado=Max('historial_estados__fecha_inicio')))
+    for orden in ordenes:
+        orden.actualizado = max(filter(None, [orden.ultimo_estado, orden.fecha_entrada]))
+    OrdenDeReparacion.objects.bulk_update(ordenes, ['actualizado'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taller', '0084_duracionfaseorden'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ordendereparacion',
+            name='actualizado',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.RunPython(fechar_ultima_actividad, migrations.RunPython.noop),
+    ]
@@ -2,11 +2,18 @@
 from django.db import models
 from django.utils import timezone
 from decimal import Decimal
-from django.db.models import Sum
+from django.db.models import Sum, F, Q, OuterRef, Subquery, Value, DecimalField, Max, Min, Count
+from django.db.models.functions import Coalesce, ExtractIsoYear, ExtractWeek, TruncMonth
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, pre_save, post_delete
 from django.dispatch import receiver
+from django.db import transaction
+from django.core.cache import cache
 import math
+import bisect
+from itertools import groupby
+import os
+import json
 import calendar  # 🟢 NUEVO: Necesario para calcular días laborables
 import datetime
 
@@ -88,7 +95,29 @@ class Presupuesto(models.Model):
 # --- MODULO DE ÓRDENES Y SEGUIMIENTO DE TIEMPOS ---
 # =========================================================
 
+def _abonado_por_orden(referencia):
+    # Subconsulta correlacionada: SUM(importe) de los Ingresos de la orden 'referencia' (0 si no hay)
+    subconsulta = Ingreso.objects.filter(orden=OuterRef(referencia)).order_by().values('orden').annotate(total=Sum('importe')).values('total')[:1]
+    return Coalesce(Subquery(subconsulta, output_field=DecimalField(max_digits=12, decimal_places=2)), Value(Decimal('0.00')), output_field=DecimalField(max_digits=12, decimal_places=2))
+
+class OrdenDeReparacionQuerySet(models.QuerySet):
+    def with_saldo(self):
+        # abonado = cobrado de la orden; pendiente = total de la factura - abonado (None si no tiene factura)
+        return self.annotate(
+            abonado=_abonado_por_orden('pk'),
+        ).annotate(
+            pendiente=F('factura__total_final') - F('abonado'),
+        )
+
+    def relevantes_para_cobro(self):
+        # Órdenes abiertas + entregadas sin factura o con más de 1 céntimo pendiente
+        return self.with_saldo().filter(
+            ~Q(estado='Entregado') | Q(factura__isnull=True) | Q(pendiente__gt=Decimal('0.01'))
+        )
+
 class OrdenDeReparacion(models.Model):
+    objects = OrdenDeReparacionQuerySet.as_manager()
+
     ESTADO_CHOICES = [
         ('Recibido', 'Recibido'),
         ('En Diagnostico', 'En Diagnóstico'),
@@ -111,6 +140,8 @@ class OrdenDeReparacion(models.Model):
     estado = models.CharField(max_length=50, choices=ESTADO_CHOICES, default='Recibido')
     fecha_entrada = models.DateTimeField(default=timezone.now)
     trabajo_interno = models.BooleanField(default=False, verbose_name="Vehículo del Taller")
+    # 🟢 NUEVO: Última vez que se guardó la orden (marca de agua para refrescar el tablero del taller)
+    actualizado = models.DateTimeField(auto_now=True, db_index=True)
 
     @property
     def dias_en_taller(self):
@@ -121,31 +152,50 @@ class OrdenDeReparacion(models.Model):
     def __str__(self):
         return f"Orden #{self.id} - {self.vehiculo.matricula}"
 
+    # 🟢 Recordamos el estado tal y como vino de la BD: save() ya no tiene que volver a leer la orden
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instancia = super().from_db(db, field_names, values)
+        instancia._estado_cargado = dict(zip(field_names, values)).get('estado', models.DEFERRED)
+        return instancia
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super(OrdenDeReparacion, self).refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None or 'estado' in fields:
+            self._estado_cargado = self.estado
+
     def save(self, *args, **kwargs):
         is_new = self.pk is None
-        estado_cambiado = False
+        estado_cargado = getattr(self, '_estado_cargado', models.DEFERRED)
+        update_fields = kwargs.get('update_fields')
         
-        if not is_new:
-            vieja_orden = OrdenDeReparacion.objects.get(pk=self.pk)
-            if vieja_orden.estado != self.estado:
-                estado_cambiado = True
-        else:
+        if is_new:
             estado_cambiado = True
+        elif update_fields is not None and 'estado' not in update_fields:
+            estado_cambiado = False
+        elif estado_cargado is models.DEFERRED:
+            # Orden construida a mano o cargada sin el campo estado: solo entonces lo consultamos
+            estado_cargado = OrdenDeReparacion.objects.filter(pk=self.pk).values_list('estado', flat=True).first()
+            estado_cambiado = estado_cargado != self.estado
+        else:
+            estado_cambiado = estado_cargado != self.estado
             
         super(OrdenDeReparacion, self).save(*args, **kwargs)
+        if 'estado' not in self.get_deferred_fields():
+            self._estado_cargado = self.estado
         
         if estado_cambiado:
-            ultimo_estado = self.historial_estados.filter(fecha_fin__isnull=True).first()
-            if ultimo_estado:
-                ultimo_estado.fecha_fin = timezone.now()
-                ultimo_estado.save()
+            ahora = timezone.now()
+            # Cerramos el tramo abierto con un solo UPDATE (una orden nueva no tiene historial que cerrar)
+            if not is_new:
+                cerrar_tramos_historial(self.historial_estados.all(), ahora)
             
             usuario_actual = getattr(self, '_usuario_actual', None)
             
             HistorialEstadoOrden.objects.create(
                 orden=self, 
                 estado=self.estado, 
-                fecha_inicio=timezone.now(),
+                fecha_inicio=ahora,
                 usuario=usuario_actual
             )
 
@@ -180,7 +230,56 @@ class HistorialEstadoOrden(models.Model):
 
     class Meta:
         ordering = ['-fecha_inicio']
+        # "¿Qué estado tiene abierto esta orden?" (fecha_fin NULL) sin recorrer todo su historial
+        indexes = [models.Index(fields=['orden', 'fecha_fin'], name='historial_orden_fin_idx')]
+
+def sumar_tramos_fase(tramos):
+    """
+    Agrupa tramos cerrados del historial (orden_id, estado, fecha_inicio, fecha_fin, es_pausa_jornada) por
+    orden, estado y mes de cierre: {(orden_id, estado, mes): [segundos, tramos]}. Las pausas de jornada
+    (taller cerrado por la noche) NO cuentan: solo se mide el tiempo de trabajo.
+    """
+    totales = {}
+    for orden_id, estado, fecha_inicio, fecha_fin, es_pausa in tramos:
+        if es_pausa or not fecha_inicio or not fecha_fin: continue
+        mes = timezone.localtime(fecha_fin).date().replace(day=1)
+        total = totales.setdefault((orden_id, estado, mes), [0, 0])
+        total[0] += max(0, int((fecha_fin - fecha_inicio).total_seconds()))
+        total[1] += 1
+    return totales
+
+# 🟢 NUEVO: Tiempo acumulado de cada orden en cada fase (se rellena al cerrar cada tramo del historial)
+class DuracionFaseOrden(models.Model):
+    orden = models.ForeignKey(OrdenDeReparacion, related_name='duraciones_fase', on_delete=models.CASCADE)
+    estado = models.CharField(max_length=50)
+    mes = models.DateField(help_text="Mes (día 1) en el que se cerraron los tramos")
+    segundos = models.PositiveBigIntegerField(default=0)
+    tramos = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        ordering = ['orden', 'mes', 'estado']
+        constraints = [models.UniqueConstraint(fields=['orden', 'estado', 'mes'], name='duracion_fase_unica')]
+        indexes = [models.Index(fields=['mes', 'estado'], name='duracion_fase_mes_idx')]
+
+    def __str__(self):
+        return f"Orden #{self.orden_id} - {self.estado} ({self.mes.strftime('%m/%Y')}): {self.segundos // 3600}h"
+
+    @classmethod
+    def acumular(cls, tramos):
+        """Suma los tramos dados a sus filas: get_or_create y, si ya existía, un UPDATE con F() (sin pisar otros procesos)."""
+        for (orden_id, estado, mes), (segundos, n) in sumar_tramos_fase(tramos).items():
+            fila, creada = cls.objects.get_or_create(orden_id=orden_id, estado=estado, mes=mes, defaults={'segundos': segundos, 'tramos': n})
+            if not creada: cls.objects.filter(pk=fila.pk).update(segundos=F('segundos') + segundos, tramos=F('tramos') + n)
+
+def cerrar_tramos_historial(historial, fecha_fin):
+    """Cierra con un solo UPDATE los tramos abiertos del historial dado y acumula su duración. Devuelve cuántos cierra."""
+    with transaction.atomic(savepoint=False):
+        abiertos = historial.filter(fecha_fin__isnull=True).select_for_update()
+        tramos = list(abiertos.values_list('orden_id', 'estado', 'fecha_inicio', 'es_pausa_jornada'))
+        if not tramos: return 0
+        abiertos.update(fecha_fin=fecha_fin)
+        DuracionFaseOrden.acumular([(orden_id, estado, inicio, fecha_fin, pausa) for orden_id, estado, inicio, pausa in tramos])
+    return len(tramos)
 
 # =========================================================
 # --- MODULO DE NÓMINAS Y RECURSOS HUMANOS ---
@@ -227,6 +326,38 @@ class HistorialSueldo(models.Model):
         return f"{self.empleado.nombre} - Desde {self.fecha_inicio.strftime('%d/%m/%Y')}"
 
 
+def duracion_turno(fecha, hora_entrada, hora_salida):
+    """Segundos trabajados en un fichaje (entrada y salida del mismo día, o turno de noche que acaba al día siguiente)."""
+    t1 = datetime.datetime.combine(fecha, hora_entrada)
+    t2 = datetime.datetime.combine(fecha, hora_salida)
+    # ESCUDO ANTIBALAS: Control de clics rápidos vs turnos de noche
+    if t2 < t1:
+        if (t1 - t2).total_seconds() < 300: # Menos de 5 min de diferencia (clic de prueba)
+            t2 = t1
+        else:
+            t2 += datetime.timedelta(days=1) # Turno de noche real (salió al día siguiente)
+    return int((t2 - t1).total_seconds())
+
+class AsistenciaQuerySet(models.QuerySet):
+    # Totales de horas sumados en SQL sobre la duración guardada al fichar la salida
+    def horas_por_dia(self):
+        return self.filter(hora_salida__isnull=False).values('empleado', 'fecha').annotate(
+            segundos=Coalesce(Sum('duracion_segundos'), 0),
+            sin_pagar=Count('id', filter=Q(pagado=False)),
+        ).order_by('empleado', 'fecha')
+
+    def horas_por_semana(self):
+        return self.filter(hora_salida__isnull=False).annotate(
+            ano_iso=ExtractIsoYear('fecha'), semana=ExtractWeek('fecha')
+        ).values('empleado', 'ano_iso', 'semana').annotate(
+            segundos=Coalesce(Sum('duracion_segundos'), 0), inicio=Min('fecha'), fin=Max('fecha'),
+        ).order_by('empleado', 'ano_iso', 'semana')
+
+    def horas_por_mes(self):
+        return self.filter(hora_salida__isnull=False).annotate(mes=TruncMonth('fecha')).values('empleado', 'mes').annotate(
+            segundos=Coalesce(Sum('duracion_segundos'), 0), dias=Count('fecha', distinct=True),
+        ).order_by('empleado', 'mes')
+
 class Asistencia(models.Model):
     TIPO_JORNADA_CHOICES = [
         ('Taller', 'Taller / Estructuras (Cobra el día)'),
@@ -243,47 +374,141 @@ class Asistencia(models.Model):
 
     # 🟢 NUEVO: CONGELA EL SUELDO EXACTO DEL DÍA
     sueldo_ganado = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, verbose_name="Sueldo del día")
+
+    # 🟢 NUEVO: Duración del turno, calculada UNA vez al fichar la salida (para sumar horas en SQL)
+    duracion_segundos = models.PositiveIntegerField(null=True, blank=True, editable=False)
+
+    objects = AsistenciaQuerySet.as_manager()
     
-    def calcular_sueldo_del_dia(self):
+    def calcular_sueldo_del_dia(self, tarifas=None):
         """Calcula cuánto vale este día según el historial o el perfil actual."""
-        # 1. Buscamos el registro de historial más cercano (pero anterior o igual) a la fecha de asistencia
-        historial = HistorialSueldo.objects.filter(
-            empleado=self.empleado, 
-            fecha_inicio__lte=self.fecha
-        ).order_by('-fecha_inicio').first()
-
-        # 2. Si hay historial usamos esos datos; si no, usamos los del modelo Empleado como respaldo
-        if historial:
-            s_por_dia = historial.sueldo_por_dia
-            s_fijo_mensual = historial.sueldo_fijo_mensual
-            v_jornada_taller = historial.valor_jornada_taller
-        else:
-            s_por_dia = self.empleado.sueldo_por_dia
-            s_fijo_mensual = self.empleado.sueldo_fijo_mensual
-            v_jornada_taller = self.empleado.valor_jornada_taller
-
-        if self.empleado.es_chapista and self.tipo_jornada == 'Taller':
-            return v_jornada_taller
-        elif self.empleado.es_chapista and self.tipo_jornada == 'Chapa':
-            return Decimal('0.00')
-        elif self.empleado.es_sueldo_fijo:
-            dias_en_mes = calendar.monthrange(self.fecha.year, self.fecha.month)[1]
-            dias_laborables = sum(1 for dia in range(1, dias_en_mes + 1) if calendar.weekday(self.fecha.year, self.fecha.month, dia) < 5)
-            if dias_laborables > 0:
-                return (s_fijo_mensual / Decimal(str(dias_laborables))).quantize(Decimal('0.01'))
-            return Decimal('0.00')
-        else:
-            return s_por_dia
+        # Para muchos fichajes a la vez, pasa un TarifasSueldo ya cargado (ver recalcular_sueldos)
+        tarifas = tarifas or TarifasSueldo([self.empleado])
+        return tarifas.sueldo_del_dia(self)
 
     def save(self, *args, **kwargs):
         # Solo calculamos si el sueldo está a 0 (cuando se crea el fichaje)
         if self.sueldo_ganado == Decimal('0.00'):
             self.sueldo_ganado = self.calcular_sueldo_del_dia()
+        if self.hora_entrada and self.hora_salida:
+            self.duracion_segundos = duracion_turno(self.fecha, self.hora_entrada, self.hora_salida)
+        else:
+            self.duracion_segundos = None
         super(Asistencia, self).save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.empleado.nombre} - {self.fecha} ({self.tipo_jornada})"
 
+# 🟢 NUEVO: Calendario laboral (festivos y cierres del taller)
+class CalendarioLaboral(models.Model):
+    AMBITO_CHOICES = [
+        ('NACIONAL', 'Festivo nacional'),
+        ('CATALUNA', 'Festivo de Cataluña'),
+        ('LOCAL', 'Festivo local'),
+        ('CIERRE', 'Cierre del taller'),
+    ]
+    FICHERO_FESTIVOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'festivos.json')
+
+    fecha = models.DateField(unique=True)
+    ambito = models.CharField(max_length=10, choices=AMBITO_CHOICES, default='NACIONAL')
+    descripcion = models.CharField(max_length=100)
+
+    class Meta:
+        ordering = ['fecha']
+        verbose_name = "Día No Laborable"
+        verbose_name_plural = "Calendario Laboral"
+
+    def __str__(self): return f"{self.fecha.strftime('%d/%m/%Y')} - {self.descripcion}"
+
+    @classmethod
+    def cargar_fichero(cls, ruta=None):
+        """Carga (o actualiza) los festivos del JSON local. Devuelve (creados, actualizados)."""
+        with open(ruta or cls.FICHERO_FESTIVOS, encoding='utf-8') as fichero:
+            festivos = json.load(fichero)
+        creados = actualizados = 0
+        for festivo in festivos:
+            _, creado = cls.objects.update_or_create(
+                fecha=datetime.date.fromisoformat(festivo['fecha']),
+                defaults={'ambito': festivo.get('ambito', 'NACIONAL'), 'descripcion': festivo['descripcion']}
+            )
+            if creado: creados += 1
+            else: actualizados += 1
+        return creados, actualizados
+
+def _dias_laborables_ano(ano):
+    # Los 12 meses del año de golpe con UNA consulta de festivos (sin caché entre peticiones: leer la versión
+    # del calendario costaría lo mismo que leer sus ~15 festivos; TarifasSueldo lo guarda para todo un lote)
+    festivos = set(CalendarioLaboral.objects.filter(fecha__year=ano).values_list('fecha', flat=True))
+    dias_por_mes = {}
+    for mes in range(1, 13):
+        dias_en_mes = calendar.monthrange(ano, mes)[1]
+        dias_por_mes[mes] = sum(
+            1 for dia in range(1, dias_en_mes + 1)
+            if calendar.weekday(ano, mes, dia) < 5 and datetime.date(ano, mes, dia) not in festivos
+        )
+    return dias_por_mes
+
+def dias_laborables_mes(ano, mes):
+    """Días de Lunes a Viernes del mes que no son festivo ni cierre del taller."""
+    return _dias_laborables_ano(ano)[mes]
+
+class TarifasSueldo:
+    """
+    Resuelve el sueldo de un día para muchos fichajes: el historial de sueldos de cada empleado se carga
+    UNA vez, ordenado por fecha, y el tramo vigente se busca con bisect en vez de una consulta por día.
+    """
+    def __init__(self, empleados):
+        self.empleados = {emp.id: emp for emp in empleados}
+        self._fechas, self._tramos, self._calendario = {}, {}, {}
+        for tramo in HistorialSueldo.objects.filter(empleado_id__in=self.empleados).order_by('empleado_id', 'fecha_inicio', 'id'):
+            self._fechas.setdefault(tramo.empleado_id, []).append(tramo.fecha_inicio)
+            self._tramos.setdefault(tramo.empleado_id, []).append(tramo)
+
+    def tramo_vigente(self, empleado_id, fecha):
+        # El registro de historial más cercano (pero anterior o igual) a la fecha; None si no hay
+        posicion = bisect.bisect_right(self._fechas.get(empleado_id, []), fecha) - 1
+        return self._tramos[empleado_id][posicion] if posicion >= 0 else None
+
+    def sueldo_del_dia(self, asistencia):
+        empleado = self.empleados.get(asistencia.empleado_id) or asistencia.empleado
+        # Si hay historial usamos esos datos; si no, usamos los del modelo Empleado como respaldo
+        tarifa = self.tramo_vigente(empleado.id, asistencia.fecha) or empleado
+
+        if empleado.es_chapista and asistencia.tipo_jornada == 'Taller':
+            return tarifa.valor_jornada_taller
+        elif empleado.es_chapista and asistencia.tipo_jornada == 'Chapa':
+            return Decimal('0.00')
+        elif empleado.es_sueldo_fijo:
+            ano = asistencia.fecha.year
+            if ano not in self._calendario: self._calendario[ano] = _dias_laborables_ano(ano)
+            dias_laborables = self._calendario[ano][asistencia.fecha.month]
+            if dias_laborables > 0:
+                return (tarifa.sueldo_fijo_mensual / Decimal(str(dias_laborables))).quantize(Decimal('0.01'))
+            return Decimal('0.00')
+        else:
+            return tarifa.sueldo_por_dia
+
+def tarifar_sueldos(asistencias):
+    """Calcula (SIN guardar) el sueldo de cada fichaje dado. Devuelve una lista de (asistencia, sueldo)."""
+    asistencias = list(asistencias.select_related('empleado'))
+    if not asistencias: return []
+    tarifas = TarifasSueldo({a.empleado_id: a.empleado for a in asistencias}.values())
+    return [(a, Decimal(tarifas.sueldo_del_dia(a)).quantize(Decimal('0.01'))) for a in asistencias]
+
+def sueldos_sin_congelar():
+    """Fichajes cerrados, sin pagar y con el sueldo aún a 0 (los de Chapa valen 0 por definición)."""
+    return Asistencia.objects.filter(pagado=False, hora_salida__isnull=False, sueldo_ganado=0).exclude(tipo_jornada='Chapa')
+
+def recalcular_sueldos(asistencias):
+    """Congela el sueldo de todos los fichajes dados con un solo bulk_update. Devuelve cuántos han cambiado."""
+    cambiadas = []
+    for asistencia, sueldo in tarifar_sueldos(asistencias):
+        if sueldo != asistencia.sueldo_ganado:
+            asistencia.sueldo_ganado = sueldo
+            cambiadas.append(asistencia)
+    Asistencia.objects.bulk_update(cambiadas, ['sueldo_ganado'])
+    return len(cambiadas)
+
 class AdelantoSueldo(models.Model):
     empleado = models.ForeignKey(Empleado, on_delete=models.CASCADE, related_name='adelantos')
     fecha = models.DateField(default=timezone.now)
@@ -291,6 +516,10 @@ class AdelantoSueldo(models.Model):
     motivo = models.CharField(max_length=200, default="Adelanto de nómina")
     liquidado = models.BooleanField(default=False)
 
+    # 🟢 NUEVO: Las comisiones (importe negativo) quedan enlazadas a su orden y a la línea de mano de obra
+    orden = models.ForeignKey('OrdenDeReparacion', on_delete=models.SET_NULL, null=True, blank=True, related_name='comisiones')
+    linea_factura = models.ForeignKey('LineaFactura', on_delete=models.SET_NULL, null=True, blank=True, related_name='comisiones')
+
     def __str__(self):
         return f"{self.empleado.nombre} - {self.importe}€"
 
@@ -413,7 +642,20 @@ class Ingreso(models.Model):
         self.descripcion = self.descripcion.upper()
         super(Ingreso, self).save(*args, **kwargs)
 
+class FacturaQuerySet(models.QuerySet):
+    def with_pendiente(self):
+        return self.annotate(
+            abonado=_abonado_por_orden('orden_id'),
+        ).annotate(
+            pendiente=F('total_final') - F('abonado'),
+        )
+
+    def pendientes_de_cobro(self):
+        return self.with_pendiente().filter(pendiente__gt=Decimal('0.01'))
+
 class Factura(models.Model):
+    objects = FacturaQuerySet.as_manager()
+
     orden = models.OneToOneField(OrdenDeReparacion, on_delete=models.CASCADE)
     
     # Hemos cambiado auto_now_add=True por default=datetime.date.today para que sea editable
@@ -437,6 +679,36 @@ class Factura(models.Model):
         if self.notas_cliente: self.notas_cliente = self.notas_cliente.upper()
         super(Factura, self).save(*args, **kwargs)
 
+class SecuenciaFactura(models.Model):
+    # Contador de numeración por serie (numeración continua, sin reiniciar cada año: numero_factura es único en Factura).
+    # Se reserva dentro de la transacción que crea la factura: si esta falla, el número vuelve y no quedan huecos.
+    serie = models.CharField(max_length=20, default='FACTURA', unique=True)
+    ultimo_numero = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Secuencia de Facturas"
+        verbose_name_plural = "Secuencias de Facturas"
+
+    def __str__(self):
+        return f"{self.serie}: último Nº {self.ultimo_numero}"
+
+    @classmethod
+    def avanzar_hasta(cls, numero, serie='FACTURA'):
+        # Un número puesto a mano (admin) por delante del contador lo adelanta: así la serie nunca lo vuelve a dar
+        if numero: cls.objects.filter(serie=serie, ultimo_numero__lt=numero).update(ultimo_numero=numero)
+
+def siguiente_numero_factura(serie='FACTURA'):
+    """Reserva el siguiente número de la serie con un UPDATE atómico sobre una sola fila (sin recorrer Factura)."""
+    with transaction.atomic():
+        filtro = SecuenciaFactura.objects.filter(serie=serie)
+        # El UPDATE va primero: bloquea la fila (o la BD en SQLite) hasta el commit y los demás esperan su turno
+        if not filtro.update(ultimo_numero=F('ultimo_numero') + 1):
+            # Primera vez: la serie arranca desde el último número ya emitido
+            ultimo = Factura.objects.aggregate(ultimo=models.Max('numero_factura'))['ultimo'] or 0
+            SecuenciaFactura.objects.get_or_create(serie=serie, defaults={'ultimo_numero': ultimo})
+            filtro.update(ultimo_numero=F('ultimo_numero') + 1)
+        return filtro.values_list('ultimo_numero', flat=True).get()
+
 class LineaFactura(models.Model):
     factura = models.ForeignKey(Factura, related_name='lineas', on_delete=models.CASCADE)
     TIPO_CHOICES = [
@@ -453,6 +725,10 @@ class LineaFactura(models.Model):
     
     # ASIGNACIÓN DE COMISIONES EN FACTURACIÓN
     mecanico = models.ForeignKey(Empleado, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Mecánico Asignado (Comisión)")
+
+    # 🟢 NUEVO: De dónde sale el coste de la línea (para no emparejar por el texto de la descripción)
+    gasto_origen = models.ForeignKey(Gasto, on_delete=models.SET_NULL, null=True, blank=True, related_name='lineas_factura')
+    tipo_consumible = models.ForeignKey('TipoConsumible', on_delete=models.SET_NULL, null=True, blank=True, related_name='lineas_factura')
     
     @property
     def total_linea(self): return (self.cantidad or 0) * (self.precio_unitario or 0)
@@ -468,24 +744,98 @@ class LineaFactura(models.Model):
 # --- MODULO DE INVENTARIO Y CONSUMIBLES ---
 # =========================================================
 
+class TipoConsumibleQuerySet(models.QuerySet):
+    def with_stock(self):
+        # Stock de todos los consumibles en UNA sola consulta: el saldo del último apunte del libro de movimientos
+        ultimo_saldo = MovimientoStock.objects.filter(tipo=OuterRef('pk')).order_by('-fecha', '-id').values('saldo')[:1]
+        return self.annotate(
+            stock_calculado=Coalesce(Subquery(ultimo_saldo, output_field=DecimalField(max_digits=12, decimal_places=2)), Value(Decimal('0.00')), output_field=DecimalField(max_digits=12, decimal_places=2))
+        )
+
+    def bajo_minimo(self):
+        return self.with_stock().filter(nivel_minimo_stock__isnull=False, stock_calculado__lte=F('nivel_minimo_stock'))
+
+def _coste_fifo(compras, consumido_previo, cantidad):
+    # compras: lista de (cantidad, coste_por_unidad) en orden de entrada. Se saltan las unidades ya consumidas
+    # y se valora 'cantidad' con las capas que quedan. Si no llega el stock, lo que falta va al último precio.
+    saltar, pendiente, coste, ultimo_precio = max(consumido_previo, Decimal('0.00')), cantidad, Decimal('0.00'), Decimal('0.0000')
+    for cantidad_capa, coste_capa in compras:
+        ultimo_precio = coste_capa
+        disponible = cantidad_capa
+        if saltar > 0:
+            salto = min(disponible, saltar); disponible -= salto; saltar -= salto
+        if disponible <= 0 or pendiente <= 0: continue
+        tomado = min(disponible, pendiente)
+        coste += tomado * coste_capa; pendiente -= tomado
+    coste += pendiente * ultimo_precio
+    return (coste / cantidad).quantize(Decimal('0.0001')) if cantidad > 0 else ultimo_precio
+
+def reconstruir_costes_consumo(metodo, compras, usos, ajustes):
+    """
+    Recorre el historial de un consumible en orden cronológico y devuelve {uso_id: coste_unitario}.
+    compras: (fecha, id, cantidad, coste_total) · usos: (fecha, id, cantidad) · ajustes: (fecha, id, cantidad)
+    """
+    # A igualdad de fecha: primero entra el material, luego los ajustes y por último los usos
+    eventos = [(f, 0, i, ('C', c, t)) for f, i, c, t in compras] + [(f, 1, i, ('A', c, None)) for f, i, c in ajustes] + [(f, 2, i, ('U', c, None)) for f, i, c in usos]
+    eventos.sort(key=lambda e: e[:3])
+
+    costes, capas, consumido, stock, precio_medio = {}, [], Decimal('0.00'), Decimal('0.00'), Decimal('0.0000')
+    for _, _, id_evento, (clase, cantidad, coste_total) in eventos:
+        cantidad = cantidad or Decimal('0.00')
+        if clase == 'C':
+            coste_unidad = (coste_total / cantidad) if cantidad > 0 and coste_total is not None else Decimal('0.0000')
+            capas.append((cantidad, coste_unidad))
+            # Misma fórmula que CompraConsumible.save
+            precio_medio = coste_unidad if stock <= 0 else (stock * precio_medio + (coste_total or 0)) / (stock + cantidad)
+            stock += cantidad
+        elif clase == 'A':
+            consumido -= cantidad; stock += cantidad
+        else:
+            costes[id_evento] = _coste_fifo(capas, consumido, cantidad) if metodo == 'FIFO' else Decimal(precio_medio).quantize(Decimal('0.0001'))
+            consumido += cantidad; stock -= cantidad
+    return costes
+
 class TipoConsumible(models.Model):
+    objects = TipoConsumibleQuerySet.as_manager()
+
+    # 🟢 NUEVO: cómo se valora lo que se gasta en las órdenes
+    METODO_COSTE_CHOICES = [
+        ('MEDIO', 'Precio medio ponderado'),
+        ('FIFO', 'FIFO (primero en entrar, primero en salir)'),
+    ]
+
     nombre = models.CharField(max_length=100)
     unidad_medida = models.CharField(max_length=20)
     nivel_minimo_stock = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     precio_coste_medio = models.DecimalField(max_digits=10, decimal_places=4, default=0.0000, help_text="Se calcula automáticamente con cada compra")
+    metodo_coste = models.CharField(max_length=10, choices=METODO_COSTE_CHOICES, default='MEDIO')
     
     @property
     def stock_actual(self):
-        total_comprado = CompraConsumible.objects.filter(tipo=self).aggregate(total=Sum('cantidad'))['total'] or Decimal('0.00')
-        total_usado_ordenes = UsoConsumible.objects.filter(tipo=self).aggregate(total=Sum('cantidad_usada'))['total'] or Decimal('0.00')
-        total_ajustado = AjusteStockConsumible.objects.filter(tipo=self).aggregate(total=Sum('cantidad_ajustada'))['total'] or Decimal('0.00')
-        return (total_comprado - total_usado_ordenes + total_ajustado).quantize(Decimal('0.01'))
+        # Si viene de objects.with_stock() ya está calculado, no volvemos a consultar
+        if getattr(self, 'stock_calculado', None) is not None:
+            return Decimal(self.stock_calculado).quantize(Decimal('0.01'))
+        return MovimientoStock.saldo_en(self.id)
+
+    def stock_en_fecha(self, fecha):
+        return MovimientoStock.saldo_en(self.id, fecha)
 
     @property
     def alerta_stock(self):
         if self.nivel_minimo_stock is not None and self.stock_actual <= self.nivel_minimo_stock: return "⚠️ BAJO"
         return "✅ OK" if self.nivel_minimo_stock is not None else "N/A"
 
+    def coste_consumo(self, cantidad, excluir_orden=None, consumido_adicional=Decimal('0.00')):
+        """Coste unitario de gastar 'cantidad' ahora mismo, según el método de coste del consumible.
+        consumido_adicional: unidades ya gastadas que todavía no están guardadas (p.ej. en el mismo bulk_create)."""
+        if self.metodo_coste != 'FIFO':
+            return Decimal(self.precio_coste_medio or 0).quantize(Decimal('0.0001'))
+        usos = UsoConsumible.objects.filter(tipo=self)
+        if excluir_orden is not None: usos = usos.exclude(orden=excluir_orden)
+        consumido = consumido_adicional + (usos.aggregate(total=Sum('cantidad_usada'))['total'] or Decimal('0.00')) - (AjusteStockConsumible.objects.filter(tipo=self).aggregate(total=Sum('cantidad_ajustada'))['total'] or Decimal('0.00'))
+        capas = CompraConsumible.objects.filter(tipo=self).order_by('fecha_compra', 'id').values_list('cantidad', 'coste_por_unidad')
+        return _coste_fifo(list(capas), consumido, Decimal(cantidad))
+
     def __str__(self):
         return self.nombre
         
@@ -510,7 +860,8 @@ class CompraConsumible(models.Model):
             self.coste_por_unidad = Decimal('0.0000')
             
         if es_nuevo:
-            tipo_asociado = self.tipo
+            # Stock y precio medio previos en una sola consulta
+            tipo_asociado = TipoConsumible.objects.with_stock().get(pk=self.tipo_id)
             stock_previo = tipo_asociado.stock_actual
             precio_medio_previo = tipo_asociado.precio_coste_medio
             
@@ -522,8 +873,8 @@ class CompraConsumible(models.Model):
                 nuevo_stock_total = stock_previo + self.cantidad
                 nuevo_precio_medio = (valor_inventario_previo + valor_nueva_compra) / nuevo_stock_total
             
-            tipo_asociado.precio_coste_medio = nuevo_precio_medio
-            tipo_asociado.save()
+            TipoConsumible.objects.filter(pk=self.tipo_id).update(precio_coste_medio=Decimal(nuevo_precio_medio).quantize(Decimal('0.0001')))
+            self.tipo.precio_coste_medio = Decimal(nuevo_precio_medio).quantize(Decimal('0.0001'))
 
         super().save(*args, **kwargs)
         
@@ -535,6 +886,17 @@ class UsoConsumible(models.Model):
     tipo = models.ForeignKey(TipoConsumible, on_delete=models.CASCADE)
     cantidad_usada = models.DecimalField(max_digits=10, decimal_places=2)
     fecha_uso = models.DateField(default=timezone.now)
+    # 🟢 NUEVO: coste congelado en el momento del uso (los informes solo suman coste_total)
+    coste_unitario = models.DecimalField(max_digits=10, decimal_places=4, null=True, blank=True, editable=False)
+    coste_total = models.DecimalField(max_digits=12, decimal_places=4, null=True, blank=True, editable=False)
+
+    def asignar_coste(self, excluir_orden=None, consumido_adicional=Decimal('0.00')):
+        self.coste_unitario = self.tipo.coste_consumo(self.cantidad_usada, excluir_orden=excluir_orden, consumido_adicional=consumido_adicional)
+        self.coste_total = (self.coste_unitario * Decimal(self.cantidad_usada)).quantize(Decimal('0.0001'))
+
+    def save(self, *args, **kwargs):
+        if self.coste_unitario is None: self.asignar_coste()
+        super().save(*args, **kwargs)
     
     def __str__(self): return f"Uso de {self.cantidad_usada} {self.tipo.unidad_medida}"
 
@@ -557,6 +919,189 @@ class TipoConsumibleStock(TipoConsumible):
         verbose_name = "Stock de Consumible"
         verbose_name_plural = "Stocks de Consumibles"
 
+# 🟢 NUEVO: Libro de movimientos (kardex) con saldo acumulado por consumible
+class MovimientoStock(models.Model):
+    TIPO_MOVIMIENTO_CHOICES = [
+        ('COMPRA', 'Compra'),
+        ('USO', 'Uso en taller'),
+        ('AJUSTE', 'Ajuste manual'),
+    ]
+
+    tipo = models.ForeignKey(TipoConsumible, on_delete=models.CASCADE, related_name='movimientos')
+    fecha = models.DateField()
+    tipo_movimiento = models.CharField(max_length=10, choices=TIPO_MOVIMIENTO_CHOICES)
+    cantidad = models.DecimalField(max_digits=10, decimal_places=2, help_text="Con signo: positivo entra, negativo sale")
+    saldo = models.DecimalField(max_digits=12, decimal_places=2, help_text="Stock después de este movimiento")
+    compra = models.OneToOneField(CompraConsumible, on_delete=models.CASCADE, null=True, blank=True, related_name='movimiento')
+    uso = models.OneToOneField(UsoConsumible, on_delete=models.CASCADE, null=True, blank=True, related_name='movimiento')
+    ajuste = models.OneToOneField(AjusteStockConsumible, on_delete=models.CASCADE, null=True, blank=True, related_name='movimiento')
+
+    class Meta:
+        ordering = ['fecha', 'id']
+        indexes = [models.Index(fields=['tipo', 'fecha'], name='movstock_tipo_fecha_idx')]
+
+    def __str__(self): return f"{self.get_tipo_movimiento_display()} {self.cantidad} ({self.tipo}) -> {self.saldo}"
+
+    @classmethod
+    def saldo_en(cls, tipo_id, fecha=None):
+        # Stock de un consumible al final de 'fecha' (o el actual): un solo acceso por el índice (tipo, fecha)
+        movimientos = cls.objects.filter(tipo_id=tipo_id)
+        if fecha is not None: movimientos = movimientos.filter(fecha__lte=fecha)
+        return movimientos.order_by('-fecha', '-id').values_list('saldo', flat=True).first() or Decimal('0.00')
+
+    @staticmethod
+    def bloquear_consumibles(tipo_ids):
+        # Serializa los apuntes de un mismo consumible: el saldo se lee y se escribe con la fila de TipoConsumible bloqueada
+        return list(TipoConsumible.objects.select_for_update().filter(pk__in=tipo_ids).order_by('pk').values_list('pk', flat=True))
+
+    @classmethod
+    def apuntar(cls, tipo_id, fecha, tipo_movimiento, cantidad, **origen):
+        fecha = cls._meta.get_field('fecha').to_python(fecha); cantidad = Decimal(cantidad or 0)
+        with transaction.atomic():
+            cls.bloquear_consumibles([tipo_id])
+            # Regla única (también en la carga inicial 0079): dentro del mismo día manda el orden de llegada (id)
+            movimiento = cls.objects.create(tipo_id=tipo_id, fecha=fecha, tipo_movimiento=tipo_movimiento, cantidad=cantidad, saldo=cls.saldo_en(tipo_id, fecha) + cantidad, **origen)
+            cls.objects.filter(tipo_id=tipo_id, fecha__gt=fecha).update(saldo=F('saldo') + cantidad)
+        return movimiento
+
+    @classmethod
+    def apuntar_usos(cls, usos):
+        # Para los UsoConsumible creados con bulk_create (no pasan por las señales): un bloqueo para todos los
+        # consumibles, una lectura y un UPDATE por (consumible, día) y un solo INSERT para todo el lote
+        campo_fecha = cls._meta.get_field('fecha')
+        pendientes = sorted(((uso.tipo_id, campo_fecha.to_python(uso.fecha_uso), -Decimal(uso.cantidad_usada or 0), uso) for uso in usos), key=lambda p: p[:2])
+        if not pendientes: return []
+        with transaction.atomic():
+            cls.bloquear_consumibles({p[0] for p in pendientes})
+            movimientos = []; totales_dia = []
+            for tipo_id, del_tipo in groupby(pendientes, key=lambda p: p[0]):
+                arrastre = Decimal('0.00')
+                for fecha, del_dia in groupby(del_tipo, key=lambda p: p[1]):
+                    saldo = cls.saldo_en(tipo_id, fecha) + arrastre; total_dia = Decimal('0.00')
+                    for _, _, cantidad, uso in del_dia:
+                        saldo += cantidad; total_dia += cantidad
+                        movimientos.append(cls(tipo_id=tipo_id, fecha=fecha, tipo_movimiento='USO', cantidad=cantidad, saldo=saldo, uso=uso))
+                    totales_dia.append((tipo_id, fecha, total_dia)); arrastre += total_dia
+            # Primero se leen todos los saldos y luego los apuntes ya guardados de días posteriores arrastran lo del día
+            for tipo_id, fecha, total_dia in totales_dia:
+                cls.objects.filter(tipo_id=tipo_id, fecha__gt=fecha).update(saldo=F('saldo') + total_dia)
+            return cls.objects.bulk_create(movimientos)
+
+# Origen -> (tipo de movimiento, campo fecha, campo cantidad, signo, campo en MovimientoStock)
+ORIGENES_STOCK = {
+    CompraConsumible: ('COMPRA', 'fecha_compra', 'cantidad', 1, 'compra'),
+    UsoConsumible: ('USO', 'fecha_uso', 'cantidad_usada', -1, 'uso'),
+    AjusteStockConsumible: ('AJUSTE', 'fecha_ajuste', 'cantidad_ajustada', 1, 'ajuste'),
+}
+
+def _datos_movimiento(instance):
+    tipo_movimiento, campo_fecha, campo_cantidad, signo, _ = ORIGENES_STOCK[type(instance)]
+    fecha = MovimientoStock._meta.get_field('fecha').to_python(getattr(instance, campo_fecha))
+    return (instance.tipo_id, fecha, signo * Decimal(getattr(instance, campo_cantidad) or 0))
+
+@receiver(pre_save, sender=CompraConsumible)
+@receiver(pre_save, sender=UsoConsumible)
+@receiver(pre_save, sender=AjusteStockConsumible)
+def guardar_movimiento_anterior(sender, instance, **kwargs):
+    instance._movimiento_anterior = None
+    if instance.pk:
+        anterior = sender.objects.filter(pk=instance.pk).first()
+        if anterior: instance._movimiento_anterior = _datos_movimiento(anterior)
+
+@receiver(post_save, sender=CompraConsumible)
+@receiver(post_save, sender=UsoConsumible)
+@receiver(post_save, sender=AjusteStockConsumible)
+def apuntar_movimiento_stock(sender, instance, created, **kwargs):
+    tipo_movimiento, _, _, _, campo_origen = ORIGENES_STOCK[sender]
+    tipo_id, fecha, cantidad = _datos_movimiento(instance)
+    if not created:
+        if getattr(instance, '_movimiento_anterior', None) == (tipo_id, fecha, cantidad): return
+        # Ha cambiado fecha, cantidad o consumible: se retira el apunte viejo y se vuelve a apuntar
+        MovimientoStock.objects.filter(**{campo_origen: instance}).delete()
+    MovimientoStock.apuntar(tipo_id, fecha, tipo_movimiento, cantidad, **{campo_origen: instance})
+
+@receiver(post_delete, sender=MovimientoStock)
+def retirar_movimiento_stock(sender, instance, **kwargs):
+    # Al borrar un apunte (o su compra/uso/ajuste en cascada), los posteriores dejan de contarlo
+    with transaction.atomic(savepoint=False):
+        MovimientoStock.bloquear_consumibles([instance.tipo_id])
+        MovimientoStock.objects.filter(tipo_id=instance.tipo_id).filter(Q(fecha__gt=instance.fecha) | Q(fecha=instance.fecha, id__gt=instance.id)).update(saldo=F('saldo') - instance.cantidad)
+
+# 🟢 NUEVO: Previsión de consumo (ritmo diario, fecha en que se acaba y cuánto pedir)
+VENTANA_PREVISION_DIAS = 90      # Historial que se mira
+VENTANA_RECIENTE_DIAS = 30       # Si el último mes se gasta más rápido, manda el último mes
+PLAZO_REPOSICION_DIAS = 7        # Lo que tarda en llegar un pedido
+COBERTURA_PEDIDO_DIAS = 30       # Para cuántos días se pide
+FACTOR_SEGURIDAD = 1.65          # ~95% de no quedarse sin stock durante el plazo
+
+def _calcular_prevision_consumibles(hoy):
+    desde = hoy - datetime.timedelta(days=VENTANA_PREVISION_DIAS - 1)
+
+    # Una pasada por consulta: consumo por (tipo, día), primer movimiento de cada tipo y stock actual
+    consumo_por_dia = {}
+    for fila in UsoConsumible.objects.filter(fecha_uso__gte=desde, fecha_uso__lte=hoy).values('tipo_id', 'fecha_uso').annotate(total=Sum('cantidad_usada')).order_by():
+        consumo_por_dia.setdefault(fila['tipo_id'], []).append(((hoy - fila['fecha_uso']).days, float(fila['total'] or 0)))
+    primer_movimiento = dict(MovimientoStock.objects.values('tipo_id').annotate(primera=Min('fecha')).order_by().values_list('tipo_id', 'primera'))
+    stocks = dict(TipoConsumible.objects.with_stock().values_list('id', 'stock_calculado'))
+
+    prevision = {}
+    for tipo_id, stock in stocks.items():
+        stock = float(stock or 0)
+        dias = consumo_por_dia.get(tipo_id, [])
+        # Si el consumible es nuevo, la ventana empieza en su primer movimiento (si no, los días vacíos bajan la media)
+        primera = primer_movimiento.get(tipo_id)
+        ventana = max(1, min(VENTANA_PREVISION_DIAS, (hoy - primera).days + 1)) if primera else VENTANA_PREVISION_DIAS
+        ventana_reciente = min(VENTANA_RECIENTE_DIAS, ventana)
+
+        # Media, desviación y media reciente sin montar la serie diaria: los días sin uso cuentan como 0
+        total = sum(cantidad for _, cantidad in dias)
+        total_cuadrados = sum(cantidad * cantidad for _, cantidad in dias)
+        total_reciente = sum(cantidad for hace, cantidad in dias if hace < ventana_reciente)
+        media = total / ventana
+        desviacion = math.sqrt(max(total_cuadrados / ventana - media * media, 0))
+        consumo_diario = max(media, total_reciente / ventana_reciente)
+
+        if consumo_diario > 0:
+            dias_restantes = max(int(stock / consumo_diario), 0)
+            stock_seguridad = FACTOR_SEGURIDAD * desviacion * math.sqrt(PLAZO_REPOSICION_DIAS)
+            punto_pedido = consumo_diario * PLAZO_REPOSICION_DIAS + stock_seguridad
+            cantidad_sugerida = max(consumo_diario * (PLAZO_REPOSICION_DIAS + COBERTURA_PEDIDO_DIAS) + stock_seguridad - stock, 0)
+            prevision[tipo_id] = {
+                'consumo_diario': Decimal(consumo_diario).quantize(Decimal('0.01')),
+                'dias_restantes': dias_restantes,
+                'fecha_agotado': hoy + datetime.timedelta(days=dias_restantes),
+                'punto_pedido': Decimal(punto_pedido).quantize(Decimal('0.01')),
+                'cantidad_sugerida': (Decimal(math.ceil(cantidad_sugerida * 100)) / 100).quantize(Decimal('0.01')),
+                'pedir': stock <= punto_pedido,
+            }
+        else:
+            prevision[tipo_id] = {'consumo_diario': Decimal('0.00'), 'dias_restantes': None, 'fecha_agotado': None, 'punto_pedido': Decimal('0.00'), 'cantidad_sugerida': Decimal('0.00'), 'pedir': False}
+    return prevision
+
+def prevision_consumibles(hoy=None):
+    """Previsión de todos los consumibles, cacheada hasta que entra un movimiento de stock nuevo (o cambia el día)."""
+    hoy = hoy or timezone.localdate()
+    # La clave cambia con cualquier alta/baja en el libro de movimientos, así vale aunque cada worker tenga su caché
+    version = MovimientoStock.objects.aggregate(ultimo=Max('id'), total=Count('id'))
+    clave = f"prevision_consumibles:{hoy.isoformat()}:{version['ultimo']}:{version['total']}"
+    prevision = cache.get(clave)
+    if prevision is None:
+        prevision = _calcular_prevision_consumibles(hoy)
+        cache.set(clave, prevision, 60 * 60 * 24)
+    return prevision
+
+def consumibles_con_prevision(tipos=None):
+    # Pega la previsión a cada consumible; sin historial de uso se sigue avisando por el nivel mínimo
+    prevision = prevision_consumibles()
+    tipos = list(tipos if tipos is not None else TipoConsumible.objects.with_stock().order_by('nombre'))
+    for tipo in tipos:
+        tipo.prevision = prevision.get(tipo.id)
+        if tipo.prevision and tipo.prevision['consumo_diario'] > 0:
+            tipo.reponer = tipo.prevision['pedir']
+        else:
+            tipo.reponer = tipo.nivel_minimo_stock is not None and tipo.stock_actual <= tipo.nivel_minimo_stock
+    return tipos
+
 # =========================================================
 
 class FotoVehiculo(models.Model):
@@ -697,9 +1242,32 @@ class FacturaProveedor(models.Model):
 # --- AUTOMATIZACIÓN DE DEUDA DE IVA CON HACIENDA ---
 # =========================================================
 
-def actualizar_deuda_hacienda(fecha_referencia):
-    year = fecha_referencia.year
-    trimestre = math.ceil(fecha_referencia.month / 3)
+class IvaTrimestral(models.Model):
+    # Acumulado de IVA por trimestre. Cada alta/cambio/borrado de Factura o FacturaProveedor suma solo su diferencia,
+    # sin volver a sumar todo el trimestre. 'python manage.py verificar_iva' lo compara con el cálculo completo.
+    ano = models.PositiveSmallIntegerField()
+    trimestre = models.PositiveSmallIntegerField()
+    iva_clientes = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    iva_proveedores = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        unique_together = ('ano', 'trimestre')
+        ordering = ['-ano', '-trimestre']
+        verbose_name = "IVA Trimestral"
+        verbose_name_plural = "IVA Trimestral"
+
+    @property
+    def iva_neto(self):
+        return self.iva_clientes - self.iva_proveedores
+
+    def __str__(self):
+        return f"IVA T{self.trimestre} {self.ano}: {self.iva_neto}€"
+
+def trimestre_de(fecha):
+    return (fecha.year, math.ceil(fecha.month / 3))
+
+def calcular_iva_trimestre(year, trimestre):
+    # Cálculo completo (lento) de un trimestre: (iva_clientes, iva_proveedores)
     meses = [1,2,3] if trimestre==1 else [4,5,6] if trimestre==2 else [7,8,9] if trimestre==3 else [10,11,12]
     
     iva_clientes = Factura.objects.filter(
@@ -712,46 +1280,136 @@ def actualizar_deuda_hacienda(fecha_referencia):
         fecha_factura__year=year, 
         fecha_factura__month__in=meses
     ).aggregate(total=Sum('iva'))['total'] or Decimal('0.00')
-    
-    iva_neto = iva_clientes - iva_proveedores
+
+    return Decimal(iva_clientes).quantize(Decimal('0.01')), Decimal(iva_proveedores).quantize(Decimal('0.01'))
+
+def sincronizar_deuda_hacienda(year, trimestre, fecha_referencia=None):
+    # Idempotente: deja la deuda del trimestre igual al IVA neto acumulado, se llame las veces que se llame
+    acumulado = IvaTrimestral.objects.filter(ano=year, trimestre=trimestre).first()
+    iva_neto = acumulado.iva_neto if acumulado else Decimal('0.00')
     motivo_deuda = f"IVA T{trimestre} {year}"
     
     if iva_neto > 0:
         deuda, created = DeudaTaller.objects.get_or_create(
             acreedor="HACIENDA",
             motivo=motivo_deuda,
-            defaults={'importe_inicial': iva_neto, 'fecha_creacion': fecha_referencia}
+            defaults={'importe_inicial': iva_neto, 'fecha_creacion': fecha_referencia or timezone.now().date()}
         )
-        if not created:
+        if not created and deuda.importe_inicial != iva_neto:
             deuda.importe_inicial = iva_neto
             deuda.save()
     else:
         DeudaTaller.objects.filter(acreedor="HACIENDA", motivo=motivo_deuda).update(importe_inicial=Decimal('0.00'))
 
-@receiver(post_save, sender=Factura)
-@receiver(pre_delete, sender=Factura)
-def trigger_iva_factura(sender, instance, **kwargs):
-    if instance.es_factura:
-        actualizar_deuda_hacienda(instance.fecha_emision)
+def actualizar_deuda_hacienda(fecha_referencia):
+    # Recalculo completo del trimestre de 'fecha_referencia' (corrige el acumulado y la deuda)
+    year, trimestre = trimestre_de(fecha_referencia)
+    iva_clientes, iva_proveedores = calcular_iva_trimestre(year, trimestre)
+    IvaTrimestral.objects.update_or_create(
+        ano=year, trimestre=trimestre,
+        defaults={'iva_clientes': iva_clientes, 'iva_proveedores': iva_proveedores}
+    )
+    sincronizar_deuda_hacienda(year, trimestre, fecha_referencia)
+
+def _aplicar_iva(fecha, campo, importe):
+    if fecha is None or not importe: return
+    year, trimestre = trimestre_de(fecha)
+    if not IvaTrimestral.objects.filter(ano=year, trimestre=trimestre).update(**{campo: F(campo) + importe}):
+        IvaTrimestral.objects.get_or_create(ano=year, trimestre=trimestre)
+        IvaTrimestral.objects.filter(ano=year, trimestre=trimestre).update(**{campo: F(campo) + importe})
+
+    # La deuda se sincroniza al confirmar (si la transacción se deshace, Django descarta el callback).
+    # Varios guardados del mismo trimestre registran varios: da igual, sincronizar deja siempre el mismo resultado
+    transaction.on_commit(lambda: sincronizar_deuda_hacienda(year, trimestre, fecha))
+
+def _aportacion_iva(sender, fecha, iva, es_factura=True):
+    # (fecha, importe) con el que un documento contribuye al acumulado
+    # (desde las vistas pueden llegar la fecha como texto 'AAAA-MM-DD' y el IVA como float)
+    fecha = models.DateField().to_python(fecha)
+    if sender is Factura and not es_factura: return (fecha, Decimal('0.00'))
+    return (fecha, Decimal(str(iva or 0)).quantize(Decimal('0.01')))
+
+@receiver(pre_save, sender=Factura)
+def guardar_iva_anterior_factura(sender, instance, **kwargs):
+    instance._iva_anterior = None
+    if instance.pk:
+        anterior = Factura.objects.filter(pk=instance.pk).values_list('fecha_emision', 'iva', 'es_factura').first()
+        if anterior: instance._iva_anterior = _aportacion_iva(sender, *anterior)
+
+@receiver(pre_save, sender=FacturaProveedor)
+def guardar_iva_anterior_proveedor(sender, instance, **kwargs):
+    instance._iva_anterior = None
+    if instance.pk:
+        anterior = FacturaProveedor.objects.filter(pk=instance.pk).values_list('fecha_factura', 'iva').first()
+        if anterior: instance._iva_anterior = _aportacion_iva(sender, *anterior)
 
+@receiver(post_save, sender=Factura)
 @receiver(post_save, sender=FacturaProveedor)
-@receiver(pre_delete, sender=FacturaProveedor)
-def trigger_iva_proveedor(sender, instance, **kwargs):
-    actualizar_deuda_hacienda(instance.fecha_factura)
-
+def trigger_iva(sender, instance, **kwargs):
+    campo = 'iva_clientes' if sender is Factura else 'iva_proveedores'
+    if sender is Factura:
+        nuevo = _aportacion_iva(sender, instance.fecha_emision, instance.iva, instance.es_factura)
+    else:
+        nuevo = _aportacion_iva(sender, instance.fecha_factura, instance.iva)
+    anterior = getattr(instance, '_iva_anterior', None)
+    if anterior == nuevo: return
+
+    fecha_nueva, iva_nuevo = nuevo
+    if anterior:
+        fecha_anterior, iva_anterior = anterior
+        if fecha_anterior and trimestre_de(fecha_anterior) == trimestre_de(fecha_nueva):
+            # Mismo trimestre: solo aplicamos la diferencia
+            _aplicar_iva(fecha_nueva, campo, Decimal(iva_nuevo) - Decimal(iva_anterior))
+            instance._iva_anterior = nuevo
+            return
+        _aplicar_iva(fecha_anterior, campo, -Decimal(iva_anterior))
+    _aplicar_iva(fecha_nueva, campo, Decimal(iva_nuevo))
+    instance._iva_anterior = nuevo
+
+@receiver(post_delete, sender=Factura)
+@receiver(post_delete, sender=FacturaProveedor)
+def descontar_iva(sender, instance, **kwargs):
+    campo = 'iva_clientes' if sender is Factura else 'iva_proveedores'
+    if sender is Factura:
+        fecha, iva = _aportacion_iva(sender, instance.fecha_emision, instance.iva, instance.es_factura)
+    else:
+        fecha, iva = _aportacion_iva(sender, instance.fecha_factura, instance.iva)
+    _aplicar_iva(fecha, campo, -Decimal(iva))
 
 # =========================================================
 # --- MODULO DE STOCK Y TRAZABILIDAD DE CHAPA ---
 # =========================================================
 
+class StockMaterialChapaQuerySet(models.QuerySet):
+    def with_saldo(self):
+        # Gastado, disponible y fecha del último uso de cada bote en la misma consulta
+        return self.annotate(
+            usado_calculado=Coalesce(Sum('usos__importe_usado'), Value(Decimal('0.00')), output_field=DecimalField(max_digits=12, decimal_places=2)),
+            ultimo_uso=Max('usos__fecha_uso'),
+        ).annotate(disponible_calculado=F('importe_total') - F('usado_calculado'))
+
+    def con_saldo(self):
+        # Los agotados se descartan por el índice antes de sumar nada
+        return self.filter(agotado=False).with_saldo().filter(disponible_calculado__gt=0)
+
+    def agotados(self):
+        return self.filter(agotado=True).with_saldo()
+
 class StockMaterialChapa(models.Model):
+    objects = StockMaterialChapaQuerySet.as_manager()
+
     gasto_original = models.OneToOneField(Gasto, on_delete=models.CASCADE, related_name='lote_chapa')
     descripcion = models.CharField(max_length=255, help_text="Ej: Pintura Blanca UHS, Barniz, Masilla...")
     importe_total = models.DecimalField(max_digits=10, decimal_places=2, help_text="Lo que costó el bote o lote completo")
     fecha_registro = models.DateField(default=timezone.now)
+    # 🟢 NUEVO: se marca al gastarse al 100% (lo mantienen las señales de UsoMaterialChapa)
+    agotado = models.BooleanField(default=False, db_index=True, editable=False)
 
     @property
     def importe_usado(self):
+        # Si viene de objects.with_saldo() ya está sumado
+        if getattr(self, 'usado_calculado', None) is not None:
+            return Decimal(self.usado_calculado).quantize(Decimal('0.01'))
         # Suma todos los "consumos" que se le han hecho a este bote
         total = self.usos.aggregate(total=Sum('importe_usado'))['total']
         return total or Decimal('0.00')
@@ -761,10 +1419,54 @@ class StockMaterialChapa(models.Model):
         # Dinero que queda en el bote
         return self.importe_total - self.importe_usado
 
-    @property
-    def agotado(self):
-        # Si el bote se ha gastado al 100%
-        return self.importe_disponible <= 0
+    def refrescar_agotado(self):
+        agotado = self.importe_disponible <= 0
+        if agotado != self.agotado:
+            StockMaterialChapa.objects.filter(pk=self.pk).update(agotado=agotado)
+            self.agotado = agotado
+
+    def save(self, *args, **kwargs):
+        if self.pk: self.agotado = self.importe_disponible <= 0
+        super(StockMaterialChapa, self).save(*args, **kwargs)
+
+    @classmethod
+    def disponible_familia(cls, familia=None):
+        lotes = cls.objects.con_saldo()
+        if familia: lotes = lotes.filter(descripcion__icontains=familia)
+        return lotes.aggregate(total=Sum('disponible_calculado'))['total'] or Decimal('0.00')
+
+    @classmethod
+    def repartir_fifo(cls, orden, importe, familia=None, notas=None):
+        """
+        Reparte 'importe' euros entre los botes abiertos, del más antiguo al más nuevo.
+        Bloquea los botes hasta el final de la transacción para que dos chapistas no gasten el mismo saldo.
+        Si no hay saldo suficiente no se apunta nada (ValueError).
+        """
+        importe = Decimal(importe).quantize(Decimal('0.01'))
+        if importe <= 0: raise ValueError("El importe tiene que ser mayor que 0.")
+        with transaction.atomic():
+            lotes = cls.objects.select_for_update().filter(agotado=False)
+            if familia: lotes = lotes.filter(descripcion__icontains=familia)
+            lotes = list(lotes.order_by('fecha_registro', 'id'))
+            # Con los botes ya bloqueados, lo gastado de cada uno no puede cambiar por debajo
+            usado = dict(UsoMaterialChapa.objects.filter(lote__in=lotes).values('lote').annotate(total=Sum('importe_usado')).order_by().values_list('lote', 'total'))
+
+            usos, agotados, pendiente = [], [], importe
+            for lote in lotes:
+                if pendiente <= 0: break
+                disponible = lote.importe_total - (usado.get(lote.id) or Decimal('0.00'))
+                if disponible <= 0: continue
+                tomado = min(disponible, pendiente)
+                usos.append(UsoMaterialChapa(lote=lote, orden=orden, importe_usado=tomado, fecha_uso=timezone.now().date(), notas=notas.upper() if notas else notas))
+                pendiente -= tomado
+                if tomado == disponible: agotados.append(lote.id)
+
+            if pendiente > 0:
+                raise ValueError(f"No hay saldo suficiente: faltan {pendiente}€.")
+            UsoMaterialChapa.objects.bulk_create(usos)
+            # bulk_create no pasa por las señales: marcamos aquí los botes que se han vaciado
+            if agotados: cls.objects.filter(id__in=agotados).update(agotado=True)
+        return usos
 
     def __str__(self):
         return f"{self.descripcion} - Restan: {self.importe_disponible}€"
@@ -781,4 +1483,213 @@ class UsoMaterialChapa(models.Model):
         
     def save(self, *args, **kwargs):
         if self.notas: self.notas = self.notas.upper()
-        super(UsoMaterialChapa, self).save(*args, **kwargs)
\ No newline at end of file
+        super(UsoMaterialChapa, self).save(*args, **kwargs)
+
+@receiver(post_save, sender=UsoMaterialChapa)
+@receiver(post_delete, sender=UsoMaterialChapa)
+def refrescar_lote_chapa(sender, instance, **kwargs):
+    lote = StockMaterialChapa.objects.filter(pk=instance.lote_id).first()
+    if lote: lote.refrescar_agotado()
+
+# =========================================================
+# --- SALDOS DE CUENTAS (LIBRO MATERIALIZADO) ---
+# =========================================================
+
+class SaldoCuenta(models.Model):
+    # Acumulado de ingresos y gastos por cuenta para no sumar todo el histórico en cada página.
+    # Se mantiene solo con las señales de Gasto/Ingreso; 'python manage.py recalcular_saldos' lo reconstruye.
+    CUENTAS = ['EFECTIVO', 'CUENTA_TALLER', 'TARJETA_1', 'TARJETA_2']
+    CUENTA_CHOICES = Gasto.METODO_PAGO_CHOICES[:4]
+
+    cuenta = models.CharField(max_length=20, choices=CUENTA_CHOICES, unique=True)
+    total_ingresos = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    total_gastos = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Saldo de Cuenta"
+        verbose_name_plural = "Saldos de Cuentas"
+        ordering = ['cuenta']
+
+    @property
+    def saldo(self):
+        return self.total_ingresos - self.total_gastos
+
+    @classmethod
+    def saldos(cls):
+        # Una sola consulta: {cuenta: ingresos - gastos}, con 0.00 para las cuentas sin movimientos
+        resultado = {cuenta: Decimal('0.00') for cuenta in cls.CUENTAS}
+        for fila in cls.objects.all():
+            resultado[fila.cuenta] = fila.saldo
+        return resultado
+
+    @classmethod
+    def aplicar(cls, cuenta, campo, importe):
+        if cuenta not in cls.CUENTAS or not importe: return
+        if not cls.objects.filter(cuenta=cuenta).update(**{campo: F(campo) + importe, 'fecha_actualizacion': timezone.now()}):
+            cls.objects.get_or_create(cuenta=cuenta)
+            cls.objects.filter(cuenta=cuenta).update(**{campo: F(campo) + importe, 'fecha_actualizacion': timezone.now()})
+
+    @classmethod
+    def calcular_desde_movimientos(cls):
+        # Recalculo completo (lento): {cuenta: (total_ingresos, total_gastos)} sumando todo el histórico
+        ingresos = dict(Ingreso.objects.filter(metodo_pago__in=cls.CUENTAS).values_list('metodo_pago').annotate(total=Sum('importe')).order_by())
+        gastos = dict(Gasto.objects.filter(metodo_pago__in=cls.CUENTAS).values_list('metodo_pago').annotate(total=Sum('importe')).order_by())
+        return {c: (Decimal(ingresos.get(c) or 0).quantize(Decimal('0.01')), Decimal(gastos.get(c) or 0).quantize(Decimal('0.01'))) for c in cls.CUENTAS}
+
+    def __str__(self):
+        return f"{self.get_cuenta_display()} - Saldo: {self.saldo}€"
+
+@receiver(pre_save, sender=Gasto)
+@receiver(pre_save, sender=Ingreso)
+def guardar_saldo_anterior(sender, instance, **kwargs):
+    # Lo que había en BD antes de editar (también desde el admin), para restarlo de la cuenta vieja
+    instance._saldo_anterior = None
+    if instance.pk:
+        instance._saldo_anterior = sender.objects.filter(pk=instance.pk).values_list('metodo_pago', 'importe').first()
+
+@receiver(post_save, sender=Gasto)
+@receiver(post_save, sender=Ingreso)
+def actualizar_saldo_cuenta(sender, instance, **kwargs):
+    campo = 'total_gastos' if sender is Gasto else 'total_ingresos'
+    anterior = getattr(instance, '_saldo_anterior', None)
+    if anterior:
+        metodo_anterior, importe_anterior = anterior
+        if metodo_anterior == instance.metodo_pago and importe_anterior == instance.importe: return
+        SaldoCuenta.aplicar(metodo_anterior, campo, -(importe_anterior or Decimal('0.00')))
+    SaldoCuenta.aplicar(instance.metodo_pago, campo, instance.importe or Decimal('0.00'))
+    instance._saldo_anterior = (instance.metodo_pago, instance.importe)
+
+@receiver(post_delete, sender=Gasto)
+@receiver(post_delete, sender=Ingreso)
+def descontar_saldo_cuenta(sender, instance, **kwargs):
+    campo = 'total_gastos' if sender is Gasto else 'total_ingresos'
+    SaldoCuenta.aplicar(instance.metodo_pago, campo, -(instance.importe or Decimal('0.00')))
+
+
+# =========================================================
+# --- CATÁLOGO DE PERIODOS CON DATOS (DESPLEGABLES AÑO/MES) ---
+# =========================================================
+
+class PeriodoConDatos(models.Model):
+    # Un registro por (año, mes, origen) con movimientos. Los desplegables de año/mes lo leen en vez de
+    # cargar todas las fechas de Gasto, Ingreso, Factura y Presupuesto. Se mantiene con señales.
+    ORIGEN_CHOICES = [
+        ('GASTO', 'Gasto'),
+        ('INGRESO', 'Ingreso'),
+        ('FACTURA', 'Factura'),
+        ('PRESUPUESTO', 'Presupuesto'),
+    ]
+    ano = models.PositiveSmallIntegerField()
+    mes = models.PositiveSmallIntegerField()
+    origen = models.CharField(max_length=20, choices=ORIGEN_CHOICES)
+
+    class Meta:
+        unique_together = ('ano', 'mes', 'origen')
+        ordering = ['-ano', 'mes']
+        verbose_name = "Periodo con Datos"
+        verbose_name_plural = "Periodos con Datos"
+
+    def __str__(self):
+        return f"{self.mes:02d}/{self.ano} ({self.get_origen_display()})"
+
+    @classmethod
+    def anos_y_meses(cls):
+        # {año: [meses ordenados]} con los años de más reciente a más antiguo
+        anos_y_meses = {}
+        for ano, mes in cls.objects.values_list('ano', 'mes').distinct().order_by('-ano', 'mes'):
+            anos_y_meses.setdefault(ano, []).append(mes)
+        return anos_y_meses
+
+# Modelo -> (origen, campo de fecha)
+ORIGENES_PERIODO = {
+    Gasto: ('GASTO', 'fecha'),
+    Ingreso: ('INGRESO', 'fecha'),
+    Factura: ('FACTURA', 'fecha_emision'),
+    Presupuesto: ('PRESUPUESTO', 'fecha_creacion'),
+}
+
+def _periodo_de(valor):
+    if valor is None: return None
+    if isinstance(valor, datetime.datetime):
+        valor = timezone.localtime(valor) if timezone.is_aware(valor) else valor
+    return (valor.year, valor.month)
+
+def _revisar_periodo(sender, periodo):
+    # Si ya no queda ningún movimiento de ese origen en ese mes, lo quitamos del catálogo
+    if periodo is None: return
+    origen, campo = ORIGENES_PERIODO[sender]
+    ano, mes = periodo
+    if isinstance(sender._meta.get_field(campo), models.DateTimeField):
+        inicio = timezone.make_aware(datetime.datetime(ano, mes, 1))
+        fin = timezone.make_aware(datetime.datetime(ano + (mes == 12), mes % 12 + 1, 1))
+        hay_datos = sender.objects.filter(**{f'{campo}__gte': inicio, f'{campo}__lt': fin}).exists()
+    else:
+        hay_datos = sender.objects.filter(**{f'{campo}__year': ano, f'{campo}__month': mes}).exists()
+    if not hay_datos:
+        PeriodoConDatos.objects.filter(ano=ano, mes=mes, origen=origen).delete()
+
+@receiver(pre_save, sender=Gasto)
+@receiver(pre_save, sender=Ingreso)
+@receiver(pre_save, sender=Factura)
+@receiver(pre_save, sender=Presupuesto)
+def guardar_periodo_anterior(sender, instance, **kwargs):
+    _, campo = ORIGENES_PERIODO[sender]
+    instance._periodo_anterior = None
+    if instance.pk:
+        instance._periodo_anterior = _periodo_de(sender.objects.filter(pk=instance.pk).values_list(campo, flat=True).first())
+
+@receiver(post_save, sender=Gasto)
+@receiver(post_save, sender=Ingreso)
+@receiver(post_save, sender=Factura)
+@receiver(post_save, sender=Presupuesto)
+def registrar_periodo(sender, instance, **kwargs):
+    origen, campo = ORIGENES_PERIODO[sender]
+    periodo = _periodo_de(getattr(instance, campo))
+    anterior = getattr(instance, '_periodo_anterior', None)
+    if periodo and periodo != anterior:
+        PeriodoConDatos.objects.get_or_create(ano=periodo[0], mes=periodo[1], origen=origen)
+    if anterior and anterior != periodo:
+        _revisar_periodo(sender, anterior)
+
+@receiver(post_delete, sender=Gasto)
+@receiver(post_delete, sender=Ingreso)
+@receiver(post_delete, sender=Factura)
+@receiver(post_delete, sender=Presupuesto)
+def retirar_periodo(sender, instance, **kwargs):
+    _, campo = ORIGENES_PERIODO[sender]
+    _revisar_periodo(sender, _periodo_de(getattr(instance, campo)))
+
+# =========================================================
+# --- VERSIÓN DE LA PÁGINA PÚBLICA DEL COCHE ---
+# =========================================================
+# La página que ve el cliente se cachea por orden y 'actualizado'. Cualquier cambio que se vea en ella toca la orden.
+
+def tocar_ordenes(**filtros):
+    OrdenDeReparacion.objects.filter(**filtros).update(actualizado=timezone.now())
+
+@receiver(post_save, sender=FotoVehiculo)
+@receiver(post_delete, sender=FotoVehiculo)
+@receiver(post_save, sender=ReporteEscaner)
+@receiver(post_delete, sender=ReporteEscaner)
+def tocar_orden_por_adjunto(sender, instance, **kwargs):
+    tocar_ordenes(id=instance.orden_id)
+
+@receiver(pre_save, sender=NotaInternaOrden)
+def guardar_visibilidad_anterior(sender, instance, **kwargs):
+    instance._visible_anterior = False
+    if instance.pk:
+        instance._visible_anterior = bool(NotaInternaOrden.objects.filter(pk=instance.pk).values_list('visible_cliente', flat=True).first())
+
+@receiver(post_save, sender=NotaInternaOrden)
+@receiver(post_delete, sender=NotaInternaOrden)
+def tocar_orden_por_nota(sender, instance, **kwargs):
+    # Solo las notas que el cliente ve (o veía) cambian su página
+    if instance.visible_cliente or getattr(instance, '_visible_anterior', False):
+        tocar_ordenes(id=instance.orden_id)
+
+@receiver(post_save, sender=Vehiculo)
+def tocar_ordenes_por_vehiculo(sender, instance, created, **kwargs):
+    # Matrícula, modelo o kilómetros salen en la página de todas sus órdenes
+    if not created:
+        tocar_ordenes(vehiculo_id=instance.pk)
@@ -1,3 +1,91 @@
-from django.test import TestCase
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+
+from .models import SecuenciaFactura, siguiente_numero_factura
 
 # Create your tests here.
+
+PROCESOS = 4
+NUMEROS_POR_PROCESO = 25
+
+
+def _reservar_numeros(cola):
+    # Proceso hijo: abre su propia conexión y reserva números como lo haría otro worker de gunicorn
+    numeros = []
+    for _ in range(NUMEROS_POR_PROCESO):
+        with transaction.atomic():
+            numeros.append(siguiente_numero_factura())
+    connections.close_all()
+    cola.put(numeros)
+
+
+class NumeracionFacturasConcurrenteTest(TransactionTestCase):
+    """Varios procesos pidiendo números a la vez: ni duplicados ni huecos."""
+
+    def setUp(self):
+        try:
+            self.contexto = multiprocessing.get_context('fork')
+        except ValueError:
+            raise unittest.SkipTest("Hace falta 'fork' para lanzar los procesos.")
+
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # La BD de test de SQLite vive en memoria y otros procesos no la ven: la copiamos a un fichero
+            connection.ensure_connection()
+            descriptor, ruta_temporal = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(descriptor)
+            destino = sqlite3.connect(ruta_temporal)
+            connection.connection.backup(destino)
+            destino.close()
+
+            # Guardamos la conexión en memoria (si se cierra, la BD de test desaparece) y apuntamos al fichero
+            conexion_memoria, nombre_original = connection.connection, connection.settings_dict['NAME']
+            connection.connection = None
+            connection.settings_dict['NAME'] = ruta_temporal
+
+            def restaurar():
+                connection.close()
+                connection.settings_dict['NAME'] = nombre_original
+                connection.connection = conexion_memoria
+                os.remove(ruta_temporal)
+            self.addCleanup(restaurar)
+
+        SecuenciaFactura.objects.update_or_create(serie='FACTURA', defaults={'ultimo_numero': 0})
+
+    def test_procesos_concurrentes_sin_duplicados_ni_huecos(self):
+        # Cada hijo tiene que abrir su propia conexión (no se comparten sockets tras el fork)
+        connections.close_all()
+        cola = self.contexto.Queue()
+        procesos = [self.contexto.Process(target=_reservar_numeros, args=(cola,)) for _ in range(PROCESOS)]
+        for proceso in procesos: proceso.start()
+        resultados = [cola.get(timeout=60) for _ in procesos]
+        for proceso in procesos: proceso.join(timeout=60)
+
+        numeros = [n for lista in resultados for n in lista]
+        total = PROCESOS * NUMEROS_POR_PROCESO
+        self.assertEqual(len(numeros), total)
+        self.assertEqual(sorted(numeros), list(range(1, total + 1)))
+        self.assertEqual(SecuenciaFactura.objects.get(serie='FACTURA').ultimo_numero, total)
+
+
+class SecuenciaFacturaTest(TestCase):
+
+    def test_numero_puesto_a_mano_adelanta_la_serie(self):
+        self.assertEqual(siguiente_numero_factura(), 1)
+        SecuenciaFactura.avanzar_hasta(5)
+        SecuenciaFactura.avanzar_hasta(3)
+        self.assertEqual(siguiente_numero_factura(), 6)
+
+    def test_transaccion_deshecha_no_deja_huecos(self):
+        try:
+            with transaction.atomic():
+                siguiente_numero_factura()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(siguiente_numero_factura(), 1)
@@ -30,6 +30,7 @@ urlpatterns = [
 
     # Órdenes
     path('ordenes/', views.lista_ordenes, name='lista_ordenes'),
+    path('ordenes/cambios/', views.cambios_ordenes, name='cambios_ordenes'),
     path('orden/<int:orden_id>/', views.detalle_orden, name='detalle_orden'),
     path('historial-ordenes/', views.historial_ordenes, name='historial_ordenes'),
     path('sincronizar-escaner/', views.sincronizar_escaner, name='sincronizar_escaner'),
@@ -47,6 +48,7 @@ urlpatterns = [
     path('editar-movimiento/<str:tipo>/<int:movimiento_id>/', views.editar_movimiento, name='editar_movimiento'),
     path('eliminar-movimiento/<str:tipo>/<int:movimiento_id>/', views.eliminar_movimiento, name='eliminar_movimiento'),
     path('informes/rentabilidad/', views.informe_rentabilidad, name='informe_rentabilidad'),
+    path('informes/fases/', views.informe_fases, name='informe_fases'),
     path('orden/<int:orden_id>/ganancia/', views.detalle_ganancia_orden, name='detalle_ganancia_orden'),
     
     # --- LA SOLUCIÓN AL EMPLEADO: La ruta larga va PRIMERO ---
@@ -77,6 +79,7 @@ urlpatterns = [
     path('nominas/', views.panel_nominas, name='panel_nominas'),
     path('nominas/detalle/<int:empleado_id>/', views.detalle_nomina, name='detalle_nomina'),
     path('nominas/adelanto/', views.dar_adelanto, name='dar_adelanto'),
+    path('nominas/exportar-horas/', views.exportar_horas, name='exportar_horas'),
     # Añade esto junto a tus otras rutas de empleados/nóminas
     path('empleado/<int:empleado_id>/actualizar_sueldo/', views.actualizar_sueldo_historial, name='actualizar_sueldo_historial'),
     
@@ -1,10 +1,12 @@
 # taller/views.py
 # --- LIBRERÍAS ESTÁNDAR DE PYTHON ---
 import os
+import csv
 import json
-import calendar
+import math
+import statistics
 from datetime import datetime, timedelta
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 from itertools import groupby
 from collections import defaultdict
 from urllib.parse import quote
@@ -18,16 +20,20 @@ import io
 
 # --- CORE DE DJANGO ---
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
-from django.template.loader import get_template
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.template.loader import get_template, render_to_string
 from django.conf import settings
 from django.utils import timezone
+from django.utils.http import http_date
+from django.utils.cache import get_conditional_response
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Sum, F, Q
+from django.db.models import Sum, F, Q, Count, Max, Prefetch, Exists, OuterRef
 from django.db import transaction
-from django.core.signing import Signer, BadSignature
+from django.core.signing import Signer, TimestampSigner, BadSignature, SignatureExpired
+from django.core.cache import cache
+from django.core.paginator import Paginator
 from django.core.mail import EmailMessage
 from .models import StockMaterialChapa, UsoMaterialChapa
 
@@ -39,18 +45,52 @@ from .models import (
     Presupuesto, LineaPresupuesto, UsoConsumible, AjusteStockConsumible,
     CierreTarjeta, NotaTablon, NotaInternaOrden, DeudaTaller, AmpliacionDeuda, 
     HistorialEstadoOrden, Cita, HistorialIA, ReporteEscaner,
-    Asistencia, AdelantoSueldo, FacturaProveedor, HistorialSueldo
+    Asistencia, AdelantoSueldo, FacturaProveedor, HistorialSueldo, SaldoCuenta, PeriodoConDatos, MovimientoStock, siguiente_numero_factura,
+    consumibles_con_prevision, dias_laborables_mes, recalcular_sueldos, tarifar_sueldos, sueldos_sin_congelar,
+    DuracionFaseOrden, cerrar_tramos_historial
 )
 
 def obtener_dias_laborables_mes(fecha):
-    """Calcula cuántos días de Lunes a Viernes tiene el mes de la fecha dada"""
-    dias_en_mes = calendar.monthrange(fecha.year, fecha.month)[1]
-    dias_laborables = 0
-    for dia in range(1, dias_en_mes + 1):
-        # weekday() devuelve 0 para Lunes, 1 Martes... 4 Viernes.
-        if calendar.weekday(fecha.year, fecha.month, dia) < 5:
-            dias_laborables += 1
-    return Decimal(str(dias_laborables))
+    """Calcula cuántos días laborables (Lunes a Viernes sin festivos) tiene el mes de la fecha dada"""
+    return Decimal(str(dias_laborables_mes(fecha.year, fecha.month)))
+
+def calcular_resumen_nominas():
+    """
+    Foto de la nómina pendiente de TODOS los empleados con un número fijo de consultas agrupadas
+    (empleados, asistencias, fechas, fichajes sin congelar y adelantos). Es SOLO LECTURA: los días que
+    aún no tienen el sueldo congelado se valoran en memoria, pero no se guardan (eso lo hace el cierre).
+    """
+    pendientes = Asistencia.objects.filter(pagado=False, hora_salida__isnull=False)
+    asistencias = {
+        fila['empleado']: fila for fila in pendientes
+        .values('empleado').annotate(dias=Count('fecha', distinct=True), bruto=Sum('sueldo_ganado')).order_by()
+    }
+    fechas = defaultdict(list)
+    for empleado_id, fecha in pendientes.values_list('empleado', 'fecha').distinct().order_by('empleado', 'fecha'):
+        fechas[empleado_id].append(fecha)
+    sin_congelar = defaultdict(Decimal)
+    for asistencia, sueldo in tarifar_sueldos(sueldos_sin_congelar()):
+        sin_congelar[asistencia.empleado_id] += sueldo
+    adelantos = dict(
+        AdelantoSueldo.objects.filter(liquidado=False).values_list('empleado').annotate(total=Sum('importe')).order_by()
+    )
+
+    empleados = []
+    total_deuda = Decimal('0.00')
+    for emp in Empleado.objects.all():
+        fila = asistencias.get(emp.id, {})
+        # Sueldo congelado de cada día + el valor provisional de los días que aún están a 0
+        bruto = (Decimal(fila.get('bruto') or 0) + sin_congelar[emp.id]).quantize(Decimal('0.01'))
+        total_adelantos = Decimal(adelantos.get(emp.id) or 0).quantize(Decimal('0.01'))
+        neto = bruto - total_adelantos
+        if neto > 0:
+            total_deuda += neto
+        empleados.append({
+            'empleado': emp, 'dias': fila.get('dias', 0), 'fechas': fechas[emp.id], 'bruto': bruto,
+            'adelantos': total_adelantos, 'neto': neto
+        })
+
+    return {'empleados': empleados, 'total_deuda': total_deuda}
 
 # ==============================================================
 # --- CANDADO DE SEGURIDAD PARA EL MODO LECTURA (PADRE) ---
@@ -64,52 +104,12 @@ def bloquear_lectura(view_func):
     return _wrapped_view
 
 def get_anos_y_meses_con_datos():
-    fechas_gastos = Gasto.objects.values_list('fecha', flat=True)
-    fechas_ingresos = Ingreso.objects.values_list('fecha', flat=True)
-    fechas_facturas = Factura.objects.values_list('fecha_emision', flat=True)
-    fechas_presupuestos = Presupuesto.objects.values_list('fecha_creacion', flat=True)
-
-    fechas_presupuestos_date = [dt.date() for dt in fechas_presupuestos if dt]
-    fechas_combinadas = set(fechas_gastos) | set(fechas_ingresos) | set(fechas_facturas) | set(fechas_presupuestos_date)
-    fechas_combinadas = {f for f in fechas_combinadas if f is not None}
-    fechas = sorted(list(fechas_combinadas), reverse=True)
-
-    anos_y_meses = {}
-    for fecha in fechas:
-        ano = fecha.year
-        mes = fecha.month
-        if ano not in anos_y_meses:
-            anos_y_meses[ano] = []
-        if mes not in anos_y_meses[ano]:
-            anos_y_meses[ano].append(mes)
-
-    for ano in anos_y_meses:
-        anos_y_meses[ano].sort()
-
-    anos_ordenados = sorted(anos_y_meses.keys(), reverse=True)
-    anos_y_meses_ordenado = {ano: anos_y_meses[ano] for ano in anos_ordenados}
-
-    return anos_y_meses_ordenado
+    # Leemos el catálogo de periodos (mantenido por señales) en vez de cargar todas las fechas
+    return PeriodoConDatos.anos_y_meses()
 
 def obtener_ordenes_relevantes():
-    ordenes_no_entregadas = OrdenDeReparacion.objects.exclude(estado='Entregado')
-    ordenes_entregadas_con_saldo = []
-    ordenes_entregadas = OrdenDeReparacion.objects.filter(estado='Entregado').select_related('factura').prefetch_related('ingreso_set')
-
-    for orden in ordenes_entregadas:
-        try:
-            factura = orden.factura
-            abonos = sum(ing.importe for ing in orden.ingreso_set.all()) if orden.ingreso_set.exists() else Decimal('0.00')
-            pendiente = factura.total_final - abonos
-            if pendiente > Decimal('0.01'):
-                ordenes_entregadas_con_saldo.append(orden.id)
-        except Factura.DoesNotExist:
-            ordenes_entregadas_con_saldo.append(orden.id)
-        except AttributeError:
-             ordenes_entregadas_con_saldo.append(orden.id)
-
-    ids_relevantes = list(ordenes_no_entregadas.values_list('id', flat=True)) + ordenes_entregadas_con_saldo
-    return OrdenDeReparacion.objects.filter(id__in=list(set(ids_relevantes))).select_related('vehiculo', 'cliente')
+    # Abiertas + entregadas con saldo pendiente, calculado en SQL (una sola consulta)
+    return OrdenDeReparacion.objects.relevantes_para_cobro().select_related('vehiculo', 'cliente')
 
 def generar_pdf_response(factura):
     cliente = factura.orden.cliente
@@ -201,23 +201,14 @@ def home(request):
     total_ingresos = ingresos_mes.aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
     total_gastos = gastos_mes.aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
 
-    # --- Balances de Cuentas ---
-    ing_efectivo = Ingreso.objects.filter(metodo_pago='EFECTIVO').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    gas_efectivo = Gasto.objects.filter(metodo_pago='EFECTIVO').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    balance_efectivo = ing_efectivo - gas_efectivo
-
-    ing_taller = Ingreso.objects.filter(metodo_pago='CUENTA_TALLER').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    gas_taller = Gasto.objects.filter(metodo_pago='CUENTA_TALLER').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    balance_taller = ing_taller - gas_taller
+    # --- Balances de Cuentas (tabla de saldos, 1 consulta) ---
+    saldos = SaldoCuenta.saldos()
+    balance_efectivo = saldos['EFECTIVO']
+    balance_taller = saldos['CUENTA_TALLER']
 
     # --- Balances de Tarjetas ---
-    def obtener_disponible_tarjeta(nombre_metodo, limite):
-        ing = Ingreso.objects.filter(metodo_pago=nombre_metodo).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        gas = Gasto.objects.filter(metodo_pago=nombre_metodo).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        return limite + (ing - gas)
-
-    tarjeta_1 = {'disponible': obtener_disponible_tarjeta('TARJETA_1', Decimal('2000.00'))}
-    tarjeta_2 = {'disponible': obtener_disponible_tarjeta('TARJETA_2', Decimal('1000.00'))}
+    tarjeta_1 = {'disponible': Decimal('2000.00') + saldos['TARJETA_1']}
+    tarjeta_2 = {'disponible': Decimal('1000.00') + saldos['TARJETA_2']}
 
     # --- CITAS PARA EL RECORDATORIO DE HOY ---
     citas_hoy = Cita.objects.filter(
@@ -226,41 +217,18 @@ def home(request):
     ).order_by('fecha_hora')
 
     # --- Alertas de Stock ---
-    tipos_consumible = TipoConsumible.objects.all()
     alertas_stock = []
-    for tipo in tipos_consumible:
-        total_comprado = CompraConsumible.objects.filter(tipo=tipo).aggregate(total=Sum('cantidad'))['total'] or Decimal('0.00')
-        total_usado_ordenes = UsoConsumible.objects.filter(tipo=tipo).aggregate(total=Sum('cantidad_usada'))['total'] or Decimal('0.00')
-        total_ajustado = AjusteStockConsumible.objects.filter(tipo=tipo).aggregate(total=Sum('cantidad_ajustada'))['total'] or Decimal('0.00')
-        stock_actual = total_comprado - total_usado_ordenes + total_ajustado
-
-        if tipo.nivel_minimo_stock is not None and stock_actual <= tipo.nivel_minimo_stock:
-            alertas_stock.append({
-                'nombre': tipo.nombre, 'stock_actual': stock_actual,
-                'unidad': tipo.unidad_medida, 'minimo': tipo.nivel_minimo_stock
-            })
+    for tipo in consumibles_con_prevision():
+        if not tipo.reponer: continue
+        prevision = tipo.prevision or {}
+        alertas_stock.append({
+            'nombre': tipo.nombre, 'stock_actual': tipo.stock_actual,
+            'unidad': tipo.unidad_medida, 'minimo': tipo.nivel_minimo_stock,
+            'fecha_agotado': prevision.get('fecha_agotado'), 'cantidad_sugerida': prevision.get('cantidad_sugerida')
+        })
 
     # --- DEUDA DE NÓMINAS PENDIENTES ---
-    total_deuda_nominas = Decimal('0.00')
-    empleados_taller = Empleado.objects.all()
-    for emp in empleados_taller:
-        dias_pendientes = Asistencia.objects.filter(
-            empleado=emp, pagado=False, hora_salida__isnull=False
-        ).values('fecha').distinct().count()
-        
-        # --- CÁLCULO INTELIGENTE ---
-        if emp.es_sueldo_fijo:
-            dias_laborables_mes = obtener_dias_laborables_mes(hoy_date)
-            sueldo_bruto = Decimal(dias_pendientes) * (emp.sueldo_fijo_mensual / dias_laborables_mes)
-        else:
-            sueldo_bruto = dias_pendientes * emp.sueldo_por_dia
-        
-        adelantos_pendientes = AdelantoSueldo.objects.filter(empleado=emp, liquidado=False)
-        total_adelantos = sum(a.importe for a in adelantos_pendientes)
-        
-        neto_a_pagar = sueldo_bruto - total_adelantos
-        if neto_a_pagar > 0:
-            total_deuda_nominas += neto_a_pagar
+    total_deuda_nominas = calcular_resumen_nominas()['total_deuda']
 
     # --- Otros Datos Generales ---
     notas_tablon = NotaTablon.objects.filter(completada=False).order_by('-fecha_creacion')[:20]
@@ -313,9 +281,7 @@ def registrar_pago_tarjeta(request):
         importe_pago = Decimal(request.POST.get('importe_pago', '0'))
         saldo_real_banco = Decimal(request.POST.get('saldo_real_banco', '0'))
         
-        gastos = Gasto.objects.filter(metodo_pago=tarjeta).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        pagos = Ingreso.objects.filter(metodo_pago=tarjeta).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        deuda_app_antes = gastos - pagos
+        deuda_app_antes = -SaldoCuenta.saldos().get(tarjeta, Decimal('0.00'))
         deuda_app_despues = deuda_app_antes - importe_pago
         intereses = saldo_real_banco - deuda_app_despues
         
@@ -647,9 +613,7 @@ def anadir_gasto(request):
                 if tarjeta_destino and saldo_real_str:
                     saldo_real_banco = Decimal(saldo_real_str.replace(',', '.'))
                     
-                    gastos_tarjeta = Gasto.objects.filter(metodo_pago=tarjeta_destino).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-                    abonos_tarjeta = Ingreso.objects.filter(metodo_pago=tarjeta_destino).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-                    deuda_app_antes = gastos_tarjeta - abonos_tarjeta
+                    deuda_app_antes = -SaldoCuenta.saldos().get(tarjeta_destino, Decimal('0.00'))
                     deuda_app_despues = deuda_app_antes - importe_decimal
                     intereses = saldo_real_banco - deuda_app_despues
                     
@@ -1142,6 +1106,14 @@ def editar_presupuesto(request, presupuesto_id):
 # ==========================================
 # --- NUEVA LÓGICA DE LISTA DE ÓRDENES ---
 # ==========================================
+ESTADOS_EN_TALLER = ['Recibido', 'En Diagnostico', 'Esperando Piezas', 'En Reparacion', 'En Pruebas']
+
+def version_tablero_ordenes():
+    """Marca de agua del tablero (una consulta por índice): cambia al crear, guardar o borrar cualquier orden."""
+    datos = OrdenDeReparacion.objects.aggregate(total=Count('id'), ultimo=Max('actualizado'))
+    ultimo = datos['ultimo']
+    return f"{datos['total']}-{int(ultimo.timestamp() * 1000) if ultimo else 0}", ultimo
+
 @login_required
 def lista_ordenes(request):
     if request.method == 'POST':
@@ -1160,23 +1132,43 @@ def lista_ordenes(request):
             orden.save()
         return redirect('lista_ordenes')
 
-    ordenes_activas = OrdenDeReparacion.objects.exclude(estado='Entregado').select_related('vehiculo', 'cliente')
-    
-    ordenes_clientes = ordenes_activas.filter(trabajo_interno=False)
-    flota_interna = ordenes_activas.filter(trabajo_interno=True).order_by('id')
-    
-    ordenes_taller = ordenes_clientes.filter(estado__in=['Recibido', 'En Diagnostico', 'Esperando Piezas', 'En Reparacion', 'En Pruebas']).order_by('id')
-    ordenes_pausadas = ordenes_clientes.filter(estado='Esperando Autorizacion').order_by('id')
-    ordenes_listas = ordenes_clientes.filter(estado='Listo para Recoger').order_by('id')
+    # UNA sola consulta para todo el tablero; las columnas se reparten en memoria
+    pausa_abierta = HistorialEstadoOrden.objects.filter(orden=OuterRef('pk'), es_pausa_jornada=True, fecha_fin__isnull=True)
+    ordenes_activas = list(
+        OrdenDeReparacion.objects.exclude(estado='Entregado').select_related('vehiculo', 'cliente')
+        .annotate(en_pausa_jornada=Exists(pausa_abierta)).order_by('id')
+    )
+
+    columnas = {'taller': [], 'pausadas': [], 'listas': [], 'flota': []}
+    for orden in ordenes_activas:
+        if orden.trabajo_interno: columnas['flota'].append(orden)
+        elif orden.estado in ESTADOS_EN_TALLER: columnas['taller'].append(orden)
+        elif orden.estado == 'Esperando Autorizacion': columnas['pausadas'].append(orden)
+        elif orden.estado == 'Listo para Recoger': columnas['listas'].append(orden)
 
     return render(request, 'taller/lista_ordenes.html', {
-        'ordenes_taller': ordenes_taller,
-        'ordenes_pausadas': ordenes_pausadas,
-        'ordenes_listas': ordenes_listas,
-        'flota_interna': flota_interna,
-        'taller_cerrado': HistorialEstadoOrden.objects.filter(es_pausa_jornada=True, fecha_fin__isnull=True).exists()
+        'ordenes_taller': columnas['taller'],
+        'ordenes_pausadas': columnas['pausadas'],
+        'ordenes_listas': columnas['listas'],
+        'flota_interna': columnas['flota'],
+        'taller_cerrado': any(orden.en_pausa_jornada for orden in ordenes_activas),
+        'version_tablero': version_tablero_ordenes()[0],
     })
 
+@login_required
+def cambios_ordenes(request):
+    """Feed ligero para las tablets: devuelve 304 si ninguna orden ha cambiado desde la versión que ya tienen."""
+    version, ultimo = version_tablero_ordenes()
+    etag = f'"{version}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        respuesta = HttpResponseNotModified()
+    else:
+        respuesta = JsonResponse({'version': version, 'ultimo_cambio': ultimo.isoformat() if ultimo else None})
+    respuesta['ETag'] = etag
+    respuesta['Cache-Control'] = 'private, no-cache'
+    if ultimo: respuesta['Last-Modified'] = http_date(ultimo.timestamp())
+    return respuesta
+
 @login_required
 def detalle_orden(request, orden_id):
     orden = get_object_or_404(OrdenDeReparacion.objects.select_related('cliente', 'vehiculo', 'presupuesto_origen').prefetch_related('fotos', 'ingreso_set', 'gastos', 'factura', 'notas_internas'), id=orden_id)
@@ -1194,8 +1186,7 @@ def detalle_orden(request, orden_id):
     # ==============================================================
     # --- ENLACE MÁGICO DEL ESTADO DEL COCHE PARA WHATSAPP ---
     # ==============================================================
-    signer = Signer()
-    signed_orden_id = signer.sign(orden.id)
+    signed_orden_id = firmar_enlace_estado(orden.id)
     url_estado_publico = request.build_absolute_uri(reverse('estado_vehiculo_publico', args=[signed_orden_id]))
     
     whatsapp_estado_url = None
@@ -1327,26 +1318,49 @@ def detalle_orden(request, orden_id):
             porcentaje_str = request.POST.get('porcentaje_usar', '0')
             if lote_id and porcentaje_str:
                 try:
-                    lote = StockMaterialChapa.objects.get(id=lote_id)
                     porcentaje = Decimal(porcentaje_str.replace(',', '.'))
                     if porcentaje > 0:
-                        # Hacemos la matemática de los euros
-                        importe_usar = (lote.importe_total * (porcentaje / Decimal('100'))).quantize(Decimal('0.01'))
-                        if importe_usar <= lote.importe_disponible:
-                            UsoMaterialChapa.objects.create(
-                                lote=lote,
-                                orden=orden,
-                                importe_usado=importe_usar,
-                                fecha_uso=timezone.now().date(),
-                                notas=f"Uso del {porcentaje}% ({request.user.username})"
-                            )
-                            messages.success(request, f"Se han asignado {importe_usar}€ de pintura al vehículo.")
-                        else:
-                            messages.error(request, "El importe supera el saldo disponible del bote.")
+                        with transaction.atomic():
+                            # Bloqueamos el bote: otro chapista no puede gastar el mismo saldo a la vez
+                            lote = StockMaterialChapa.objects.select_for_update().get(id=lote_id)
+                            # Hacemos la matemática de los euros
+                            importe_usar = (lote.importe_total * (porcentaje / Decimal('100'))).quantize(Decimal('0.01'))
+                            if importe_usar <= lote.importe_disponible:
+                                UsoMaterialChapa.objects.create(
+                                    lote=lote,
+                                    orden=orden,
+                                    importe_usado=importe_usar,
+                                    fecha_uso=timezone.now().date(),
+                                    notas=f"Uso del {porcentaje}% ({request.user.username})"
+                                )
+                                messages.success(request, f"Se han asignado {importe_usar}€ de pintura al vehículo.")
+                            else:
+                                messages.error(request, "El importe supera el saldo disponible del bote.")
                 except (ValueError, TypeError, Decimal.InvalidOperation, StockMaterialChapa.DoesNotExist):
                     pass
             return redirect('detalle_orden', orden_id=orden.id)
 
+        # 🟢 NUEVO: REPARTO AUTOMÁTICO (FIFO) ENTRE BOTES: por euros o por % del saldo de una familia
+        elif form_type == 'repartir_stock_chapa':
+            familia = (request.POST.get('familia') or '').strip()
+            importe_str = (request.POST.get('importe_repartir') or '').replace(',', '.')
+            porcentaje_str = (request.POST.get('porcentaje_familia') or '').replace(',', '.')
+            try:
+                if importe_str:
+                    importe_usar = Decimal(importe_str)
+                    detalle = f"{importe_usar}€"
+                else:
+                    porcentaje = Decimal(porcentaje_str)
+                    importe_usar = (StockMaterialChapa.disponible_familia(familia) * porcentaje / Decimal('100')).quantize(Decimal('0.01'))
+                    detalle = f"{porcentaje}% de {familia or 'todo el material'}"
+                usos = StockMaterialChapa.repartir_fifo(orden, importe_usar, familia=familia or None, notas=f"Reparto automático {detalle} ({request.user.username})")
+                messages.success(request, f"Se han asignado {importe_usar}€ de material repartidos en {len(usos)} bote(s).")
+            except (TypeError, InvalidOperation):
+                messages.error(request, "Indica un importe o un porcentaje válido.")
+            except ValueError as e:
+                messages.error(request, str(e))
+            return redirect('detalle_orden', orden_id=orden.id)
+
         # 🟢 NUEVO: LÓGICA PARA BORRAR UN USO DE CHAPA
         elif form_type == 'eliminar_uso_chapa':
             uso_id = request.POST.get('uso_id')
@@ -1363,19 +1377,19 @@ def detalle_orden(request, orden_id):
     deudas_pendientes = [d for d in DeudaTaller.objects.all() if d.estado == 'Pendiente']
 
     # 🟢 SEPARAMOS EL MONEDERO EN "COMPRADO PARA ESTE COCHE" Y "RESTO DEL TALLER"
-    lotes_chapa_db = StockMaterialChapa.objects.all().order_by('fecha_registro')
+    # Solo los botes con saldo, filtrados en la BD (los agotados ni se cargan)
+    lotes_chapa_db = StockMaterialChapa.objects.con_saldo().select_related('gasto_original').order_by('fecha_registro')
     lotes_con_saldo = []
     lotes_especificos = []
     lotes_generales = []
     
     for l in lotes_chapa_db:
-        if l.importe_disponible > 0:
-            l.saldo_real = l.importe_disponible
-            lotes_con_saldo.append(l)
-            if l.gasto_original and l.gasto_original.orden == orden:
-                lotes_especificos.append(l)
-            else:
-                lotes_generales.append(l)
+        l.saldo_real = l.importe_disponible
+        lotes_con_saldo.append(l)
+        if l.gasto_original and l.gasto_original.orden_id == orden.id:
+            lotes_especificos.append(l)
+        else:
+            lotes_generales.append(l)
 
     context = {
         'orden': orden, 'repuestos': repuestos, 'gastos_otros': gastos_otros, 'factura': factura,
@@ -1410,7 +1424,7 @@ def generar_factura(request, orden_id):
         notas = request.POST.get('notas_cliente', '')
 
         with transaction.atomic():
-            AdelantoSueldo.objects.filter(motivo__icontains=f"(Orden #{orden.id})").delete()
+            orden.comisiones.all().delete()
             
             factura = Factura.objects.filter(orden=orden).first()
             
@@ -1418,60 +1432,62 @@ def generar_factura(request, orden_id):
                 factura.es_factura = es_factura
                 factura.notas_cliente = notas
                 if es_factura and not factura.numero_factura:
-                    ultima_factura = Factura.objects.select_for_update().filter(numero_factura__isnull=False).order_by('-numero_factura').first()
-                    factura.numero_factura = (ultima_factura.numero_factura + 1) if (ultima_factura and ultima_factura.numero_factura) else 1
+                    factura.numero_factura = siguiente_numero_factura()
                 
                 factura.lineas.all().delete()
                 UsoConsumible.objects.filter(orden=orden).delete()
             else:
                 nuevo_numero_factura = None
                 if es_factura:
-                    ultima_factura = Factura.objects.select_for_update().filter(numero_factura__isnull=False).order_by('-numero_factura').first()
-                    nuevo_numero_factura = (ultima_factura.numero_factura + 1) if (ultima_factura and ultima_factura.numero_factura) else 1
+                    nuevo_numero_factura = siguiente_numero_factura()
                 
                 factura = Factura.objects.create(orden=orden, es_factura=es_factura, notas_cliente=notas, numero_factura=nuevo_numero_factura)
             
+            # --- 1. RECOGEMOS TODO EN MEMORIA (sin tocar la BD línea a línea) ---
             subtotal = Decimal('0.00')
-            repuestos_qs = Gasto.objects.filter(orden=orden, categoria='Repuestos')
-            gastos_otros_qs = Gasto.objects.filter(orden=orden, categoria='Otros')
-            
-            for repuesto in repuestos_qs:
-                pvp_str = request.POST.get(f'pvp_repuesto_{repuesto.id}')
-                if pvp_str:
-                    try:
-                        pvp = Decimal(pvp_str); coste_repuesto = repuesto.importe or Decimal('0.00')
-                        if pvp < coste_repuesto: pvp = coste_repuesto
-                        subtotal += pvp; LineaFactura.objects.create(factura=factura, tipo='Repuesto', descripcion=repuesto.descripcion, cantidad=1, precio_unitario=pvp)
-                    except: pass
+            lineas_nuevas = []; usos_nuevos = []; comisiones_nuevas = []
+            gastos_orden = Gasto.objects.filter(orden=orden, categoria__in=['Repuestos', 'Otros'])
             
-            for gasto_otro in gastos_otros_qs:
-                pvp_str = request.POST.get(f'pvp_otro_{gasto_otro.id}')
+            for gasto in sorted(gastos_orden, key=lambda g: g.categoria != 'Repuestos'):
+                prefijo, tipo_linea = ('pvp_repuesto', 'Repuesto') if gasto.categoria == 'Repuestos' else ('pvp_otro', 'Externo')
+                pvp_str = request.POST.get(f'{prefijo}_{gasto.id}')
                 if pvp_str:
                     try:
-                        pvp = Decimal(pvp_str); coste_gasto = gasto_otro.importe or Decimal('0.00')
+                        pvp = Decimal(pvp_str); coste_gasto = gasto.importe or Decimal('0.00')
                         if pvp < coste_gasto: pvp = coste_gasto
-                        subtotal += pvp; LineaFactura.objects.create(factura=factura, tipo='Externo', descripcion=gasto_otro.descripcion, cantidad=1, precio_unitario=pvp)
+                        subtotal += pvp; lineas_nuevas.append(LineaFactura(factura=factura, tipo=tipo_linea, descripcion=(gasto.descripcion or '').upper(), cantidad=1, precio_unitario=pvp, gasto_origen=gasto))
                     except: pass
             
             tipos_consumible_id = request.POST.getlist('tipo_consumible'); cantidades_consumible = request.POST.getlist('consumible_cantidad'); pvps_consumible = request.POST.getlist('consumible_pvp_total')
+            # Un solo SELECT para todos los consumibles de la factura
+            tipos_por_id = TipoConsumible.objects.in_bulk([int(t) for t in tipos_consumible_id if t and t.isdigit()])
+            consumido_en_factura = defaultdict(lambda: Decimal('0.00'))
             for i in range(len(tipos_consumible_id)):
                 if tipos_consumible_id[i] and cantidades_consumible[i] and pvps_consumible[i]:
                     try:
-                        tipo = TipoConsumible.objects.get(id=tipos_consumible_id[i]); cantidad = Decimal(cantidades_consumible[i]); pvp_total = Decimal(pvps_consumible[i])
+                        tipo = tipos_por_id.get(int(tipos_consumible_id[i]))
+                        if tipo is None: continue
+                        cantidad = Decimal(cantidades_consumible[i]); pvp_total = Decimal(pvps_consumible[i])
                         if cantidad <= 0 or pvp_total < 0: continue
                         precio_unitario_calculado = (pvp_total / cantidad).quantize(Decimal('0.01')); subtotal += pvp_total
-                        LineaFactura.objects.create(factura=factura, tipo='Consumible', descripcion=tipo.nombre, cantidad=cantidad, precio_unitario=precio_unitario_calculado)
-                        UsoConsumible.objects.create(orden=orden, tipo=tipo, cantidad_usada=cantidad)
+                        lineas_nuevas.append(LineaFactura(factura=factura, tipo='Consumible', descripcion=tipo.nombre.upper(), cantidad=cantidad, precio_unitario=precio_unitario_calculado, tipo_consumible=tipo))
+                        # El coste se congela ahora (bulk_create no pasa por UsoConsumible.save)
+                        uso = UsoConsumible(orden=orden, tipo=tipo, cantidad_usada=cantidad)
+                        uso.asignar_coste(excluir_orden=orden, consumido_adicional=consumido_en_factura[tipo.id])
+                        consumido_en_factura[tipo.id] += cantidad; usos_nuevos.append(uso)
                     except: pass
             
             # --- MAGIA DEL 60/40 CON INVENTARIO DE CHAPA ---
             descripciones_mo = request.POST.getlist('mano_obra_desc')
             importes_mo = request.POST.getlist('mano_obra_importe')
             mecanicos_mo = request.POST.getlist('mano_obra_mecanico')
+            # Un solo SELECT para todos los mecánicos de la factura
+            empleados_por_id = Empleado.objects.in_bulk([int(m) for m in mecanicos_mo if m and m.isdigit()])
 
             # 🟢 NUEVO: Obtenemos el total de pintura usada en este coche del monedero
             total_chapa = orden.materiales_chapa_usados.aggregate(total=Sum('importe_usado'))['total'] or Decimal('0.00')
             material_restante_por_descontar = total_chapa
+            hoy = timezone.now().date()
 
             for desc, importe_str, mecanico_id in zip(descripciones_mo, importes_mo, mecanicos_mo):
                 if desc and importe_str:
@@ -1481,37 +1497,37 @@ def generar_factura(request, orden_id):
                         subtotal += importe
                         
                         # 1. Metemos el 100% del importe en la factura para el cliente
-                        LineaFactura.objects.create(factura=factura, tipo='Mano de Obra', descripcion=desc.upper(), cantidad=1, precio_unitario=importe)
+                        linea_mo = LineaFactura(factura=factura, tipo='Mano de Obra', descripcion=desc.upper(), cantidad=1, precio_unitario=importe)
+                        lineas_nuevas.append(linea_mo)
                         
                         # 2. Si hay un mecánico asignado, calculamos su 60%
-                        if mecanico_id:
-                            try:
-                                emp_comision = Empleado.objects.get(id=mecanico_id)
-                                base_comision = importe
-                                notas_adicionales = ""
-
-                                # 🟢 NUEVO: Si es chapista y hay material por descontar, se lo restamos a SU base
-                                if emp_comision.es_chapista and material_restante_por_descontar > 0:
-                                    descuento_aplicado = min(base_comision, material_restante_por_descontar)
-                                    base_comision -= descuento_aplicado
-                                    material_restante_por_descontar -= descuento_aplicado
-                                    notas_adicionales = f" (-{descuento_aplicado}€ de Material)"
+                        emp_comision = empleados_por_id.get(int(mecanico_id)) if mecanico_id and mecanico_id.isdigit() else None
+                        if emp_comision:
+                            base_comision = importe
+                            notas_adicionales = ""
+
+                            # 🟢 NUEVO: Si es chapista y hay material por descontar, se lo restamos a SU base
+                            if emp_comision.es_chapista and material_restante_por_descontar > 0:
+                                descuento_aplicado = min(base_comision, material_restante_por_descontar)
+                                base_comision -= descuento_aplicado
+                                material_restante_por_descontar -= descuento_aplicado
+                                notas_adicionales = f" (-{descuento_aplicado}€ de Material)"
+                            
+                            # Si la base queda en 0 o menos, no hay comisión
+                            if base_comision > 0:
+                                comision = (base_comision * Decimal('0.60')).quantize(Decimal('0.01'))
                                 
-                                # Si la base queda en 0 o menos, no hay comisión
-                                if base_comision > 0:
-                                    comision = (base_comision * Decimal('0.60')).quantize(Decimal('0.01'))
-                                    
-                                    AdelantoSueldo.objects.create(
-                                        empleado=emp_comision,
-                                        importe=-comision, 
-                                        motivo=f"🟢 COMISIÓN 60% (Orden #{orden.id}): {desc.upper()[:20]}{notas_adicionales}",
-                                        fecha=timezone.now().date(),
-                                        liquidado=False
-                                    )
-                            except Empleado.DoesNotExist:
-                                pass
-                    except Exception as e: 
-                        print(f"Error al procesar mano de obra: {e}")
+                                comisiones_nuevas.append(AdelantoSueldo(
+                                    empleado=emp_comision,
+                                    importe=-comision, 
+                                    motivo=f"🟢 COMISIÓN 60% (Orden #{orden.id}): {desc.upper()[:20]}{notas_adicionales}",
+                                    fecha=hoy,
+                                    liquidado=False,
+                                    orden=orden,
+                                    linea_factura=linea_mo
+                                ))
+                    except (InvalidOperation, ValueError):
+                        messages.error(request, f"Mano de obra '{desc.upper()}': importe no válido ({importe_str}), no se ha facturado.")
 
             descripciones_grua = request.POST.getlist('grua_desc')
             importes_grua = request.POST.getlist('grua_importe')
@@ -1521,8 +1537,14 @@ def generar_factura(request, orden_id):
                         importe = Decimal(importe_str)
                         if importe <= 0: continue
                         subtotal += importe
-                        LineaFactura.objects.create(factura=factura, tipo='Grúa', descripcion=desc.upper(), cantidad=1, precio_unitario=importe)
+                        lineas_nuevas.append(LineaFactura(factura=factura, tipo='Grúa', descripcion=desc.upper(), cantidad=1, precio_unitario=importe))
                     except: pass
+
+            # --- 2. GUARDAMOS DE GOLPE: un INSERT por modelo (las líneas primero, las comisiones apuntan a ellas) ---
+            LineaFactura.objects.bulk_create(lineas_nuevas)
+            UsoConsumible.objects.bulk_create(usos_nuevos)
+            MovimientoStock.apuntar_usos(usos_nuevos)
+            AdelantoSueldo.objects.bulk_create(comisiones_nuevas)
             
             iva_calculado = Decimal('0.00'); subtotal_positivo = max(subtotal, Decimal('0.00'))
             if es_factura: iva_calculado = (subtotal_positivo * Decimal('0.21')).quantize(Decimal('0.01'))
@@ -1586,14 +1608,11 @@ def editar_factura(request, factura_id):
         }
         
         if linea.tipo == 'Consumible':
-            tipo_obj = TipoConsumible.objects.filter(nombre__iexact=linea.descripcion).first()
-            linea_data['tipo_consumible_id'] = tipo_obj.id if tipo_obj else None
+            linea_data['tipo_consumible_id'] = linea.tipo_consumible_id
         elif linea.tipo == 'Repuesto':
-            gasto_obj = repuestos_qs.filter(descripcion__iexact=linea.descripcion).first()
-            linea_data['repuesto_id'] = gasto_obj.id if gasto_obj else None
+            linea_data['repuesto_id'] = linea.gasto_origen_id
         elif linea.tipo == 'Externo':
-            gasto_obj = gastos_otros_qs.filter(descripcion__iexact=linea.descripcion).first()
-            linea_data['externo_id'] = gasto_obj.id if gasto_obj else None
+            linea_data['externo_id'] = linea.gasto_origen_id
             
         elif linea.tipo == 'Grúa':
             linea_data['tipo'] = 'Grúa'
@@ -1612,6 +1631,57 @@ def editar_factura(request, factura_id):
     return render(request, 'taller/editar_factura.html', context)
 
 
+def calcular_rentabilidad_facturas(facturas_qs):
+    """Rentabilidad por factura con consultas agrupadas (no por factura): {factura_id: {...}}"""
+    facturas = list(facturas_qs)
+    ids_ordenes = facturas_qs.values('orden_id')
+    cero = Decimal('0.00')
+
+    # 1. Coste de repuestos y trabajos externos por orden
+    costes = defaultdict(lambda: cero)
+    for fila in Gasto.objects.filter(orden_id__in=ids_ordenes, categoria__in=['Repuestos', 'Otros']).values('orden_id', 'categoria').annotate(total=Sum('importe')).order_by():
+        costes[(fila['orden_id'], fila['categoria'])] = Decimal(fila['total'] or 0).quantize(Decimal('0.01'))
+
+    # 2. PVP por tipo de línea (total_linea = cantidad * precio)
+    pvp = defaultdict(lambda: cero)
+    for fila in LineaFactura.objects.filter(factura__in=facturas_qs.values('id')).values('factura_id', 'tipo').annotate(total=Sum(F('cantidad') * F('precio_unitario'))).order_by():
+        pvp[(fila['factura_id'], fila['tipo'])] = Decimal(fila['total'] or 0).quantize(Decimal('0.0001'))
+
+    # 3. Coste de consumibles: ya viene congelado en cada UsoConsumible
+    costes_consumibles = defaultdict(lambda: cero)
+    for fila in UsoConsumible.objects.filter(orden_id__in=ids_ordenes).values('orden_id').annotate(total=Sum('coste_total')).order_by():
+        costes_consumibles[fila['orden_id']] = Decimal(fila['total'] or 0).quantize(Decimal('0.0001'))
+
+    # 4. Comisiones de los mecánicos (negativas) y órdenes cobradas por compensación
+    comisiones = defaultdict(lambda: cero)
+    for fila in AdelantoSueldo.objects.filter(orden_id__in=ids_ordenes).values('orden_id').annotate(total=Sum('importe')).order_by():
+        comisiones[fila['orden_id']] = Decimal(fila['total'] or 0).quantize(Decimal('0.01'))
+    ordenes_compensadas = set(Ingreso.objects.filter(orden_id__in=ids_ordenes, metodo_pago='COMPENSACION').values_list('orden_id', flat=True))
+
+    resultado = {}
+    for factura in facturas:
+        orden_id = factura.orden_id
+        if not orden_id: continue
+
+        coste_consumibles_factura = costes_consumibles[orden_id]
+
+        pvp_mo = pvp[(factura.id, 'Mano de Obra')]
+        pvp_piezas = pvp[(factura.id, 'Repuesto')] + pvp[(factura.id, 'Consumible')] + pvp[(factura.id, 'Externo')]
+        coste_total_piezas = costes[(orden_id, 'Repuestos')] + costes[(orden_id, 'Otros')] + coste_consumibles_factura
+
+        ganancia_piezas_orden = pvp_piezas - coste_total_piezas
+        # Como la comisión está en negativo (-60€), al "sumarla" al PVP hace una resta real
+        ganancia_mo_real = pvp_mo + comisiones[orden_id]
+
+        resultado[factura.id] = {
+            'ganancia_mo': ganancia_mo_real,
+            'ganancia_piezas': ganancia_piezas_orden,
+            'grua_facturada': pvp[(factura.id, 'Grúa')],
+            'ganancia_total_taller': ganancia_mo_real + ganancia_piezas_orden,
+            'es_compensado': orden_id in ordenes_compensadas,
+        }
+    return resultado
+
 @login_required
 def informe_rentabilidad(request):
     if not request.user.is_superuser:
@@ -1628,7 +1698,7 @@ def informe_rentabilidad(request):
     ano_seleccionado = request.GET.get('ano')
     mes_seleccionado = request.GET.get('mes')
 
-    facturas_qs = Factura.objects.select_related('orden__vehiculo').prefetch_related('lineas')
+    facturas_qs = Factura.objects.select_related('orden__vehiculo', 'orden__cliente')
     ingresos_grua_qs = Ingreso.objects.filter(categoria='Grua')
     otras_ganancias_qs = Ingreso.objects.filter(categoria='Otras Ganancias')
 
@@ -1661,67 +1731,23 @@ def informe_rentabilidad(request):
     ganancia_grua_facturada = Decimal('0.00')
     reporte = []
     
-    compras_consumibles = CompraConsumible.objects.order_by('tipo_id', '-fecha_compra')
-    ultimas_compras_por_tipo = {}
-    for compra in compras_consumibles:
-        if compra.tipo_id not in ultimas_compras_por_tipo:
-            ultimas_compras_por_tipo[compra.tipo_id] = compra
-    tipos_consumible_dict = {tipo.nombre.upper(): tipo for tipo in TipoConsumible.objects.all()}
-    
+    rentabilidad = calcular_rentabilidad_facturas(facturas)
     for factura in facturas:
-        orden = factura.orden
-        if not orden: continue 
-        
-        gastos_orden_qs = Gasto.objects.filter(orden=orden)
-        coste_repuestos = gastos_orden_qs.filter(categoria='Repuestos').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        coste_externos = gastos_orden_qs.filter(categoria='Otros').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        coste_consumibles_factura = Decimal('0.00')
-        
-        pvp_mo = Decimal('0.00')
-        pvp_piezas = Decimal('0.00')
-        grua_en_esta_factura = Decimal('0.00')
-        
-        for linea in factura.lineas.all():
-            if linea.tipo == 'Mano de Obra':
-                pvp_mo += linea.total_linea
-            elif linea.tipo == 'Grúa':
-                grua_en_esta_factura += linea.total_linea
-                ganancia_grua_facturada += linea.total_linea
-            elif linea.tipo in ['Repuesto', 'Consumible', 'Externo']:
-                pvp_piezas += linea.total_linea
-                if linea.tipo == 'Consumible':
-                    tipo_obj = tipos_consumible_dict.get(linea.descripcion.upper())
-                    if tipo_obj and tipo_obj.id in ultimas_compras_por_tipo:
-                        compra_relevante = ultimas_compras_por_tipo[tipo_obj.id]
-                        if compra_relevante.fecha_compra <= factura.fecha_emision:
-                            coste_consumibles_factura += (compra_relevante.coste_por_unidad or Decimal('0.00')) * linea.cantidad
-        
-        coste_total_piezas = coste_repuestos + coste_externos + coste_consumibles_factura
-        ganancia_piezas_orden = pvp_piezas - coste_total_piezas
-        
-        # 🟢 MAGIA DE COMISIONES AQUÍ 🟢
-        # Sumamos las comisiones pagadas a los mecánicos (Como la comisión está en negativo -60€, al "sumarla" al PVP, hace una resta real)
-        comisiones_empleados = AdelantoSueldo.objects.filter(motivo__icontains=f"(Orden #{orden.id})").aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        
-        # Ganancia limpia de mano de obra para el taller
-        ganancia_mo_real = pvp_mo + comisiones_empleados
-        
-        ganancia_total_taller = ganancia_mo_real + ganancia_piezas_orden
-        
-        total_ganancia_mo += ganancia_mo_real
-        total_ganancia_piezas += ganancia_piezas_orden
-        
-        metodos = list(orden.ingreso_set.values_list('metodo_pago', flat=True))
-        es_compensado = 'COMPENSACION' in metodos
+        datos = rentabilidad.get(factura.id)
+        if datos is None: continue
+
+        total_ganancia_mo += datos['ganancia_mo']
+        total_ganancia_piezas += datos['ganancia_piezas']
+        ganancia_grua_facturada += datos['grua_facturada']
 
         reporte.append({ 
-            'orden': orden, 
+            'orden': factura.orden, 
             'factura': factura, 
-            'ganancia_mo': ganancia_mo_real,
-            'ganancia_piezas': ganancia_piezas_orden,
-            'grua_facturada': grua_en_esta_factura,
-            'ganancia_total_taller': ganancia_total_taller,
-            'es_compensado': es_compensado 
+            'ganancia_mo': datos['ganancia_mo'],
+            'ganancia_piezas': datos['ganancia_piezas'],
+            'grua_facturada': datos['grua_facturada'],
+            'ganancia_total_taller': datos['ganancia_total_taller'],
+            'es_compensado': datos['es_compensado'] 
         })
     
     ganancia_grua_directa = ingresos_grua.aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
@@ -1758,7 +1784,7 @@ def detalle_ganancia_orden(request, orden_id):
 
     orden = get_object_or_404(OrdenDeReparacion.objects.select_related('vehiculo', 'cliente'), id=orden_id)
     try: 
-        factura = Factura.objects.prefetch_related('lineas', 'orden__ingreso_set').get(orden=orden)
+        factura = Factura.objects.prefetch_related(Prefetch('lineas', queryset=LineaFactura.objects.select_related('gasto_origen')), 'orden__ingreso_set').get(orden=orden)
     except Factura.DoesNotExist: 
         return redirect('detalle_orden', orden_id=orden.id)
     
@@ -1766,14 +1792,8 @@ def detalle_ganancia_orden(request, orden_id):
     gastos_usados_ids = set()
     
     gastos_asociados = Gasto.objects.filter(orden=orden, categoria__in=['Repuestos', 'Otros']).order_by('id')
-    compras_consumibles = CompraConsumible.objects.filter(fecha_compra__lte=factura.fecha_emision).order_by('tipo_id', '-fecha_compra')
-    
-    ultimas_compras_por_tipo = {}
-    for compra in compras_consumibles:
-        if compra.tipo_id not in ultimas_compras_por_tipo: 
-            ultimas_compras_por_tipo[compra.tipo_id] = compra
-            
-    tipos_consumible_dict = {tipo.nombre.upper(): tipo for tipo in TipoConsumible.objects.all()}
+    # Coste unitario congelado de cada consumible gastado en la orden
+    costes_uso_por_tipo = {uso.tipo_id: uso.coste_unitario for uso in UsoConsumible.objects.filter(orden=orden, coste_unitario__isnull=False)}
     
     total_mo_facturada = Decimal('0.00')
 
@@ -1799,20 +1819,14 @@ def detalle_ganancia_orden(request, orden_id):
         desglose_agrupado[key]['pvp'] += pvp_linea
         
         if linea.tipo in ['Repuesto', 'Externo']:
-            categoria_gasto = 'Repuestos' if linea.tipo == 'Repuesto' else 'Otros'
-            gasto_encontrado = None
-            for gasto in gastos_asociados:
-                if (gasto.id not in gastos_usados_ids and gasto.categoria == categoria_gasto and gasto.descripcion.strip().upper() == descripcion_limpia): 
-                    gasto_encontrado = gasto
-                    break
-            if gasto_encontrado: 
-                coste_linea = gasto_encontrado.importe or Decimal('0.00')
-                gastos_usados_ids.add(gasto_encontrado.id)
+            # El gasto de origen viene enlazado desde generar_factura
+            if linea.gasto_origen and linea.gasto_origen_id not in gastos_usados_ids: 
+                coste_linea = linea.gasto_origen.importe or Decimal('0.00')
+                gastos_usados_ids.add(linea.gasto_origen_id)
                 
         elif linea.tipo == 'Consumible':
-            tipo_obj = tipos_consumible_dict.get(descripcion_limpia)
-            if tipo_obj and tipo_obj.id in ultimas_compras_por_tipo: 
-                coste_unitario = ultimas_compras_por_tipo[tipo_obj.id].coste_por_unidad or Decimal('0.00')
+            if linea.tipo_consumible_id in costes_uso_por_tipo: 
+                coste_unitario = costes_uso_por_tipo[linea.tipo_consumible_id]
                 coste_linea = coste_unitario * linea.cantidad
                 
         desglose_agrupado[key]['coste'] += coste_linea
@@ -1837,7 +1851,7 @@ def detalle_ganancia_orden(request, orden_id):
 
     resumen_comisiones = []
     total_comisiones = Decimal('0.00')
-    comisiones_db = AdelantoSueldo.objects.filter(motivo__icontains=f"(Orden #{orden.id})")
+    comisiones_db = orden.comisiones.select_related('empleado')
     
     for com in comisiones_db:
         coste_comision = abs(com.importe)
@@ -1899,6 +1913,75 @@ def detalle_ganancia_orden(request, orden_id):
     }
     return render(request, 'taller/detalle_ganancia_orden.html', context)
 
+def formatear_duracion(segs):
+    # Igual que formatear_segundos, pero pasando a días cuando la espera es larga
+    dias = int(segs // 86400)
+    return f"{dias}d {int((segs % 86400) // 3600)}h" if dias else formatear_segundos(segs)
+
+def _estadisticas_fase(segundos):
+    """Media, mediana y percentil 90 (por rango) de los tiempos de cada orden en una fase."""
+    valores = sorted(segundos)
+    n = len(valores)
+    return {
+        'ordenes': n,
+        'media': formatear_duracion(sum(valores) / n),
+        'mediana': formatear_duracion(statistics.median(valores)),
+        'p90': formatear_duracion(valores[math.ceil(0.9 * n) - 1]),
+        'media_segundos': sum(valores) / n,
+    }
+
+@login_required
+def informe_fases(request):
+    """¿Dónde esperan más los coches? Tiempo de trabajo por fase (sin pausas de jornada), por mes y por mecánico."""
+    if not request.user.is_superuser:
+        return redirect('home')
+
+    hoy = timezone.now().date()
+    try: ano_seleccionado = int(request.GET.get('ano', hoy.year))
+    except (ValueError, TypeError): ano_seleccionado = hoy.year
+    try: mes_seleccionado = int(request.GET.get('mes') or 0)
+    except (ValueError, TypeError): mes_seleccionado = 0
+
+    duraciones = DuracionFaseOrden.objects.filter(mes__year=ano_seleccionado)
+    if 1 <= mes_seleccionado <= 12: duraciones = duraciones.filter(mes__month=mes_seleccionado)
+    else: mes_seleccionado = None
+
+    # Tiempo de cada orden en cada fase: en todo el periodo y dentro de cada mes
+    por_orden = defaultdict(int)
+    por_mes = defaultdict(list)
+    for orden_id, estado, mes, segundos in duraciones.values_list('orden_id', 'estado', 'mes', 'segundos'):
+        por_orden[(orden_id, estado)] += segundos
+        por_mes[(mes, estado)].append(segundos)
+
+    # El mecánico de una orden es el que cobra comisión por su mano de obra (generar_factura)
+    mecanicos = defaultdict(set)
+    for orden_id, nombre in AdelantoSueldo.objects.filter(
+        orden_id__in={orden_id for orden_id, _ in por_orden}
+    ).values_list('orden_id', 'empleado__nombre').distinct():
+        mecanicos[orden_id].add(nombre)
+
+    por_estado = defaultdict(list)
+    por_mecanico = defaultdict(list)
+    for (orden_id, estado), segundos in por_orden.items():
+        por_estado[estado].append(segundos)
+        for nombre in mecanicos.get(orden_id) or ['Sin asignar']:
+            por_mecanico[(nombre, estado)].append(segundos)
+
+    # Las fases más lentas primero
+    resumen_estados = sorted(
+        [dict(_estadisticas_fase(valores), estado=estado) for estado, valores in por_estado.items()],
+        key=lambda fila: fila['media_segundos'], reverse=True
+    )
+    resumen_meses = [dict(_estadisticas_fase(por_mes[clave]), mes=clave[0], estado=clave[1]) for clave in sorted(por_mes, reverse=True)]
+    resumen_mecanicos = [dict(_estadisticas_fase(por_mecanico[clave]), mecanico=clave[0], estado=clave[1]) for clave in sorted(por_mecanico)]
+
+    context = {
+        'resumen_estados': resumen_estados, 'resumen_meses': resumen_meses, 'resumen_mecanicos': resumen_mecanicos,
+        'ano_seleccionado': ano_seleccionado, 'mes_seleccionado': mes_seleccionado,
+        'anos_disponibles': list(range(2024, hoy.year + 1)), 'meses_del_ano': range(1, 13),
+    }
+    return render(request, 'taller/informe_fases.html', context)
+
 @login_required
 def informe_gastos(request):
     if not request.user.is_superuser:
@@ -2051,15 +2134,9 @@ def contabilidad(request):
     total_gastado = gastos_qs.aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
     total_ganancia = total_ingresado - total_gastado
     
-    gastos_totales_t1 = Gasto.objects.filter(metodo_pago='TARJETA_1').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    abonos_totales_t1 = Ingreso.objects.filter(metodo_pago='TARJETA_1').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    deuda_t1 = gastos_totales_t1 - abonos_totales_t1
-    disponible_t1 = Decimal('2000.00') - deuda_t1
-
-    gastos_totales_t2 = Gasto.objects.filter(metodo_pago='TARJETA_2').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    abonos_totales_t2 = Ingreso.objects.filter(metodo_pago='TARJETA_2').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    deuda_t2 = gastos_totales_t2 - abonos_totales_t2
-    disponible_t2 = Decimal('1000.00') - deuda_t2
+    saldos = SaldoCuenta.saldos()
+    disponible_t1 = Decimal('2000.00') + saldos['TARJETA_1']
+    disponible_t2 = Decimal('1000.00') + saldos['TARJETA_2']
 
     context = { 
         'total_ingresado': total_ingresado, 'total_gastado': total_gastado, 'total_ganancia': total_ganancia, 
@@ -2078,7 +2155,7 @@ def cuentas_por_cobrar(request):
     anos_y_meses_data = get_anos_y_meses_con_datos(); anos_disponibles = sorted(anos_y_meses_data.keys(), reverse=True)
     ano_seleccionado = request.GET.get('ano'); mes_seleccionado = request.GET.get('mes')
     
-    facturas_qs = Factura.objects.select_related('orden__cliente', 'orden__vehiculo').prefetch_related('orden__ingreso_set')
+    facturas_qs = Factura.objects.pendientes_de_cobro().select_related('orden__cliente', 'orden__vehiculo')
     
     if ano_seleccionado:
         try: facturas_qs = facturas_qs.filter(fecha_emision__year=int(ano_seleccionado))
@@ -2092,12 +2169,9 @@ def cuentas_por_cobrar(request):
         
     facturas_pendientes = []; total_pendiente = Decimal('0.00')
     for factura in facturas_qs.order_by('fecha_emision', 'id'):
-        abonos = sum(ing.importe for ing in factura.orden.ingreso_set.all()) if hasattr(factura.orden, 'ingreso_set') and factura.orden.ingreso_set.exists() else Decimal('0.00')
-        
-        pendiente = factura.total_final - abonos
-        if pendiente > Decimal('0.01'):
-            facturas_pendientes.append({'factura': factura, 'orden': factura.orden, 'cliente': factura.orden.cliente, 'vehiculo': factura.orden.vehiculo, 'pendiente': pendiente})
-            total_pendiente += pendiente
+        pendiente = factura.pendiente
+        facturas_pendientes.append({'factura': factura, 'orden': factura.orden, 'cliente': factura.orden.cliente, 'vehiculo': factura.orden.vehiculo, 'pendiente': pendiente})
+        total_pendiente += pendiente
             
     ano_sel_int = int(ano_seleccionado) if ano_seleccionado else None; mes_sel_int = int(mes_seleccionado) if mes_seleccionado else None
     context = { 'facturas_pendientes': facturas_pendientes, 'total_pendiente': total_pendiente, 'anos_disponibles': anos_disponibles, 'ano_seleccionado': ano_sel_int, 'mes_seleccionado': mes_sel_int, 'meses_del_ano': range(1, 13) }
@@ -2136,10 +2210,16 @@ def informe_tarjeta(request):
             else: mes_seleccionado = None
          except (ValueError, TypeError): mes_seleccionado = None
     
+    # Sin filtro de periodo el dispuesto es el global: se lee de la tabla de saldos
+    saldos_globales = SaldoCuenta.saldos() if ano_sel_int is None and mes_sel_int is None else None
+
     def calcular_tarjeta(tag, limite):
-        gastos = gastos_qs.filter(metodo_pago=tag).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        abonos = ingresos_qs.filter(metodo_pago=tag).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-        dispuesto = gastos - abonos
+        if saldos_globales is not None:
+            dispuesto = -saldos_globales[tag]
+        else:
+            gastos = gastos_qs.filter(metodo_pago=tag).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
+            abonos = ingresos_qs.filter(metodo_pago=tag).aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
+            dispuesto = gastos - abonos
         return {'limite': limite, 'dispuesto': dispuesto, 'disponible': limite - dispuesto}
 
     tarjeta_1 = calcular_tarjeta('TARJETA_1', Decimal('2000.00'))
@@ -2300,39 +2380,14 @@ def lista_deudas(request):
     
     total_deudas_normales = sum(d.importe_pendiente for d in deudas_pendientes)
     
-    gastos_t1 = Gasto.objects.filter(metodo_pago='TARJETA_1').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    abonos_t1 = Ingreso.objects.filter(metodo_pago='TARJETA_1').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    deuda_t1 = gastos_t1 - abonos_t1
-    
-    gastos_t2 = Gasto.objects.filter(metodo_pago='TARJETA_2').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    abonos_t2 = Ingreso.objects.filter(metodo_pago='TARJETA_2').aggregate(total=Sum('importe'))['total'] or Decimal('0.00')
-    deuda_t2 = gastos_t2 - abonos_t2
+    saldos = SaldoCuenta.saldos()
+    deuda_t1 = -saldos['TARJETA_1']
+    deuda_t2 = -saldos['TARJETA_2']
     
     total_tarjetas = deuda_t1 + deuda_t2
 
     # --- NUEVO: CÁLCULO DE DEUDA DE NÓMINAS ---
-    total_deuda_nominas = Decimal('0.00')
-    empleados_taller = Empleado.objects.all()
-    hoy_date = timezone.now().date()
-    
-    for emp in empleados_taller:
-        dias_pendientes = Asistencia.objects.filter(
-            empleado=emp, pagado=False, hora_salida__isnull=False
-        ).values('fecha').distinct().count()
-        
-        # --- CÁLCULO INTELIGENTE ---
-        if emp.es_sueldo_fijo:
-            dias_laborables_mes = obtener_dias_laborables_mes(hoy_date)
-            sueldo_bruto = Decimal(dias_pendientes) * (emp.sueldo_fijo_mensual / dias_laborables_mes)
-        else:
-            sueldo_bruto = dias_pendientes * emp.sueldo_por_dia
-            
-        adelantos_pendientes = AdelantoSueldo.objects.filter(empleado=emp, liquidado=False)
-        total_adelantos = sum(a.importe for a in adelantos_pendientes)
-        
-        neto_a_pagar = sueldo_bruto - total_adelantos
-        if neto_a_pagar > 0:
-            total_deuda_nominas += neto_a_pagar
+    total_deuda_nominas = calcular_resumen_nominas()['total_deuda']
 
     # Actualizamos el GRAN TOTAL sumando las nóminas
     gran_total_deuda = total_deudas_normales + total_tarjetas + total_deuda_nominas
@@ -2551,7 +2606,7 @@ def detalle_deuda(request, deuda_id):
 
 @login_required
 def inventario_lista(request):
-    tipos = TipoConsumible.objects.all().order_by('nombre')
+    tipos = consumibles_con_prevision(TipoConsumible.objects.with_stock().order_by('nombre'))
     context = {'tipos': tipos}
     return render(request, 'taller/inventario.html', context)
 
@@ -2601,45 +2656,29 @@ def ajustar_stock(request, tipo_id):
 
 @login_required
 def detalle_consumible(request, tipo_id):
-    tipo = get_object_or_404(TipoConsumible, id=tipo_id)
+    tipo = get_object_or_404(TipoConsumible.objects.with_stock(), id=tipo_id)
+    
+    # Una sola consulta ordenada y paginada sobre el libro de movimientos
+    apuntes = tipo.movimientos.select_related('compra', 'uso__orden__vehiculo', 'ajuste').order_by('-fecha', '-id')
+    pagina = Paginator(apuntes, 50).get_page(request.GET.get('page'))
     movimientos = []
     
-    for compra in CompraConsumible.objects.filter(tipo=tipo):
-        movimientos.append({
-            'fecha': compra.fecha_compra,
-            'accion': 'COMPRA',
-            'cantidad': compra.cantidad,
-            'descripcion': f"Compra de stock. Coste: {compra.coste_total}€",
-            'color': '#10b981', 
-            'signo': '+'
-        })
-        
-    for uso in UsoConsumible.objects.filter(tipo=tipo):
-        movimientos.append({
-            'fecha': uso.fecha_uso,
-            'accion': 'USO EN TALLER',
-            'cantidad': uso.cantidad_usada,
-            'descripcion': f"Vehículo: {uso.orden.vehiculo.matricula} (Orden #{uso.orden.id})",
-            'url_orden': reverse('detalle_orden', args=[uso.orden.id]),
-            'color': '#ef4444', 
-            'signo': '-'
-        })
-        
-    for ajuste in AjusteStockConsumible.objects.filter(tipo=tipo):
-        movimientos.append({
-            'fecha': ajuste.fecha_ajuste,
-            'accion': 'AJUSTE MANUAL',
-            'cantidad': abs(ajuste.cantidad_ajustada),
-            'descripcion': f"Motivo: {ajuste.motivo}",
-            'color': '#f59e0b', 
-            'signo': '+' if ajuste.cantidad_ajustada > 0 else '-'
-        })
-        
-    movimientos.sort(key=lambda x: x['fecha'], reverse=True)
+    for mov in pagina:
+        fila = {'fecha': mov.fecha, 'cantidad': abs(mov.cantidad), 'saldo': mov.saldo, 'signo': '+' if mov.cantidad > 0 else '-'}
+        if mov.tipo_movimiento == 'COMPRA':
+            fila.update({'accion': 'COMPRA', 'descripcion': f"Compra de stock. Coste: {mov.compra.coste_total}€" if mov.compra else "Compra de stock", 'color': '#10b981'})
+        elif mov.tipo_movimiento == 'USO':
+            orden = mov.uso.orden if mov.uso else None
+            fila.update({'accion': 'USO EN TALLER', 'descripcion': f"Vehículo: {orden.vehiculo.matricula} (Orden #{orden.id})" if orden else "Uso en taller", 'color': '#ef4444'})
+            if orden: fila['url_orden'] = reverse('detalle_orden', args=[orden.id])
+        else:
+            fila.update({'accion': 'AJUSTE MANUAL', 'descripcion': f"Motivo: {mov.ajuste.motivo}" if mov.ajuste else "Ajuste manual", 'color': '#f59e0b'})
+        movimientos.append(fila)
     
     context = {
         'tipo': tipo,
-        'movimientos': movimientos
+        'movimientos': movimientos,
+        'pagina': pagina
     }
     return render(request, 'taller/detalle_consumible.html', context)
 
@@ -2655,6 +2694,7 @@ def editar_consumible(request, tipo_id):
         unidad = request.POST.get('unidad_medida')
         minimo = request.POST.get('nivel_minimo_stock')
         precio = request.POST.get('precio_coste_medio')
+        metodo_coste = request.POST.get('metodo_coste')
         
         if nombre and unidad:
             tipo.nombre = nombre
@@ -2662,11 +2702,13 @@ def editar_consumible(request, tipo_id):
             tipo.nivel_minimo_stock = Decimal(minimo.replace(',', '.')) if minimo else None
             if precio:
                 tipo.precio_coste_medio = Decimal(precio.replace(',', '.'))
+            if metodo_coste in dict(TipoConsumible.METODO_COSTE_CHOICES):
+                tipo.metodo_coste = metodo_coste
                 
             tipo.save()
             return redirect('inventario')
             
-    context = {'tipo': tipo}
+    context = {'tipo': tipo, 'metodos_coste': TipoConsumible.METODO_COSTE_CHOICES}
     return render(request, 'taller/editar_consumible.html', context)
 
 # --- VISTA PARA EL ENLACE MÁGICO DEL PRESUPUESTO ---
@@ -3118,65 +3160,93 @@ def alternar_estado_taller(request):
     
     pausas_activas = HistorialEstadoOrden.objects.filter(es_pausa_jornada=True, fecha_fin__isnull=True)
 
-    if not pausas_activas.exists():
-        ordenes_a_pausar = OrdenDeReparacion.objects.filter(estado__in=estados_activos)
-        count = 0
-
-        for orden in ordenes_a_pausar:
-            ultimo = orden.historial_estados.filter(fecha_fin__isnull=True).first()
-            if ultimo:
-                ultimo.fecha_fin = ahora
-                ultimo.save()
+    # Todo en bloque: un UPDATE que cierra los tramos abiertos y un bulk_create con los nuevos, en la misma transacción
+    with transaction.atomic():
+        if not pausas_activas.exists():
+            # Bloqueamos las órdenes activas para que nadie les cambie el estado mientras cerramos
+            ordenes_a_pausar = list(OrdenDeReparacion.objects.select_for_update().filter(estado__in=estados_activos).values_list('id', 'estado'))
+
+            ids_pausadas = [orden_id for orden_id, _ in ordenes_a_pausar]
+            cerrar_tramos_historial(HistorialEstadoOrden.objects.filter(orden_id__in=ids_pausadas), ahora)
+            OrdenDeReparacion.objects.filter(id__in=ids_pausadas).update(actualizado=ahora) # Para que las tablets se refresquen
+            HistorialEstadoOrden.objects.bulk_create([
+                HistorialEstadoOrden(
+                    orden_id=orden_id, estado=f"PAUSA: {estado}", fecha_inicio=ahora,
+                    es_pausa_jornada=True, usuario=request.user
+                ) for orden_id, estado in ordenes_a_pausar
+            ])
             
-            HistorialEstadoOrden.objects.create(
-                orden=orden,
-                estado=f"PAUSA: {orden.estado}",
-                fecha_inicio=ahora,
-                es_pausa_jornada=True,
-                usuario=request.user
-            )
-            count += 1
+            messages.success(request, f"🌙 Taller cerrado. Se han pausado {len(ordenes_a_pausar)} coches activos.")
         
-        messages.success(request, f"🌙 Taller cerrado. Se han pausado {count} coches activos.")
-    
-    else:
-        count = 0
-
-        for pausa in pausas_activas:
-            pausa.fecha_fin = ahora
-            pausa.save()
-
-            estado_original = pausa.estado.replace("PAUSA: ", "")
-            HistorialEstadoOrden.objects.create(
-                orden=pausa.orden,
-                estado=estado_original,
-                fecha_inicio=ahora,
-                usuario=request.user
-            )
-            count += 1
-            
-        messages.success(request, f"☀️ Taller abierto. Se han reanudado {count} coches.")
+        else:
+            pausas = list(pausas_activas.values_list('orden_id', 'estado'))
+
+            cerrar_tramos_historial(pausas_activas, ahora)
+            OrdenDeReparacion.objects.filter(id__in=[orden_id for orden_id, _ in pausas]).update(actualizado=ahora)
+            HistorialEstadoOrden.objects.bulk_create([
+                HistorialEstadoOrden(
+                    orden_id=orden_id, estado=estado.replace("PAUSA: ", ""), fecha_inicio=ahora, usuario=request.user
+                ) for orden_id, estado in pausas
+            ])
+                
+            messages.success(request, f"☀️ Taller abierto. Se han reanudado {len(pausas)} coches.")
 
     return redirect(request.META.get('HTTP_REFERER', 'home'))
 
+CADUCIDAD_ENLACE_ESTADO = timedelta(days=90)  # Los enlaces nuevos dejan de valer a los 90 días de enviarlos
+
+def firmar_enlace_estado(orden_id):
+    return TimestampSigner().sign(orden_id)
+
+def _leer_enlace_estado(signed_id):
+    """Id de la orden del enlace, o None si es falso o ha caducado. Los enlaces antiguos (sin fecha) siguen valiendo."""
+    try:
+        return int(TimestampSigner().unsign(signed_id, max_age=CADUCIDAD_ENLACE_ESTADO))
+    except SignatureExpired:
+        return None
+    except (BadSignature, ValueError):
+        pass
+    try:
+        return int(Signer().unsign(signed_id))
+    except (BadSignature, ValueError):
+        return None
+
 def estado_vehiculo_publico(request, signed_id):
     """Vista pública y segura para que el cliente vea su coche sin precios"""
-    signer = Signer()
-    try:
-        original_id = signer.unsign(signed_id)
-        orden = get_object_or_404(OrdenDeReparacion.objects.select_related('cliente', 'vehiculo').prefetch_related('fotos'), id=original_id)
-    except BadSignature:
+    orden_id = _leer_enlace_estado(signed_id)
+    if orden_id is None:
         return HttpResponseForbidden("<h2>🔒 ENLACE INVÁLIDO</h2><p>Este enlace de seguimiento es incorrecto o ha caducado.</p>")
-    
-    # Seleccionamos solo las notas que el mecánico haya marcado como visibles
-    notas_publicas = orden.notas_internas.filter(visible_cliente=True).order_by('-fecha_creacion')
-    
-    context = {
-        'orden': orden,
-        'fotos': orden.fotos.all(),
-        'notas_publicas': notas_publicas, # PASAMOS LAS NOTAS AL HTML
-    }
-    return render(request, 'taller/estado_cliente.html', context)
+
+    # La versión de la página es la última actualización de la orden (fotos, notas visibles y estado la tocan)
+    actualizado = OrdenDeReparacion.objects.filter(id=orden_id).values_list('actualizado', flat=True).first()
+    if actualizado is None:
+        raise Http404("Orden no encontrada")
+    version = int(actualizado.timestamp() * 1000)
+    etag = f'"{orden_id}-{version}"'
+
+    # Si el navegador ya tiene esta versión, 304 sin tocar nada más
+    respuesta = get_conditional_response(request, etag=etag, last_modified=int(actualizado.timestamp()))
+    if respuesta is None:
+        clave = f"estado_publico:{orden_id}:{version}"
+        html = cache.get(clave)
+        if html is None:
+            orden = OrdenDeReparacion.objects.select_related('cliente', 'vehiculo').prefetch_related('fotos', 'reportes_escaner').get(id=orden_id)
+            # Seleccionamos solo las notas que el mecánico haya marcado como visibles
+            notas_publicas = orden.notas_internas.filter(visible_cliente=True).order_by('-fecha_creacion')
+            context = {
+                'orden': orden,
+                'fotos': orden.fotos.all(),
+                'notas_publicas': notas_publicas, # PASAMOS LAS NOTAS AL HTML
+            }
+            # Sin request: la página es igual para todos y se puede guardar tal cual
+            html = render_to_string('taller/estado_cliente.html', context)
+            cache.set(clave, html, 60 * 60 * 24)
+        respuesta = HttpResponse(html)
+
+    respuesta['ETag'] = etag
+    respuesta['Last-Modified'] = http_date(actualizado.timestamp())
+    respuesta['Cache-Control'] = 'public, no-cache'
+    return respuesta
 
 @login_required
 def fichador_mecanicos(request):
@@ -3246,23 +3316,23 @@ def panel_nominas(request):
         except (ValueError, TypeError):
             fecha_cierre = hoy
 
-        asistencias_pendientes = Asistencia.objects.filter(
-            empleado=empleado, pagado=False, hora_salida__isnull=False, fecha__lte=fecha_cierre
-        )
-        adelantos_pendientes = AdelantoSueldo.objects.filter(
-            empleado=empleado, liquidado=False, fecha__lte=fecha_cierre
-        )
+        with transaction.atomic():
+            # Bloqueamos al empleado: dos cierres a la vez (doble clic, dos pantallas) se hacen uno detrás de otro
+            empleado = Empleado.objects.select_for_update().get(id=empleado.id)
+            asistencias_pendientes = Asistencia.objects.filter(
+                empleado=empleado, pagado=False, hora_salida__isnull=False, fecha__lte=fecha_cierre
+            )
+            adelantos_pendientes = AdelantoSueldo.objects.filter(
+                empleado=empleado, liquidado=False, fecha__lte=fecha_cierre
+            )
 
-        dias_trabajados_totales = asistencias_pendientes.values('fecha').distinct().count()
-        
-        # 🟢 NUEVO CÁLCULO INTELIGENTE (POST)
-        # Sumamos directamente el valor congelado de cada día. Si no hay, es 0.00.
-        sueldo_bruto = asistencias_pendientes.aggregate(total=Sum('sueldo_ganado'))['total'] or Decimal('0.00')
-        
-        total_adelantos = sum(a.importe for a in adelantos_pendientes)
-        total_neto = sueldo_bruto - total_adelantos
+            # 🟢 CONGELAMOS AQUÍ (al escribir) los días que aún estén a 0, y después sumamos el valor congelado
+            recalcular_sueldos(sueldos_sin_congelar().filter(empleado=empleado, fecha__lte=fecha_cierre))
+            sueldo_bruto = asistencias_pendientes.aggregate(total=Sum('sueldo_ganado'))['total'] or Decimal('0.00')
+
+            total_adelantos = sum(a.importe for a in adelantos_pendientes)
+            total_neto = sueldo_bruto - total_adelantos
 
-        with transaction.atomic():
             # 1. PRIMERO marcamos todo lo viejo como cerrado
             asistencias_pendientes.update(pagado=True)
             adelantos_pendientes.update(liquidado=True)
@@ -3313,26 +3383,12 @@ def panel_nominas(request):
                 
         return redirect('panel_nominas')
 
-    # --- LÓGICA DEL GET ---
-    empleados = Empleado.objects.all()
+    # --- LÓGICA DEL GET (solo lectura: no congela nada, ver calcular_resumen_nominas) ---
     datos_nominas = []
-    
-    for emp in empleados:
-        asistencias_pendientes = Asistencia.objects.filter(empleado=emp, pagado=False, hora_salida__isnull=False)
-        
-        # 🟢 MODO SEGURO: Solo calcula si está a 0.00. Una vez calculado, se congela para siempre.
-        for asistencia in asistencias_pendientes:
-            if asistencia.sueldo_ganado == Decimal('0.00') and asistencia.tipo_jornada != 'Chapa':
-                asistencia.sueldo_ganado = asistencia.calcular_sueldo_del_dia()
-                asistencia.save(update_fields=['sueldo_ganado'])
+    dias_mes_actual = obtener_dias_laborables_mes(hoy)
 
-        dias_pendientes_totales = asistencias_pendientes.values('fecha').distinct().count()
-        
-        fechas_exactas = asistencias_pendientes.values_list('fecha', flat=True).distinct()
-        fechas_str = ", ".join([f.strftime('%d/%m') for f in fechas_exactas])
-        
-        # 🟢 SUMA EXACTA DE LOS DÍAS CONGELADOS
-        sueldo_bruto = asistencias_pendientes.aggregate(total=Sum('sueldo_ganado'))['total'] or Decimal('0.00')
+    for fila in calcular_resumen_nominas()['empleados']:
+        emp = fila['empleado']
         
         # Datos informativos para la UI
         dias_mes = 0
@@ -3340,22 +3396,18 @@ def panel_nominas(request):
         if emp.es_chapista:
             valor_dia = emp.valor_jornada_taller
         elif emp.es_sueldo_fijo:
-            dias_mes = obtener_dias_laborables_mes(hoy)
+            dias_mes = dias_mes_actual
             valor_dia = (emp.sueldo_fijo_mensual / dias_mes) if dias_mes else Decimal('0.00')
         else:
             valor_dia = emp.sueldo_por_dia
-            
-        adelantos_pendientes = AdelantoSueldo.objects.filter(empleado=emp, liquidado=False)
-        total_adelantos = sum(a.importe for a in adelantos_pendientes)
-        total_neto = sueldo_bruto - total_adelantos
         
         datos_nominas.append({
             'empleado': emp,
-            'dias': dias_pendientes_totales,
-            'fechas_str': fechas_str,
-            'bruto': sueldo_bruto,
-            'adelantos': total_adelantos,
-            'neto': total_neto,
+            'dias': fila['dias'],
+            'fechas_str': ", ".join([f.strftime('%d/%m') for f in fila['fechas']]),
+            'bruto': fila['bruto'],
+            'adelantos': fila['adelantos'],
+            'neto': fila['neto'],
             'valor_dia': valor_dia,
             'dias_mes': dias_mes
         })
@@ -3404,6 +3456,11 @@ def dar_adelanto(request):
         
     return redirect('panel_nominas')
 
+def formatear_segundos(segs):
+    horas = int(segs // 3600)
+    minutos = int((segs % 3600) // 60)
+    return f"{horas}h {minutos}m"
+
 def detalle_nomina(request, empleado_id):
     empleado = get_object_or_404(Empleado, id=empleado_id)
     hoy = timezone.now().date()
@@ -3412,12 +3469,11 @@ def detalle_nomina(request, empleado_id):
     mes_seleccionado = int(request.GET.get('mes', hoy.month))
     ano_seleccionado = int(request.GET.get('ano', hoy.year))
     
-    asistencias_db = Asistencia.objects.filter(
+    asistencias_mes = Asistencia.objects.filter(
         empleado=empleado, 
-        hora_salida__isnull=False,
         fecha__year=ano_seleccionado,
         fecha__month=mes_seleccionado
-    ).order_by('-fecha', '-hora_entrada')
+    )
     
     adelantos = AdelantoSueldo.objects.filter(
         empleado=empleado,
@@ -3425,12 +3481,10 @@ def detalle_nomina(request, empleado_id):
         fecha__month=mes_seleccionado
     ).order_by('-fecha')
 
-    # 🟢 NUEVO: MAGIA PARA EL ENLACE AL EXPEDIENTE
-    import re
+    # 🟢 NUEVO: MAGIA PARA EL ENLACE AL EXPEDIENTE (las comisiones ya llevan su orden enlazada)
     for ad in adelantos:
-        match = re.search(r'\(Orden #(\d+)\)', ad.motivo)
-        if match:
-            ad.orden_id_link = match.group(1) # Le pegamos el ID de la orden a la variable
+        if ad.orden_id:
+            ad.orden_id_link = ad.orden_id
     
     pagos = Gasto.objects.filter(
         empleado=empleado, 
@@ -3439,78 +3493,34 @@ def detalle_nomina(request, empleado_id):
         fecha__month=mes_seleccionado
     ).order_by('-fecha')
 
-    # --- LÓGICA DE CÁLCULO ESTRICTO DE HORAS ---
-    def formatear_segundos(segs):
-        horas = int(segs // 3600)
-        minutos = int((segs % 3600) // 60)
-        return f"{horas}h {minutos}m"
-
-    # Agrupamos todos los fichajes por día
-    agrupado_por_dia = defaultdict(list)
-    for a in asistencias_db:
-        agrupado_por_dia[a.fecha].append(a)
-
-    dias_procesados = []
-    semanas_dict = defaultdict(lambda: {'segundos': 0, 'dias': set()})
-    total_mes_segundos = 0
-
-    for fecha, registros in agrupado_por_dia.items():
-        total_dia_segundos = 0
-        fichajes_str = []
-        pagado_dia = True
-        
-        # Sacamos a qué semana del año pertenece este día
-        semana_iso = fecha.isocalendar()[1]
-        
-        for r in registros:
-            if not r.pagado: pagado_dia = False
-            
-            # Calculamos duración exacta del turno
-            t1 = datetime.combine(fecha, r.hora_entrada)
-            t2 = datetime.combine(fecha, r.hora_salida)
-            
-            # ESCUDO ANTIBALAS: Control de clics rápidos vs turnos de noche
-            if t2 < t1: 
-                if (t1 - t2).total_seconds() < 300: # Menos de 5 min de diferencia (clic de prueba)
-                    t2 = t1 
-                else:
-                    t2 += timedelta(days=1) # Turno de noche real (salió al día siguiente)
-                    
-            segundos_turno = (t2 - t1).total_seconds()
-            total_dia_segundos += segundos_turno
-            total_mes_segundos += segundos_turno
-            
-            # Sumamos a la semana correspondiente
-            semanas_dict[semana_iso]['segundos'] += segundos_turno
-            semanas_dict[semana_iso]['dias'].add(fecha)
-            
-            # Guardamos los tramos de horas para enseñarlos (Ej: 08:00-14:00)
-            fichajes_str.append(f"{r.hora_entrada.strftime('%H:%M')}-{r.hora_salida.strftime('%H:%M')}")
-
-        dias_procesados.append({
-            'fecha': fecha,
-            'fichajes': " | ".join(fichajes_str),
-            'total_horas': formatear_segundos(total_dia_segundos),
-            'pagado': pagado_dia
-        })
+    # --- HORAS: la duración de cada turno ya viene calculada del fichaje, aquí solo se suma en SQL ---
+    # Guardamos los tramos de horas para enseñarlos (Ej: 08:00-14:00)
+    fichajes_por_dia = defaultdict(list)
+    fichajes = asistencias_mes.filter(hora_salida__isnull=False).order_by('-fecha', '-hora_entrada')
+    for fecha, entrada, salida in fichajes.values_list('fecha', 'hora_entrada', 'hora_salida'):
+        fichajes_por_dia[fecha].append(f"{entrada.strftime('%H:%M')}-{salida.strftime('%H:%M')}")
 
     # Ordenamos de más reciente a más antiguo
-    dias_procesados = sorted(dias_procesados, key=lambda x: x['fecha'], reverse=True)
-
-    # Procesamos el resumen semanal para la pantalla
+    horas_dias = list(asistencias_mes.horas_por_dia().reverse())
+    dias_procesados = [{
+        'fecha': dia['fecha'],
+        'fichajes': " | ".join(fichajes_por_dia[dia['fecha']]),
+        'total_horas': formatear_segundos(dia['segundos']),
+        'pagado': not dia['sin_pagar']
+    } for dia in horas_dias]
+
+    # Resumen semanal (semana ISO) para la pantalla
     semanas_list = []
-    for sem, data in semanas_dict.items():
-        dias_ordenados = sorted(list(data['dias']))
-        inicio = dias_ordenados[0].strftime('%d/%m')
-        fin = dias_ordenados[-1].strftime('%d/%m')
-        rango = f"{inicio} al {fin}" if inicio != fin else f"{inicio}"
-        
+    for sem in asistencias_mes.horas_por_semana().reverse():
+        inicio = sem['inicio'].strftime('%d/%m')
+        fin = sem['fin'].strftime('%d/%m')
         semanas_list.append({
-            'semana': sem,
-            'rango': rango,
-            'total_horas': formatear_segundos(data['segundos'])
+            'semana': sem['semana'],
+            'rango': f"{inicio} al {fin}" if inicio != fin else f"{inicio}",
+            'total_horas': formatear_segundos(sem['segundos'])
         })
-    semanas_list = sorted(semanas_list, key=lambda x: x['semana'], reverse=True)
+
+    total_mes_segundos = sum(dia['segundos'] for dia in horas_dias)
 
     # Listas para el filtro HTML
     meses_del_ano = list(range(1, 13))
@@ -3530,6 +3540,53 @@ def detalle_nomina(request, empleado_id):
     })
 
 
+class _Eco:
+    # "Fichero" que devuelve lo que se le escribe: así csv.writer genera líneas sin guardar nada en memoria
+    def write(self, valor):
+        return valor
+
+@login_required
+def exportar_horas(request):
+    """CSV con las horas de TODOS los empleados entre dos fechas (para la gestoría), generado en streaming."""
+    hoy = timezone.now().date()
+    try:
+        desde = datetime.strptime(request.GET.get('desde', ''), '%Y-%m-%d').date()
+    except ValueError:
+        desde = hoy.replace(day=1)
+    try:
+        hasta = datetime.strptime(request.GET.get('hasta', ''), '%Y-%m-%d').date()
+    except ValueError:
+        hasta = hoy
+
+    asistencias = Asistencia.objects.filter(fecha__range=(desde, hasta))
+    nombres = dict(Empleado.objects.values_list('id', 'nombre'))
+
+    def horas_decimales(segundos):
+        return f"{Decimal(segundos) / 3600:.2f}".replace('.', ',')
+
+    def filas():
+        # Excel en español: BOM para los acentos y ';' como separador
+        yield '\ufeff'
+        escritor = csv.writer(_Eco(), delimiter=';')
+        yield escritor.writerow(['Empleado', 'Fecha', 'Horas', 'Horas (decimal)', 'Pagado'])
+        for dia in asistencias.horas_por_dia().iterator():
+            yield escritor.writerow([
+                nombres.get(dia['empleado'], ''), dia['fecha'].strftime('%d/%m/%Y'),
+                formatear_segundos(dia['segundos']), horas_decimales(dia['segundos']), 'NO' if dia['sin_pagar'] else 'SI'
+            ])
+        yield escritor.writerow([])
+        yield escritor.writerow(['Empleado', 'Mes', 'Horas', 'Horas (decimal)', 'Días trabajados'])
+        for mes in asistencias.horas_por_mes().iterator():
+            yield escritor.writerow([
+                nombres.get(mes['empleado'], ''), mes['mes'].strftime('%m/%Y'),
+                formatear_segundos(mes['segundos']), horas_decimales(mes['segundos']), mes['dias']
+            ])
+
+    response = StreamingHttpResponse(filas(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="Horas_{desde.strftime("%Y%m%d")}_{hasta.strftime("%Y%m%d")}.csv"'
+    return response
+
+
 @login_required
 def lista_facturas_legales(request):
     if not request.user.is_superuser:
@@ -4056,27 +4113,20 @@ def ver_stock_chapa(request):
     mes_sel_int = int(mes_seleccionado) if mes_seleccionado and mes_seleccionado.isdigit() else hoy.month
 
     # --- 2. EXTRACCIÓN DE DATOS ---
-    todos_los_lotes = StockMaterialChapa.objects.all().prefetch_related('usos__orden__vehiculo').order_by('-fecha_registro')
+    lotes_qs = StockMaterialChapa.objects.select_related('gasto_original__orden', 'gasto_original__vehiculo').prefetch_related('usos__orden__vehiculo').order_by('-fecha_registro')
     
-    lotes_activos = []
-    lotes_agotados = []
+    # Los activos SIEMPRE se muestran (Es el stock físico)
+    lotes_activos = list(lotes_qs.con_saldo())
+    # 🟢 Los agotados se FILTRAN en la BD por el mes y año de su último uso
+    lotes_agotados = list(lotes_qs.agotados().filter(ultimo_uso__year=ano_sel_int, ultimo_uso__month=mes_sel_int))
     total_dinero_disponible = Decimal('0.00')
 
-    for lote in todos_los_lotes:
+    for lote in lotes_activos + lotes_agotados:
         disponible = lote.importe_disponible
-        
         lote.saldo_real = disponible 
         lote.porcentaje_restante = (disponible / lote.importe_total) * 100 if lote.importe_total > 0 else 0
-        
-        if disponible > 0:
-            # Los activos SIEMPRE se muestran (Es el stock físico)
-            lotes_activos.append(lote)
-            total_dinero_disponible += disponible
-        else:
-            # 🟢 Los agotados se FILTRAN por el mes y año seleccionados
-            ultimo_uso = lote.usos.order_by('fecha_uso').last()
-            if ultimo_uso and ultimo_uso.fecha_uso.month == mes_sel_int and ultimo_uso.fecha_uso.year == ano_sel_int:
-                lotes_agotados.append(lote)
+    for lote in lotes_activos:
+        total_dinero_disponible += lote.saldo_real
 
     context = {
         'lotes_activos': lotes_activos,
@@ -4119,13 +4169,10 @@ def actualizar_sueldo_historial(request, empleado_id):
         empleado.save()
 
         # 3. 🟢 EL RECÁLCULO INTELIGENTE (Solo para este empleado y solo lo no pagado)
-        asistencias_pendientes = Asistencia.objects.filter(empleado=empleado, pagado=False)
-        for asis in asistencias_pendientes:
-            # Revisa la fecha de cada día sin pagar.
-            # Si el día es del mes pasado, le dejará el sueldo de 40€. 
-            # Si el día es del 1 de este mes en adelante, le pondrá los 50€.
-            asis.sueldo_ganado = asis.calcular_sueldo_del_dia()
-            asis.save(update_fields=['sueldo_ganado'])
+        # Revisa la fecha de cada día sin pagar.
+        # Si el día es del mes pasado, le dejará el sueldo de 40€. 
+        # Si el día es del 1 de este mes en adelante, le pondrá los 50€.
+        recalcular_sueldos(Asistencia.objects.filter(empleado=empleado, pagado=False))
 
         messages.success(request, f"💰 Sueldo actualizado desde el {fecha_inicio}. Las nóminas pendientes de este mes se han ajustado solas.")
         